@@ -0,0 +1,79 @@
+# Admission control against a mock provider that enforces a quota (open
+# streams and requests per minute, answering 429 past it): status codes,
+# latency of served requests, 429s the provider had to send, and how a
+# flooding session affects everyone else.
+#
+#   python -m benchmarks.bench_admission --requests 300 --concurrency 64 --quota 8
+import argparse
+import asyncio
+import collections
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import backend, percentile
+
+async def one_request(client: httpx.AsyncClient, url: str, session_id: str):
+    payload = {"session_id": session_id, "messages": f"สวัสดีค่ะ {uuid.uuid4().hex}", "temperature": 0.9, "model_id": "llama3-8b-8192"}
+    start = time.perf_counter()
+    try:
+        async with client.stream("POST", f"{url}/chat/default", json=payload) as response:
+            async for _ in response.aiter_bytes():
+                pass
+            return response.status_code, time.perf_counter() - start
+    except httpx.HTTPError:
+        return "error", time.perf_counter() - start
+
+async def run(url: str, requests: int, concurrency: int, flood: int):
+    # Steady users each with their own session, plus one session sending
+    # `flood` requests at once alongside them
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def user(client, i):
+        async with semaphore:
+            return "user", *(await one_request(client, url, f"user{i}_default"))
+
+    async def flooder(client):
+        return "flood", *(await one_request(client, url, "flood_default"))
+
+    async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=concurrency + flood + 10)) as client:
+        return await asyncio.gather(*(user(client, i) for i in range(requests)), *(flooder(client) for _ in range(flood)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--flood", type=int, default=50)
+    parser.add_argument("--quota", type=int, default=8, help="streams the provider serves at once")
+    parser.add_argument("--rpm", type=int, default=0, help="provider requests per minute, 0 for none")
+    args = parser.parse_args()
+
+    provider_env = {"MOCK_TTFT_MS": "200", "MOCK_TOKENS": "20", "MOCK_MAX_CONCURRENCY": str(args.quota), "MOCK_RPM": str(args.rpm)}
+    scenarios = [
+        ("no admission control", {}),
+        ("admission, queue", {"ADMISSION_CONCURRENCY": str(args.quota), "ADMISSION_MAX_WAIT_MS": "10000"}),
+        ("admission, short deadline", {"ADMISSION_CONCURRENCY": str(args.quota), "ADMISSION_MAX_WAIT_MS": "1000"}),
+    ]
+    if args.rpm:
+        limits = f'{{"llama3-8b-8192": {{"concurrency": {args.quota}, "rpm": {args.rpm}}}}}'
+        scenarios.append(("admission, rpm bucket", {"ADMISSION_LIMITS": limits, "ADMISSION_MAX_WAIT_MS": "10000"}))
+
+    print(f"{args.requests} user requests at concurrency {args.concurrency} + {args.flood} at once from one session, provider quota {args.quota} streams"
+          + (f", {args.rpm} rpm" if args.rpm else ""))
+    # Latencies include time queued in the server before a turn reaches admission
+    print(f"{'scenario':<28} {'statuses':<36} {'user p50':>9} {'user p99':>9} {'flood ok':>9} {'upstream 429':>13} {'wall s':>7}")
+    for name, app_env in scenarios:
+        with backend(provider_env, app_env) as (url, provider_url):
+            start = time.perf_counter()
+            results = asyncio.run(run(url, args.requests, args.concurrency, args.flood))
+            wall = time.perf_counter() - start
+            upstream = httpx.get(f"{provider_url}/stats").json()
+        statuses = collections.Counter(str(status) for _, status, _ in results)
+        user_ms = [seconds * 1000 for kind, status, seconds in results if kind == "user" and status == 200]
+        flood_ok = sum(1 for kind, status, _ in results if kind == "flood" and status == 200)
+        print(f"{name:<28} {str(dict(sorted(statuses.items()))):<36} {percentile(user_ms, 50):>9.0f} {percentile(user_ms, 99):>9.0f}"
+              f" {flood_ok:>9} {upstream['quota_rejected']:>13} {wall:>7.1f}")
+
+if __name__ == "__main__":
+    main()
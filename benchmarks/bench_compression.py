@@ -0,0 +1,140 @@
+# Database size, history-load latency and CPU cost of compressed message
+# content, on synthetic Thai tarot conversations: plain text vs zlib vs zlib
+# with a trained dictionary (and zstd when the zstandard package is installed).
+#
+#   python -m benchmarks.bench_compression --sessions 2000 --turns 10
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import insert, text
+from sqlalchemy.orm import sessionmaker
+
+import src.compression as compression
+from benchmarks.common import percentile
+from src.compression import HAS_ZSTANDARD, Codec, train_dictionary
+from src.models import Message, Session as DBSession, SessionSummary, create_db_engine, init_db
+from src.tarot import card_names, card_name_to_description
+
+GREETINGS = [
+    "สวัสดีค่ะ ฉันชื่อ{seer} เป็นหมอดูไพ่ทาโรต์ วันนี้อยากให้ช่วยดูเรื่องอะไรดีคะ",
+    "ยินดีต้อนรับค่ะ ฉัน{seer}จะช่วยเปิดไพ่ให้นะคะ ลองเล่าเรื่องที่กังวลใจให้ฟังหน่อยค่ะ",
+]
+QUESTIONS = [
+    "ช่วยดูเรื่องความรักให้หน่อยค่ะ ช่วงนี้รู้สึกไม่แน่ใจในความสัมพันธ์",
+    "อยากรู้เรื่องการงานค่ะ ควรเปลี่ยนงานใหม่ดีไหม",
+    "เรื่องการเงินช่วงนี้จะเป็นอย่างไรบ้างคะ",
+    "สุขภาพของคุณแม่จะดีขึ้นไหมคะ",
+    "ไพ่ใบนี้หมายความว่าอย่างไรคะ",
+    "แล้วเดือนหน้าจะดีขึ้นไหมคะ",
+]
+OPENINGS = [
+    "ฉันเห็นว่าคุณเลือกไพ่นะคะ ไพ่ที่คุณเลือกคือ {card}",
+    "จากไพ่ {card} ที่เปิดได้ ขอตีความแบบนี้นะคะ",
+    "ไพ่ {card} มาในตำแหน่งนี้ น่าสนใจมากค่ะ",
+]
+ADVICE = [
+    "ช่วงนี้ควรใจเย็น ๆ และรับฟังความรู้สึกของตัวเองให้มากขึ้นนะคะ",
+    "อย่าเพิ่งตัดสินใจอะไรเร็วเกินไป ลองคุยกับคนที่ไว้ใจก่อนค่ะ",
+    "พลังงานโดยรวมเป็นบวก สิ่งที่ตั้งใจไว้มีโอกาสสำเร็จค่ะ",
+    "ระวังเรื่องค่าใช้จ่ายที่ไม่จำเป็นในช่วงสองสามสัปดาห์นี้นะคะ",
+    "ความสัมพันธ์จะชัดเจนขึ้นเมื่อทั้งสองฝ่ายเปิดใจคุยกันตรง ๆ ค่ะ",
+    "การเปลี่ยนแปลงที่เกิดขึ้นอาจดูน่ากลัว แต่จะพาไปสู่สิ่งที่ดีกว่าค่ะ",
+    "ขอให้เชื่อในสัญชาติญาณของตัวเอง คำตอบอยู่ในใจคุณแล้วค่ะ",
+]
+
+def conversation(rng: random.Random, turns: int):
+    # [(role, content)] for one session, and a rolling summary of it
+    seer = rng.choice(["แม่หมอมงคล", "อาจารย์ดวงดาว", "หมอจันทร์"])
+    messages = [("assistant", rng.choice(GREETINGS).format(seer=seer))]
+    for _ in range(turns):
+        cards = rng.sample(card_names, rng.randint(1, 3))
+        messages.append(("user", rng.choice(QUESTIONS) + " ไพ่ที่เลือกคือ " + ", ".join(cards)))
+        reply = []
+        for card in cards:
+            reply.append(rng.choice(OPENINGS).format(card=card))
+            reply.append(card_name_to_description[card])
+        reply.extend(rng.sample(ADVICE, 3))
+        messages.append(("assistant", " ".join(reply)))
+    summary = " ".join(content for _, content in rng.sample(messages[1:], min(4, len(messages) - 1)))
+    return messages, summary
+
+def populate(engine, sessions: int, turns: int, seed: int = 0):
+    # Returns (seconds, CPU seconds) spent inserting, which includes compressing
+    rng = random.Random(seed)
+    corpus = [conversation(rng, turns) for _ in range(sessions)]
+    started, cpu = time.perf_counter(), time.process_time()
+    with engine.begin() as conn:
+        conn.execute(insert(DBSession), [{"id": i + 1, "session_id": f"s{i}_memory"} for i in range(sessions)])
+        conn.execute(insert(Message), [
+            {"session_id": i + 1, "role": role, "content": content}
+            for i, (messages, _) in enumerate(corpus) for role, content in messages
+        ])
+        conn.execute(insert(SessionSummary), [
+            {"session_id": i + 1, "summary": summary, "last_message_id": 0} for i, (_, summary) in enumerate(corpus)
+        ])
+    return time.perf_counter() - started, time.process_time() - cpu
+
+def measure(name: str, codec: Codec, workdir: str, args):
+    compression.codec = codec
+    path = os.path.join(workdir, f"{name.replace(' ', '_')}.db")
+    engine = create_db_engine(f"sqlite:///{path}")
+    init_db(engine)
+    write_seconds, write_cpu = populate(engine, args.sessions, args.turns)
+    with engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+        compressed = conn.execute(text("SELECT count(*) FROM messages WHERE typeof(content) = 'blob'")).scalar()
+        total = conn.execute(text("SELECT count(*) FROM messages")).scalar()
+
+    db = sessionmaker(bind=engine)()
+    rng = random.Random(1)
+    loads = []
+    cpu = time.process_time()
+    for _ in range(args.samples):
+        session_pk = rng.randint(1, args.sessions)
+        start = time.perf_counter()
+        db.query(Message.id, Message.role, Message.content).filter(Message.session_id == session_pk).order_by(Message.id).all()
+        db.get(SessionSummary, session_pk)
+        loads.append((time.perf_counter() - start) * 1000)
+        db.expunge_all()
+    read_cpu = (time.process_time() - cpu) / args.samples * 1000
+    db.close()
+    engine.dispose()
+
+    size_mb = os.path.getsize(path) / 1024 / 1024
+    print(f"{name:<20} {size_mb:>8.1f} {compressed / total * 100:>7.0f}% {write_seconds:>8.2f} {write_cpu:>8.2f}"
+          f" {percentile(loads, 50):>8.2f} {percentile(loads, 99):>8.2f} {read_cpu:>9.3f}")
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--min-bytes", type=int, default=256)
+    args = parser.parse_args()
+
+    # The dictionary is trained on other conversations than the ones measured
+    rng = random.Random(42)
+    training = [content for _ in range(500) for _, content in conversation(rng, args.turns)[0]]
+    zlib_dictionary = train_dictionary(training, "zlib")
+    configs = [
+        ("plain text", Codec("off")),
+        ("zlib", Codec("zlib", args.min_bytes, dictionaries=[])),
+        ("zlib + dictionary", Codec("zlib", args.min_bytes, dictionaries=[zlib_dictionary])),
+    ]
+    if HAS_ZSTANDARD:
+        configs += [
+            ("zstd", Codec("zstd", args.min_bytes, 3, dictionaries=[])),
+            ("zstd + dictionary", Codec("zstd", args.min_bytes, 3, dictionaries=[train_dictionary(training, "zstd", 64 * 1024)])),
+        ]
+
+    print(f"{args.sessions} sessions x {args.turns} turns, {args.samples} history loads")
+    print(f"{'storage':<20} {'size MB':>8} {'blobs':>8} {'write s':>8} {'cpu s':>8} {'p50 ms':>8} {'p99 ms':>8} {'cpu ms/load':>9}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, codec in configs:
+            measure(name, codec, workdir, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# Time-to-first-token under concurrent streams against the local mock provider.
+#
+#   python -m benchmarks.bench_concurrency --concurrency 1 50 200
+import argparse
+import asyncio
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import backend, percentile
+
+async def one_stream(client: httpx.AsyncClient, url: str, route: str):
+    payload = {"session_id": f"{uuid.uuid4()}_bench", "messages": "สวัสดีค่ะ", "model_id": "llama-3.1-8b-instant"}
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", f"{url}{route}", json=payload) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_text():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - start
+    return ttft, time.perf_counter() - start
+
+async def run_level(url: str, route: str, concurrency: int):
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(limits=limits, timeout=120) as client:
+        results = await asyncio.gather(*(one_stream(client, url, route) for _ in range(concurrency)))
+    ttfts = [r[0] * 1000 for r in results]
+    totals = [r[1] * 1000 for r in results]
+    return ttfts, totals
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 50, 200])
+    parser.add_argument("--route", default="/chat/default")
+    parser.add_argument("--ttft-ms", default="200")
+    parser.add_argument("--token-delay-ms", default="10")
+    parser.add_argument("--tokens", default="50")
+    args = parser.parse_args()
+
+    provider_env = {"MOCK_TTFT_MS": args.ttft_ms, "MOCK_TOKEN_DELAY_MS": args.token_delay_ms, "MOCK_TOKENS": args.tokens}
+    with backend(provider_env) as (url, _):
+        asyncio.run(run_level(url, args.route, 1))  # warm-up
+        print(f"{'streams':>8} {'ttft p50':>10} {'ttft p99':>10} {'total p50':>10} {'total p99':>10}  (ms)")
+        for concurrency in args.concurrency:
+            ttfts, totals = asyncio.run(run_level(url, args.route, concurrency))
+            print(f"{concurrency:>8} {percentile(ttfts, 50):>10.1f} {percentile(ttfts, 99):>10.1f} "
+                  f"{percentile(totals, 50):>10.1f} {percentile(totals, 99):>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+# History-load and insert latency before (baseline schema, default SQLite settings)
+# and after (indexed schema, WAL and tuned pragmas).
+#
+#   python -m benchmarks.bench_db --sessions 10000 --messages 100
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.common import percentile
+from src.models import Message, create_db_engine, init_db
+
+# The original tables, plus the later columns the models now select
+BASELINE_DDL = [
+    "CREATE TABLE sessions (id INTEGER NOT NULL PRIMARY KEY, session_id VARCHAR NOT NULL UNIQUE, created_at TIMESTAMP)",
+    "CREATE TABLE messages (id INTEGER NOT NULL PRIMARY KEY, session_id INTEGER NOT NULL REFERENCES sessions (id), "
+    "model_id VARCHAR, role VARCHAR NOT NULL, content TEXT NOT NULL, created_at TIMESTAMP, truncated BOOLEAN NOT NULL DEFAULT 0)",
+]
+
+CONTENT = "ฉันเห็นว่าคุณเลือกไพ่นะคะ ไพ่ที่คุณเลือก The Fool"
+
+def populate(path: str, sessions: int, messages: int):
+    # Interleave sessions the way concurrent traffic does, so one session's rows are scattered
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO sessions (id, session_id) VALUES (?, ?)", ((i, f"s{i}") for i in range(1, sessions + 1)))
+    rows = (
+        (m * sessions + s, s, "llama-3.1-8b-instant", "user" if m % 2 == 0 else "assistant", CONTENT)
+        for m in range(messages) for s in range(1, sessions + 1)
+    )
+    conn.executemany("INSERT INTO messages (id, session_id, model_id, role, content) VALUES (?, ?, ?, ?, ?)", rows)
+    conn.commit()
+    conn.close()
+
+def measure(engine, sessions: int, samples: int, writers: int):
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    rng = random.Random(0)
+    db = SessionLocal()
+
+    loads = []
+    for _ in range(samples):
+        session_pk = rng.randint(1, sessions)
+        start = time.perf_counter()
+        db.query(Message).filter(Message.session_id == session_pk).order_by(Message.id).all()
+        loads.append((time.perf_counter() - start) * 1000)
+
+    inserts = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        db.add(Message(session_id=rng.randint(1, sessions), role="user", content=CONTENT))
+        db.commit()
+        inserts.append((time.perf_counter() - start) * 1000)
+    db.close()
+
+    def writer():
+        local = SessionLocal()
+        for _ in range(samples // writers):
+            local.add(Message(session_id=rng.randint(1, sessions), role="user", content=CONTENT))
+            local.commit()
+        local.close()
+
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    throughput = (samples // writers) * writers / (time.perf_counter() - start)
+    return loads, inserts, throughput
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=100)
+    parser.add_argument("--samples", type=int, default=200)
+    parser.add_argument("--writers", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        before_path = os.path.join(workdir, "before.db")
+        conn = sqlite3.connect(before_path)
+        for ddl in BASELINE_DDL:
+            conn.execute(ddl)
+        conn.close()
+        populate(before_path, args.sessions, args.messages)
+        before = create_engine(f"sqlite:///{before_path}")
+
+        after_path = os.path.join(workdir, "after.db")
+        after = create_db_engine(f"sqlite:///{after_path}")
+        init_db(after)
+        populate(after_path, args.sessions, args.messages)
+
+        print(f"{args.sessions} sessions x {args.messages} messages")
+        print(f"{'schema':>7} {'load p50':>9} {'load p99':>9} {'insert p50':>11} {'insert p99':>11} {'inserts/s':>10}  (ms)")
+        for name, engine in (("before", before), ("after", after)):
+            loads, inserts, throughput = measure(engine, args.sessions, args.samples, args.writers)
+            print(f"{name:>7} {percentile(loads, 50):>9.2f} {percentile(loads, 99):>9.2f} "
+                  f"{percentile(inserts, 50):>11.2f} {percentile(inserts, 99):>11.2f} {throughput:>10.0f}")
+            engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+# Per-turn time-to-first-token on one long /chat/memory session.
+#
+#   python -m benchmarks.bench_memory --turns 30 --summary-threshold 6
+import argparse
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import backend, percentile
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=30)
+    parser.add_argument("--summary-threshold", type=int, default=6)
+    parser.add_argument("--ttft-ms", default="200")
+    args = parser.parse_args()
+
+    session_id = f"{uuid.uuid4()}_memory"
+    provider_env = {"MOCK_TTFT_MS": args.ttft_ms, "MOCK_TOKEN_DELAY_MS": "5", "MOCK_TOKENS": "50"}
+    ttfts = []
+    with backend(provider_env) as (url, _), httpx.Client(timeout=120) as client:
+        for turn in range(args.turns):
+            payload = {
+                "session_id": session_id,
+                "messages": f"คำถามที่ {turn}",
+                "model_id": "llama-3.1-8b-instant",
+                "summary_threshold": args.summary_threshold,
+            }
+            start = time.perf_counter()
+            ttft = None
+            with client.stream("POST", f"{url}/chat/memory", json=payload) as response:
+                response.raise_for_status()
+                for chunk in response.iter_text():
+                    if chunk and ttft is None:
+                        ttft = (time.perf_counter() - start) * 1000
+            ttfts.append(ttft)
+            print(f"turn {turn:>3}  ttft {ttft:>8.1f} ms")
+        history = client.get(f"{url}/view_history", params={"session_id": session_id}).json()["history"]
+
+    print(f"ttft p50 {percentile(ttfts, 50):.1f} ms  p99 {percentile(ttfts, 99):.1f} ms  max {max(ttfts):.1f} ms")
+    print(f"messages stored: {len(history)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# Reply persistence from many concurrent streams: one commit per reply (the old
+# path) vs the batching write-behind MessageWriter. Both fill in reply rows
+# reserved up front, as each user turn's transaction does.
+#
+#   python -m benchmarks.bench_persistence --concurrency 1 50 200
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from benchmarks.common import percentile
+
+CONTENT = "ไพ่ The Fool บอกว่าคุณกำลังจะได้เริ่มต้นสิ่งใหม่ค่ะ " * 10
+
+async def run_level(mode: str, concurrency: int, rounds: int):
+    from src.models import Message, SessionLocal, run_db
+    from src.persistence import MessageWriter, write_replies
+
+    with SessionLocal() as db:
+        reserved = [[Message(session_id=i + 1, role="assistant", content="", pending=True) for _ in range(rounds)] for i in range(concurrency)]
+        db.add_all(message for replies in reserved for message in replies)
+        db.commit()
+        reserved = [[message.id for message in replies] for replies in reserved]
+
+    writer = MessageWriter()
+    writer.start()
+    waits = []
+
+    async def stream(i: int):
+        for reply_id in reserved[i]:
+            start = time.perf_counter()
+            if mode == "direct":
+                await run_db(write_replies, [{"id": reply_id, "session_id": i + 1, "content": CONTENT, "model_id": "bench", "truncated": False}])
+            else:
+                await writer.submit(str(i), i + 1, reply_id, CONTENT, "bench")
+            waits.append((time.perf_counter() - start) * 1000)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(stream(i) for i in range(concurrency)))
+    await writer.stop()
+    elapsed = time.perf_counter() - start
+    return concurrency * rounds / elapsed, waits
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 50, 200])
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.environ["DATABASE_URL"] = f"sqlite:///{workdir}/bench.db"
+        from src.models import Session, SessionLocal, init_db
+        init_db()
+        # Replies are written to existing sessions, whose version they bump
+        with SessionLocal() as db:
+            db.add_all(Session(id=i + 1, session_id=str(i)) for i in range(max(args.concurrency)))
+            db.commit()
+
+        print(f"{'mode':>8} {'streams':>8} {'rows/s':>8} {'stream wait p50':>16} {'p99':>8}  (ms)")
+        for concurrency in args.concurrency:
+            for mode in ("direct", "writer"):
+                throughput, waits = asyncio.run(run_level(mode, concurrency, args.rounds))
+                print(f"{mode:>8} {concurrency:>8} {throughput:>8.0f} {percentile(waits, 50):>16.3f} {percentile(waits, 99):>8.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# Build and query latency of the BM25 retrieval index as the corpus grows.
+#
+#   python -m benchmarks.bench_retrieval --sizes 78 1000 10000 100000
+import argparse
+import pickle
+import random
+import time
+
+from benchmarks.common import percentile
+from src.retrieval import Passage, RagIndex, tarot_passages
+
+QUERIES = [
+    "ผมกังวลเรื่องความรักและการเงิน",
+    "งานไม่มั่นคง อยากเปลี่ยนงานใหม่",
+    "ทะเลาะกับแฟนบ่อย ควรทำอย่างไรดี",
+    "สุขภาพไม่ค่อยดี เครียดเรื่องครอบครัว",
+    "อยากรู้ว่าจะสอบผ่านไหม",
+]
+
+def synthetic_corpus(size: int, seed: int = 0):
+    # Document passages of shuffled phrases from the real card descriptions
+    rng = random.Random(seed)
+    phrases = [phrase for passage in tarot_passages() for phrase in passage.text.split()]
+    passages = []
+    while len(passages) < size:
+        text = " ".join(rng.choice(phrases) for _ in range(rng.randint(5, 15)))
+        passages.append(Passage(f"doc-{len(passages)}", text))
+    return passages
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[78, 1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{'documents':>9} {'build ms':>10} {'load ms':>9} {'query p50 ms':>13} {'query p99 ms':>13}")
+    for size in args.sizes:
+        corpus = synthetic_corpus(size)
+        start = time.perf_counter()
+        index = RagIndex(tarot_passages(), corpus)
+        build_ms = (time.perf_counter() - start) * 1000
+
+        # What a restart pays with RAG_INDEX_CACHE set
+        blob = pickle.dumps(index, protocol=pickle.HIGHEST_PROTOCOL)
+        start = time.perf_counter()
+        index = pickle.loads(blob)
+        load_ms = (time.perf_counter() - start) * 1000
+
+        latencies = []
+        for i in range(args.queries):
+            start = time.perf_counter()
+            index.retrieve(QUERIES[i % len(QUERIES)], ["The Fool", "Death"])
+            latencies.append((time.perf_counter() - start) * 1000)
+        print(f"{size:>9} {build_ms:>10.1f} {load_ms:>9.1f} {percentile(latencies, 50):>13.3f} {percentile(latencies, 99):>13.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Tail latency and errors with hedging and fallbacks, against two local mock
+# providers: "typhoon" with occasional slow first tokens or errors and a
+# faster, steady "groq".
+#
+#   python -m benchmarks.bench_routing --requests 200 --concurrency 10
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import percentile, serve
+
+TYPHOON_MODEL = "typhoon-v1.5x-70b-instruct"
+GROQ_MODEL = "llama-3.1-70b-versatile"
+
+async def one_stream(client: httpx.AsyncClient, url: str):
+    payload = {"session_id": f"{uuid.uuid4()}_bench", "messages": "สวัสดีค่ะ", "model_id": TYPHOON_MODEL}
+    start = time.perf_counter()
+    ttft = None
+    try:
+        async with client.stream("POST", f"{url}/chat/default", json=payload) as response:
+            if response.status_code != 200:
+                return None, None
+            async for chunk in response.aiter_text():
+                if chunk and ttft is None:
+                    ttft = time.perf_counter() - start
+            return ttft, response.headers.get("x-model-id")
+    except httpx.HTTPError:
+        return None, None
+
+async def run(url: str, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(client):
+        async with semaphore:
+            return await one_stream(client, url)
+
+    async with httpx.AsyncClient(timeout=120) as client:
+        return await asyncio.gather(*(bounded(client) for _ in range(requests)))
+
+@contextlib.contextmanager
+def routed_backend(typhoon_env: dict, app_env: dict):
+    with tempfile.TemporaryDirectory() as workdir:
+        with serve("benchmarks.mock_provider:app", env=typhoon_env) as typhoon_url, \
+                serve("benchmarks.mock_provider:app", env={"MOCK_TTFT_MS": "150"}) as groq_url:
+            env = {
+                "TYPHOON_BASE_URL": f"{typhoon_url}/v1",
+                "GROQ_BASE_URL": f"{groq_url}/v1",
+                "GROQ_API_KEY": "mock",
+                "TYPHOON_API_KEY": "mock",
+            }
+            env.update(app_env)
+            with serve("main:app", env=env, cwd=workdir) as app_url:
+                yield app_url
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--hedge-ms", default="400")
+    args = parser.parse_args()
+
+    slow = {"MOCK_TTFT_MS": "200", "MOCK_SLOW_RATE": "0.1", "MOCK_SLOW_MS": "2000"}
+    failing = {"MOCK_TTFT_MS": "200", "MOCK_ERROR_RATE": "0.3"}
+    fallbacks = json.dumps({TYPHOON_MODEL: [GROQ_MODEL]})
+    scenarios = [
+        ("slow tail, no routing", slow, {}),
+        ("slow tail, hedge same model", slow, {"ROUTING_HEDGE_MS": args.hedge_ms}),
+        ("slow tail, hedge to fallback", slow, {"ROUTING_HEDGE_MS": args.hedge_ms, "MODEL_FALLBACKS": fallbacks}),
+        ("errors, no routing", failing, {}),
+        ("errors, fallback", failing, {"MODEL_FALLBACKS": fallbacks}),
+    ]
+
+    print(f"{'scenario':<30} {'ttft p50':>9} {'ttft p99':>9} {'errors':>7}  served by")
+    for name, typhoon_env, app_env in scenarios:
+        with routed_backend(typhoon_env, app_env) as url:
+            results = asyncio.run(run(url, args.requests, args.concurrency))
+        ttfts = [ttft * 1000 for ttft, _ in results if ttft is not None]
+        errors = sum(1 for ttft, _ in results if ttft is None)
+        served = collections.Counter(model for _, model in results if model)
+        print(f"{name:<30} {percentile(ttfts, 50):>9.1f} {percentile(ttfts, 99):>9.1f} {errors:>7}  {dict(served)}")
+
+if __name__ == "__main__":
+    main()
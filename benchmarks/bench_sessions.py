@@ -0,0 +1,110 @@
+# /list_sessions at scale: the old N+1 COUNT per session, a single GROUP BY,
+# and the maintained counters with keyset pages and filters.
+#
+#   python -m benchmarks.bench_sessions --sessions 100000 --messages 5
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from sqlalchemy import func, text
+from sqlalchemy.orm import sessionmaker
+
+from benchmarks.common import percentile
+
+CONTENT = "ฉันเห็นว่าคุณเลือกไพ่นะคะ ไพ่ที่คุณเลือก The Fool"
+
+def populate(path: str, sessions: int, messages: int):
+    # Interleaved like concurrent traffic; three session_id suffixes for the prefix filter
+    conn = sqlite3.connect(path)
+    suffixes = ("default", "rag", "memory")
+    conn.executemany(
+        "INSERT INTO sessions (id, session_id, created_at) VALUES (?, ?, datetime('now', ?))",
+        ((i, f"{suffixes[i % 3]}-{i:07d}", f"-{sessions - i} seconds") for i in range(1, sessions + 1)),
+    )
+    rows = (
+        (m * sessions + s, s, "user" if m % 2 == 0 else "assistant", CONTENT, f"-{(messages - m) * sessions - s} seconds")
+        for m in range(messages) for s in range(1, sessions + 1)
+    )
+    conn.executemany("INSERT INTO messages (id, session_id, role, content, created_at) VALUES (?, ?, ?, ?, datetime('now', ?))", rows)
+    conn.commit()
+    conn.close()
+
+def n_plus_one(db):
+    # The original /list_sessions
+    from src.models import Message, Session as DBSession
+    return [
+        {"session_id": session.session_id, "message_count": db.query(Message).filter(Message.session_id == session.id).count()}
+        for session in db.query(DBSession).all()
+    ]
+
+def group_by(db):
+    from src.models import Message, Session as DBSession
+    rows = db.query(DBSession.session_id, func.count(Message.id)).outerjoin(Message, Message.session_id == DBSession.id).group_by(DBSession.id).all()
+    return [{"session_id": session_id, "message_count": count} for session_id, count in rows]
+
+def timed(fn, repeat: int):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return percentile(samples, 50)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=100000)
+    parser.add_argument("--messages", type=int, default=5)
+    parser.add_argument("--page", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        from src.app import list_session_info
+        from src.migrations import add_session_activity
+        from src.models import create_db_engine, init_db
+
+        path = os.path.join(workdir, "sessions.db")
+        engine = create_db_engine(f"sqlite:///{path}")
+        init_db(engine)
+        populate(path, args.sessions, args.messages)
+
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            add_session_activity(conn)
+        backfill = time.perf_counter() - start
+        print(f"{args.sessions} sessions x {args.messages} messages, counter backfill {backfill:.2f}s")
+
+        db = sessionmaker(bind=engine)()
+        with engine.connect() as conn:
+            middle = conn.execute(text("SELECT last_activity FROM sessions WHERE id = :id"), {"id": args.sessions // 2}).scalar()
+
+        def deep_page():
+            # Walk 20 pages by keyset position, report per page below
+            position = None
+            for _ in range(20):
+                rows = list_session_info(None, None, None, "last_activity", position, args.page, db)
+                position = [rows[-1].last_activity, rows[-1].id]
+
+        cases = [
+            ("N+1 COUNT per session (old)", lambda: n_plus_one(db), 1),
+            ("single GROUP BY", lambda: group_by(db), args.repeat),
+            ("counters, full list", lambda: list_session_info(None, None, None, "last_activity", None, None, db), args.repeat),
+            (f"counters, first page of {args.page}", lambda: list_session_info(None, None, None, "last_activity", None, args.page, db), args.repeat),
+            ("counters, per page over 20 pages", lambda: deep_page(), args.repeat),
+            ("counters, prefix 'rag-', page", lambda: list_session_info("rag-", None, None, "last_activity", None, args.page, db), args.repeat),
+            ("counters, active before mid, page", lambda: list_session_info(None, None, middle, "last_activity", None, args.page, db), args.repeat),
+            ("counters, by session_id, page", lambda: list_session_info(None, None, None, "session_id", None, args.page, db), args.repeat),
+        ]
+        print(f"{'query':<36} {'p50 ms':>10}")
+        for name, fn, repeat in cases:
+            ms = timed(fn, repeat)
+            if name.startswith("counters, per page"):
+                ms /= 20
+            print(f"{name:<36} {ms:>10.2f}")
+        db.close()
+        engine.dispose()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Write throughput of chat turns spread over 1, 2, 4 and 8 SQLite shards.
+# Writer processes each run turn transactions like save_user_message (look up
+# the session, insert a message, bump its counters, commit) against the shard
+# the session hashes to; SQLite takes one writer per file, so more files
+# let more of those transactions commit at once.
+#
+#   python -m benchmarks.bench_sharding --shards 1 2 4 8 --writers 8 --turns 2000
+import argparse
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+from src.models import Message, Session as DBSession, bump_session_version, create_db_engine, init_db
+from src.sharding import HashRing
+
+CONTENT = "ฉันเห็นว่าคุณเลือกไพ่นะคะ ไพ่ที่คุณเลือก The Fool"
+
+def shard_urls(workdir: str, count: int):
+    return {str(i): f"sqlite:///{os.path.join(workdir, f'shard{i}.db')}" for i in range(count)}
+
+def writer(urls, sessions: int, turns: int, seed: int, start):
+    ring = HashRing(urls)
+    factories = {name: sessionmaker(autocommit=False, autoflush=False, bind=create_db_engine(url)) for name, url in urls.items()}
+    rng = random.Random(seed)
+    start.wait()
+    for _ in range(turns):
+        session_id = f"s{rng.randrange(sessions)}_default"
+        with factories[ring.node(session_id)]() as db:
+            pk = db.execute(select(DBSession.id).where(DBSession.session_id == session_id)).scalar_one()
+            db.add(Message(session_id=pk, role="user", content=CONTENT, model_id="bench"))
+            db.flush()
+            bump_session_version(pk, db, 1)
+            db.commit()
+
+def measure(workdir: str, count: int, writers: int, sessions: int, turns: int):
+    # Sessions exist up front, each on its shard
+    urls = shard_urls(workdir, count)
+    ring = HashRing(urls)
+    for name, url in urls.items():
+        engine = create_db_engine(url)
+        init_db(engine)
+        with sessionmaker(bind=engine)() as db:
+            db.add_all(DBSession(session_id=f"s{i}_default") for i in range(sessions) if ring.node(f"s{i}_default") == name)
+            db.commit()
+        engine.dispose()
+    start = multiprocessing.get_context("spawn").Event()
+    processes = [multiprocessing.get_context("spawn").Process(target=writer, args=(urls, sessions, turns, i, start)) for i in range(writers)]
+    for process in processes:
+        process.start()
+    # Let every writer connect before the clock starts
+    time.sleep(2)
+    started = time.perf_counter()
+    start.set()
+    for process in processes:
+        process.join()
+    return writers * turns / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=2000)
+    parser.add_argument("--turns", type=int, default=2000, help="transactions per writer")
+    args = parser.parse_args()
+
+    print(f"{args.writers} writer processes x {args.turns} turns over {args.sessions} sessions")
+    print(f"{'shards':>6} {'turns/s':>9} {'speedup':>8}")
+    baseline = None
+    for count in args.shards:
+        with tempfile.TemporaryDirectory() as workdir:
+            throughput = measure(workdir, count, args.writers, args.sessions, args.turns)
+        baseline = baseline or throughput
+        print(f"{count:>6} {throughput:>9.0f} {throughput / baseline:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Cold start of the API: time to import main, time until a fresh uvicorn
+# worker accepts connections, and the first and second chat replies against
+# the mock provider. Each run starts with an empty database. Results go to
+# --output as JSON, and --compare fails the run when a median regressed by
+# more than --max-regression percent.
+#
+#   python -m benchmarks.bench_startup --runs 5 --output startup_results.json
+#   python -m benchmarks.bench_startup --compare startup_results.json
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import REPO_ROOT, serve
+
+IMPORT_MAIN = "import time; started = time.perf_counter(); import main; print((time.perf_counter() - started) * 1000)"
+
+def python_env(env: dict = None) -> dict:
+    child_env = dict(os.environ)
+    child_env["PYTHONPATH"] = REPO_ROOT + os.pathsep + child_env.get("PYTHONPATH", "")
+    child_env.update(env or {})
+    return child_env
+
+def import_ms(workdir: str) -> float:
+    output = subprocess.run([sys.executable, "-c", IMPORT_MAIN], cwd=workdir, env=python_env(), capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+def heaviest_imports(workdir: str, top: int = 6):
+    # Top-level packages by cumulative import time, from python -X importtime
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import main"], cwd=workdir, env=python_env(), capture_output=True, text=True, check=True)
+    packages = {}
+    for match in re.finditer(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", output.stderr):
+        cumulative, name = int(match.group(1)), match.group(3)
+        package = name.split(".")[0]
+        if package not in ("main", "src"):
+            packages[package] = max(packages.get(package, 0), cumulative)
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+def chat_ms(client: httpx.Client, url: str) -> float:
+    payload = {"session_id": f"{uuid.uuid4().hex}_default", "messages": "สวัสดีค่ะ", "model_id": "llama-3.1-8b-instant"}
+    started = time.perf_counter()
+    with client.stream("POST", f"{url}/chat/default", json=payload) as response:
+        response.raise_for_status()
+        for _ in response.iter_bytes():
+            pass
+    return (time.perf_counter() - started) * 1000
+
+def cold_start(provider_url: str):
+    # (ms until the worker accepts connections, first reply ms, second reply ms)
+    env = {"GROQ_BASE_URL": f"{provider_url}/v1", "TYPHOON_BASE_URL": f"{provider_url}/v1", "GROQ_API_KEY": "mock", "TYPHOON_API_KEY": "mock"}
+    with tempfile.TemporaryDirectory() as workdir:
+        started = time.perf_counter()
+        with serve("main:app", env=env, cwd=workdir) as url:
+            ready = (time.perf_counter() - started) * 1000
+            with httpx.Client(timeout=60) as client:
+                return ready, chat_ms(client, url), chat_ms(client, url)
+
+def compare(results, baseline_path: str, max_regression: float):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for name, after in results.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        change = (after - before) / before * 100
+        if change > max_regression:
+            regressions.append(f"{name}: {before:.1f} -> {after:.1f} ({change:+.0f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--output", default="startup_results.json")
+    parser.add_argument("--compare")
+    parser.add_argument("--max-regression", type=float, default=25.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        imports = [import_ms(workdir) for _ in range(args.runs)]
+        heaviest = heaviest_imports(workdir)
+    with serve("benchmarks.mock_provider:app", env={"MOCK_TTFT_MS": "0", "MOCK_TOKEN_DELAY_MS": "0"}) as provider_url:
+        starts = [cold_start(provider_url) for _ in range(args.runs)]
+
+    results = {
+        "import_ms": statistics.median(imports),
+        "ready_ms": statistics.median(ready for ready, _, _ in starts),
+        "first_reply_ms": statistics.median(first for _, first, _ in starts),
+        "second_reply_ms": statistics.median(second for _, _, second in starts),
+    }
+    print(f"median of {args.runs} runs, each worker on an empty database")
+    for name, value in results.items():
+        print(f"{name:<16} {value:>8.1f}")
+    print("heaviest imports (cumulative ms): " + ", ".join(f"{package} {us / 1000:.0f}" for package, us in heaviest))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"config": {"runs": args.runs}, "results": results, "heaviest_imports_us": dict(heaviest)}, f, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# Socket writes and server CPU per reply for the plain-text chat stream vs
+# SSE and NDJSON event streams with coalesced deltas. Every body chunk the app
+# yields is one send() on the connection; they are counted from /stats. CPU
+# is read from /proc for the API process, so this runs on Linux only.
+#
+#   python -m benchmarks.bench_streaming --replies 200 --concurrency 20 --tokens 300
+import argparse
+import asyncio
+import glob
+import os
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import backend, percentile
+
+def server_pid() -> int:
+    # The uvicorn child serving main:app
+    for stat in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat) as f:
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            with open(stat.replace("stat", "cmdline"), "rb") as f:
+                cmdline = f.read()
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid == os.getpid() and b"main:app" in cmdline:
+            return int(stat.split("/")[2])
+    raise RuntimeError("API server process not found")
+
+def counters(url: str, pid: int):
+    # (body chunks written, CPU seconds) of the API process so far
+    streams = httpx.get(f"{url}/stats").json()["streams"]
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    # Plain-text replies write one chunk per provider delta
+    writes = streams["completed_tokens_streamed"] - streams["event_deltas"] + streams["event_writes"]
+    return writes, (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+async def one_reply(client: httpx.AsyncClient, url: str, format: str):
+    payload = {"session_id": f"{uuid.uuid4().hex}_bench", "messages": "สวัสดีค่ะ", "temperature": 0.9, "model_id": "llama3-8b-8192"}
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", f"{url}/chat/default", params={"format": format}, json=payload) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_raw():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - start
+    return ttft, time.perf_counter() - start
+
+async def run(url: str, format: str, replies: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(client):
+        async with semaphore:
+            return await one_reply(client, url, format)
+
+    async with httpx.AsyncClient(timeout=120, limits=httpx.Limits(max_connections=concurrency + 10)) as client:
+        return await asyncio.gather(*(bounded(client) for _ in range(replies)))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replies", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--tokens", default="300")
+    parser.add_argument("--token-delay-ms", default="5")
+    parser.add_argument("--flush-ms", default="20")
+    parser.add_argument("--flush-bytes", default="256")
+    args = parser.parse_args()
+
+    provider_env = {"MOCK_TTFT_MS": "100", "MOCK_TOKEN_DELAY_MS": args.token_delay_ms, "MOCK_TOKENS": args.tokens}
+    app_env = {"STREAM_FLUSH_MS": args.flush_ms, "STREAM_FLUSH_BYTES": args.flush_bytes, "METRICS_LOG_REQUESTS": "0"}
+    print(f"{args.replies} replies of {args.tokens} tokens at concurrency {args.concurrency}, "
+          f"events flushed every {args.flush_ms} ms or {args.flush_bytes} bytes")
+    print(f"{'format':<8} {'writes/reply':>13} {'cpu ms/reply':>13} {'ttft p50':>9} {'total p50':>10} {'total p99':>10}")
+    with backend(provider_env, app_env) as (url, _):
+        pid = server_pid()
+        asyncio.run(run(url, "text", 10, 10))  # warm-up
+        for format in ("text", "sse", "ndjson"):
+            writes, cpu = counters(url, pid)
+            results = asyncio.run(run(url, format, args.replies, args.concurrency))
+            writes_after, cpu_after = counters(url, pid)
+            ttfts = [ttft * 1000 for ttft, _ in results]
+            totals = [total * 1000 for _, total in results]
+            print(f"{format:<8} {(writes_after - writes) / args.replies:>13.1f} {(cpu_after - cpu) / args.replies * 1000:>13.2f}"
+                  f" {percentile(ttfts, 50):>9.0f} {percentile(totals, 50):>10.0f} {percentile(totals, 99):>10.0f}")
+
+if __name__ == "__main__":
+    main()
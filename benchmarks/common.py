@@ -0,0 +1,65 @@
+import contextlib
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port: int, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as s:
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return
+        time.sleep(0.05)
+    raise TimeoutError(f"nothing listening on port {port} after {timeout}s")
+
+@contextlib.contextmanager
+def serve(app: str, port: int = None, env: dict = None, cwd: str = None):
+    # Run an ASGI app ("module:attr") under uvicorn in a child process
+    port = port or free_port()
+    child_env = dict(os.environ)
+    child_env["PYTHONPATH"] = REPO_ROOT + os.pathsep + child_env.get("PYTHONPATH", "")
+    child_env.update(env or {})
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app, "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=cwd or REPO_ROOT,
+        env=child_env,
+    )
+    try:
+        wait_for_port(port)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+
+@contextlib.contextmanager
+def backend(provider_env: dict = None, app_env: dict = None):
+    # Mock provider plus the chat API pointed at it, with a throwaway SQLite file
+    with tempfile.TemporaryDirectory() as workdir:
+        with serve("benchmarks.mock_provider:app", env=provider_env) as provider_url:
+            env = {
+                "GROQ_BASE_URL": f"{provider_url}/v1",
+                "TYPHOON_BASE_URL": f"{provider_url}/v1",
+                "GROQ_API_KEY": "mock",
+                "TYPHOON_API_KEY": "mock",
+            }
+            env.update(app_env or {})
+            with serve("main:app", env=env, cwd=workdir) as app_url:
+                yield app_url, provider_url
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    k = max(0, math.ceil(q / 100 * len(ordered)) - 1)
+    return ordered[k]
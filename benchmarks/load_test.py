@@ -0,0 +1,150 @@
+# End-to-end load test of the chat API against the local mock provider.
+#
+# Each virtual user owns one session and sends --turns sequential requests to
+# one route; users run concurrently at each --concurrency level. Results go to
+# --output as JSON, and --compare fails the run when p99 latency or throughput
+# regressed by more than --max-regression percent against an earlier result.
+#
+#   python -m benchmarks.load_test --concurrency 1 10 50 100 --output load_test_results.json
+#   python -m benchmarks.load_test --compare load_test_results.json
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+
+import httpx
+
+from benchmarks.common import backend, percentile
+
+ROUTES = ["default", "rag", "memory", "view_history"]
+
+def chat_payload(session_id: str, turn: int, route: str):
+    payload = {"session_id": session_id, "messages": f"ช่วยดูดวงเรื่องงานให้หน่อย ครั้งที่ {turn}", "model_id": "llama-3.1-8b-instant"}
+    if route == "rag" and turn % 2 == 1:
+        payload["tarot_card"] = ["The Fool", "Death"]
+    if route == "memory":
+        payload["summary_threshold"] = 4
+    return payload
+
+async def timed_stream(client: httpx.AsyncClient, url: str, payload):
+    start = time.perf_counter()
+    ttft = None
+    async with client.stream("POST", url, json=payload) as response:
+        async for chunk in response.aiter_bytes():
+            if chunk and ttft is None:
+                ttft = time.perf_counter() - start
+        ok = response.status_code == 200
+    total = time.perf_counter() - start
+    return ok, ttft if ttft is not None else total, total
+
+async def timed_get(client: httpx.AsyncClient, url: str, params):
+    start = time.perf_counter()
+    response = await client.get(url, params=params)
+    total = time.perf_counter() - start
+    return response.status_code == 200, total, total
+
+async def virtual_user(client: httpx.AsyncClient, base_url: str, route: str, turns: int, samples):
+    session_id = f"{uuid.uuid4()}_{route}"
+    if route == "view_history":
+        await timed_stream(client, f"{base_url}/chat/default", chat_payload(session_id, 0, "default"))
+        for _ in range(turns):
+            samples.append(await timed_get(client, f"{base_url}/view_history", {"session_id": session_id}))
+        return
+    for turn in range(turns):
+        samples.append(await timed_stream(client, f"{base_url}/chat/{route}", chat_payload(session_id, turn, route)))
+
+async def run_level(base_url: str, route: str, concurrency: int, turns: int):
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+        db_before = (await client.get(f"{base_url}/stats")).json()["db"]
+        samples = []
+        start = time.perf_counter()
+        await asyncio.gather(*(virtual_user(client, base_url, route, turns, samples) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(0.2)  # let write-behind and summaries settle before reading DB time
+        db_after = (await client.get(f"{base_url}/stats")).json()["db"]
+
+    ok = [sample for sample in samples if sample[0]]
+    ttfts = [sample[1] * 1000 for sample in ok]
+    totals = [sample[2] * 1000 for sample in ok]
+    requests = len(samples)
+    return {
+        "route": route,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": requests - len(ok),
+        "throughput_rps": requests / elapsed,
+        "ttft_ms": {q: percentile(ttfts, int(q[1:])) for q in ("p50", "p95", "p99")},
+        "total_ms": {q: percentile(totals, int(q[1:])) for q in ("p50", "p95", "p99")},
+        "db_ms_per_request": (db_after["busy_seconds"] - db_before["busy_seconds"]) * 1000 / max(requests, 1),
+        "db_wait_ms_per_request": (db_after["wait_seconds"] - db_before["wait_seconds"]) * 1000 / max(requests, 1),
+    }
+
+def compare(results, baseline_path: str, max_regression: float):
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = {(r["route"], r["concurrency"]): r for r in json.load(f)["results"]}
+    regressions = []
+    for result in results:
+        old = baseline.get((result["route"], result["concurrency"]))
+        if old is None:
+            continue
+        checks = [
+            ("ttft p99", old["ttft_ms"]["p99"], result["ttft_ms"]["p99"], True),
+            ("total p99", old["total_ms"]["p99"], result["total_ms"]["p99"], True),
+            ("throughput", old["throughput_rps"], result["throughput_rps"], False),
+        ]
+        for name, before, after, lower_is_better in checks:
+            change = (after - before) / before * 100 if before else 0.0
+            if (change if lower_is_better else -change) > max_regression:
+                regressions.append(f"{result['route']} x{result['concurrency']} {name}: {before:.1f} -> {after:.1f} ({change:+.0f}%)")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 10, 50, 100])
+    parser.add_argument("--routes", nargs="+", default=ROUTES, choices=ROUTES)
+    parser.add_argument("--turns", type=int, default=3)
+    parser.add_argument("--ttft-ms", default="200")
+    parser.add_argument("--token-delay-ms", default="10")
+    parser.add_argument("--tokens", default="50")
+    parser.add_argument("--error-rate", default="0")
+    parser.add_argument("--output", default="load_test_results.json")
+    parser.add_argument("--compare")
+    parser.add_argument("--max-regression", type=float, default=25.0)
+    args = parser.parse_args()
+
+    provider_env = {
+        "MOCK_TTFT_MS": args.ttft_ms,
+        "MOCK_TOKEN_DELAY_MS": args.token_delay_ms,
+        "MOCK_TOKENS": args.tokens,
+        "MOCK_ERROR_RATE": args.error_rate,
+    }
+    results = []
+    with backend(provider_env) as (url, _):
+        asyncio.run(run_level(url, "default", 1, 1))  # warm-up
+        print(f"{'route':>13} {'users':>6} {'reqs':>5} {'err':>4} {'rps':>7} {'ttft p50':>9} {'ttft p99':>9} "
+              f"{'total p50':>10} {'total p99':>10} {'db ms/req':>10}")
+        for route in args.routes:
+            for concurrency in args.concurrency:
+                result = asyncio.run(run_level(url, route, concurrency, args.turns))
+                results.append(result)
+                print(f"{route:>13} {concurrency:>6} {result['requests']:>5} {result['errors']:>4} {result['throughput_rps']:>7.1f} "
+                      f"{result['ttft_ms']['p50']:>9.1f} {result['ttft_ms']['p99']:>9.1f} "
+                      f"{result['total_ms']['p50']:>10.1f} {result['total_ms']['p99']:>10.1f} {result['db_ms_per_request']:>10.2f}")
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "compare")}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump({"config": config, "results": results}, f, indent=2)
+    print(f"results written to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
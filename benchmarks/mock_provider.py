@@ -0,0 +1,147 @@
+# OpenAI-compatible chat completions server for local benchmarks and load tests.
+#
+# The module-level app is configured from the environment:
+#
+#   MOCK_TTFT_MS             delay before the first streamed token (default 200)
+#   MOCK_TOKEN_DELAY_MS      delay between streamed tokens (default 10)
+#   MOCK_TOKENS              number of tokens per reply (default 50)
+#   MOCK_ERROR_RATE          fraction of requests failing with a 500 (default 0)
+#   MOCK_RATE_LIMIT_RATE     fraction of requests rejected with a 429 (default 0)
+#   MOCK_SLOW_RATE           fraction of requests whose first token is late (default 0)
+#   MOCK_SLOW_MS             extra delay before those first tokens (default 2000)
+#   MOCK_SEED                seed for the error and slow draws (default 0)
+#   MOCK_MAX_CONCURRENCY     open streams allowed before answering 429 (default 0, no limit)
+#   MOCK_RPM                 requests allowed per rolling minute before answering 429 (default 0, no limit)
+#
+# GET /stats reports requests served, quota rejections and peak concurrency.
+#
+# create_app() builds more instances with other profiles, e.g. two providers
+# with different latencies in one process.
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from collections import deque
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+def completion_chunk(completion_id: str, model: str, content=None, finish_reason=None) -> str:
+    delta = {} if content is None else {"content": content}
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+
+def reply_tokens(tokens: int):
+    return [f"ค่ะ{i} " for i in range(tokens)]
+
+def create_app(
+    ttft_ms: float = 200,
+    token_delay_ms: float = 10,
+    tokens: int = 50,
+    error_rate: float = 0.0,
+    rate_limit_rate: float = 0.0,
+    slow_rate: float = 0.0,
+    slow_ms: float = 2000,
+    seed: int = 0,
+    max_concurrency: int = 0,
+    rpm: int = 0,
+) -> FastAPI:
+    app = FastAPI()
+    rng = random.Random(seed)
+    app.state.requests = 0
+    app.state.quota_rejected = 0
+    app.state.open_streams = 0
+    app.state.peak_streams = 0
+    accepted = deque()  # monotonic times of requests in the last minute
+
+    def over_quota():
+        # Seconds until the request would fit the provider's quota, 0 if it does now
+        now = time.monotonic()
+        while accepted and accepted[0] < now - 60:
+            accepted.popleft()
+        if max_concurrency and app.state.open_streams >= max_concurrency:
+            return 1
+        if rpm and len(accepted) >= rpm:
+            return accepted[0] + 60 - now
+        accepted.append(now)
+        return 0
+
+    async def stream_tokens(completion_id: str, model: str, delay_ms: float):
+        app.state.open_streams += 1
+        app.state.peak_streams = max(app.state.peak_streams, app.state.open_streams)
+        try:
+            await asyncio.sleep(delay_ms / 1000)
+            for i, token in enumerate(reply_tokens(tokens)):
+                if i:
+                    await asyncio.sleep(token_delay_ms / 1000)
+                yield completion_chunk(completion_id, model, token)
+            yield completion_chunk(completion_id, model, finish_reason="stop")
+            yield "data: [DONE]\n\n"
+        finally:
+            app.state.open_streams -= 1
+
+    @app.get("/stats")
+    async def stats():
+        return {"requests": app.state.requests, "quota_rejected": app.state.quota_rejected, "peak_streams": app.state.peak_streams}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        app.state.requests += 1
+        body = await request.json()
+        model = body.get("model", "mock")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+
+        wait = over_quota()
+        if wait:
+            app.state.quota_rejected += 1
+            return JSONResponse(
+                {"error": {"message": "Quota exceeded", "type": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": str(max(1, round(wait)))},
+            )
+        draw = rng.random()
+        if draw < rate_limit_rate:
+            return JSONResponse(
+                {"error": {"message": "Rate limit reached", "type": "rate_limit_exceeded"}},
+                status_code=429,
+                headers={"retry-after": "1"},
+            )
+        if draw < rate_limit_rate + error_rate:
+            return JSONResponse({"error": {"message": "Mock provider error", "type": "server_error"}}, status_code=500)
+        delay_ms = ttft_ms + (slow_ms if slow_rate and rng.random() < slow_rate else 0)
+
+        if body.get("stream"):
+            return StreamingResponse(stream_tokens(completion_id, model, delay_ms), media_type="text/event-stream")
+
+        await asyncio.sleep((delay_ms + token_delay_ms * tokens) / 1000)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(reply_tokens(tokens))}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens},
+        }
+
+    return app
+
+app = create_app(
+    ttft_ms=float(os.getenv("MOCK_TTFT_MS", "200")),
+    token_delay_ms=float(os.getenv("MOCK_TOKEN_DELAY_MS", "10")),
+    tokens=int(os.getenv("MOCK_TOKENS", "50")),
+    error_rate=float(os.getenv("MOCK_ERROR_RATE", "0")),
+    rate_limit_rate=float(os.getenv("MOCK_RATE_LIMIT_RATE", "0")),
+    slow_rate=float(os.getenv("MOCK_SLOW_RATE", "0")),
+    slow_ms=float(os.getenv("MOCK_SLOW_MS", "2000")),
+    seed=int(os.getenv("MOCK_SEED", "0")),
+    max_concurrency=int(os.getenv("MOCK_MAX_CONCURRENCY", "0")),
+    rpm=int(os.getenv("MOCK_RPM", "0")),
+)
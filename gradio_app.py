@@ -1,9 +1,9 @@
 import gradio as gr
-import requests
+import httpx
+import asyncio
 import json
+import time
 import uuid
-import concurrent.futures
-from requests.exceptions import ChunkedEncodingError
 from src.tarot import card_names
 import os
 from dotenv import load_dotenv
@@ -15,75 +15,106 @@ default_endpoint = f"{host}/chat/default"
 rag_endpoint = f"{host}/chat/rag"
 history_endpoint = f"{host}/view_history"
 
-def compare_chatbots(session_id, messages, model_id, temperature, seer_name, seer_personality, tarot_card):
-    # Convert messages list to a single string    
-    # Prepare the payloads
-    print("tarot_card", tarot_card)
-    payload_default = json.dumps({
-        "session_id": session_id + "_default",
-        "messages": messages,
-        "model_id": model_id,
-        "temperature": temperature,
-        "tarot_card": tarot_card,
-        "seer_name": seer_name,
-        "seer_personality": seer_personality,
-    })
-    payload_rag = json.dumps({
-        "session_id": session_id + "_rag",
+# One pooled client for every message, so both panes reuse open connections
+client = httpx.AsyncClient(timeout=httpx.Timeout(10, read=120), limits=httpx.Limits(max_connections=20, max_keepalive_connections=10))
+
+class Pane:
+    # One chatbot's reply as it streams in, with client-side timings
+
+    def __init__(self):
+        self.text = ""
+        self.started = time.perf_counter()
+        self.ttft = None
+        self.total = None
+        self.headers = {}
+        self.error = None
+
+    def timings(self):
+        if self.error is not None:
+            return f"**Error:** {self.error}"
+        parts = []
+        if self.ttft is not None:
+            parts.append(f"TTFT {self.ttft * 1000:.0f} ms")
+        parts.append(f"total {self.total:.2f} s" if self.total is not None else "streaming…")
+        if "x-model-id" in self.headers:
+            parts.append(self.headers["x-model-id"])
+        if self.headers.get("x-cache") in ("hit", "semantic"):
+            parts.append(f"cache {self.headers['x-cache']}")
+        return " · ".join(parts)
+
+async def stream_reply(url, payload, pane, changed):
+    # Read the NDJSON event stream into the pane, signalling each update
+    try:
+        async with client.stream("POST", url, params={"format": "ndjson"}, json=payload) as response:
+            pane.headers = response.headers
+            if response.status_code != 200:
+                await response.aread()
+                pane.error = f"{response.status_code} - {response.text}"
+                return
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event["type"] == "delta":
+                    if pane.ttft is None:
+                        pane.ttft = time.perf_counter() - pane.started
+                    pane.text += event["text"]
+                elif event["type"] == "error":
+                    pane.error = event["message"]
+                changed.set()
+    except httpx.HTTPError as e:
+        pane.error = f"Response ended prematurely ({e!r})"
+    finally:
+        pane.total = time.perf_counter() - pane.started
+        changed.set()
+
+async def compare_chatbots(session_id, messages, model_id, temperature, seer_name, seer_personality, tarot_card):
+    # Stream both endpoints at once, yielding both panes whenever either changes
+    payload = {
         "messages": messages,
         "model_id": model_id,
         "temperature": temperature,
         "tarot_card": tarot_card,
         "seer_name": seer_name,
         "seer_personality": seer_personality,
-    })
-    headers = {
-        'Content-Type': 'application/json'
     }
-
-    def call_endpoint(url, payload):
-        try:
-            response = requests.request("POST", url, headers=headers, data=payload)
-            if response.status_code == 200:
-                try:
-                    return response.text
-                except requests.exceptions.JSONDecodeError:
-                    return "Error: Response is not valid JSON"
-            else:
-                return f"Error: {response.status_code} - {response.text}"
-        except ChunkedEncodingError:
-            return "Error: Response ended prematurely"
-
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        future_default = executor.submit(call_endpoint, default_endpoint, payload_default)
-        future_rag = executor.submit(call_endpoint, rag_endpoint, payload_rag)
-        
-        response_default_text = future_default.result()
-        response_rag_text = future_rag.result()
-
-    return response_default_text, response_rag_text
+    pane_default, pane_rag = Pane(), Pane()
+    changed = asyncio.Event()
+    tasks = [
+        asyncio.create_task(stream_reply(default_endpoint, {**payload, "session_id": session_id + "_default"}, pane_default, changed)),
+        asyncio.create_task(stream_reply(rag_endpoint, {**payload, "session_id": session_id + "_rag"}, pane_rag, changed)),
+    ]
+    try:
+        while not all(task.done() for task in tasks):
+            await changed.wait()
+            changed.clear()
+            yield pane_default, pane_rag
+        yield pane_default, pane_rag
+    finally:
+        # The user left or pressed stop: close both streams
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 # Function to handle chat interaction
-def chat_interaction(session_id, message, model_id, temperature, seer_name, seer_personality, chat_history_default, chat_history_rag, tarot_card):
-    response_default, response_rag = compare_chatbots(session_id, message, model_id, temperature, seer_name, seer_personality, tarot_card)
-    
-    chat_history_default.append((message, response_default))
-    chat_history_rag.append((message, response_rag))
-    
-    message = ""
-    tarot_card = []
-    return message, chat_history_default, chat_history_rag, tarot_card
+async def chat_interaction(session_id, message, model_id, temperature, seer_name, seer_personality, chat_history_default, chat_history_rag, tarot_card):
+    chat_history_default = chat_history_default + [(message, "")]
+    chat_history_rag = chat_history_rag + [(message, "")]
+    async for pane_default, pane_rag in compare_chatbots(session_id, message, model_id, temperature, seer_name, seer_personality, tarot_card):
+        chat_history_default[-1] = (message, pane_default.text)
+        chat_history_rag[-1] = (message, pane_rag.text)
+        yield "", chat_history_default, chat_history_rag, [], pane_default.timings(), pane_rag.timings()
 
 # Function to reload session ID and clear chat history
 def reload_session_and_clear_chat():
     new_session_id = str(uuid.uuid4())
     new_session_id_rag = f"{new_session_id}_rag"
-    return new_session_id, new_session_id_rag, [], []
+    return new_session_id, new_session_id_rag, [], [], "", ""
 
 # Function to load chat history
-def load_chat_history(session_id):
+async def load_chat_history(session_id):
     try:
-        response = requests.get(f"{history_endpoint}?session_id={session_id}")
+        response = await client.get(history_endpoint, params={"session_id": session_id})
         if response.status_code == 200:
             return response.json()
         else:
@@ -99,10 +130,12 @@ with gr.Blocks() as demo:
         with gr.Column():
             gr.Markdown("## Default Chatbot")
             chatbot_default = gr.Chatbot(elem_id="chatbot_default")
+            timings_default = gr.Markdown()
         
         with gr.Column():
             gr.Markdown("## Rag Chatbot")
             chatbot_rag = gr.Chatbot(elem_id="chatbot_rag")
+            timings_rag = gr.Markdown()
     
     with gr.Row():
         message = gr.Textbox(label="Message", show_label=False, scale=3)
@@ -132,26 +165,15 @@ with gr.Blocks() as demo:
         load_history_button = gr.Button("Load Chat History", scale=1, variant="secondary")  # New button
         chat_history_json = gr.JSON(label="Chat History")  # New JSON field
     
-    submit_button.click(
-        lambda session_id, message, model_id, temperature, seer_name, seer_personality, chatbot_default, chatbot_rag, tarot_card: chat_interaction(
-            session_id, message, model_id, temperature, seer_name, seer_personality, chatbot_default, chatbot_rag, tarot_card
-        ),
-        inputs=[session_id, message, model_id, temperature, seer_name, seer_personality, chatbot_default, chatbot_rag, tarot_card],
-        outputs=[message, chatbot_default, chatbot_rag, tarot_card]
-    )
-
-    message.submit(
-        lambda session_id, message, model_id, temperature, seer_name, seer_personality, chatbot_default, chatbot_rag, tarot_card: chat_interaction(
-            session_id, message, model_id, temperature, seer_name, seer_personality, chatbot_default, chatbot_rag, tarot_card
-        ),
-        inputs=[session_id, message, model_id, temperature, seer_name, seer_personality, chatbot_default, chatbot_rag, tarot_card],
-        outputs=[message, chatbot_default, chatbot_rag, tarot_card]
-    )
+    chat_inputs = [session_id, message, model_id, temperature, seer_name, seer_personality, chatbot_default, chatbot_rag, tarot_card]
+    chat_outputs = [message, chatbot_default, chatbot_rag, tarot_card, timings_default, timings_rag]
+    submit_button.click(chat_interaction, inputs=chat_inputs, outputs=chat_outputs)
+    message.submit(chat_interaction, inputs=chat_inputs, outputs=chat_outputs)
 
     reload_button.click(
         reload_session_and_clear_chat,
         inputs=[],
-        outputs=[session_id, session_id_rag, chatbot_default, chatbot_rag]
+        outputs=[session_id, session_id_rag, chatbot_default, chatbot_rag, timings_default, timings_rag]
     )
 
     load_history_button.click(
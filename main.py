@@ -1,6 +1,11 @@
-import os
-import uvicorn
-from src.app import app 
+from dotenv import load_dotenv
+# Settings are read when the src modules are imported
+load_dotenv()
+
+from src.app import create_app
+
+app = create_app()
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    import uvicorn
+    uvicorn.run(app, host="0.0.0.0", port=8080)
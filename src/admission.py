@@ -0,0 +1,301 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlparse
+
+import anyio
+
+from src.providers import provider_for
+
+logger = logging.getLogger(__name__)
+
+# Limits per provider host or model_id: concurrent upstream streams, requests
+# per minute and tokens (prompt + reply) per minute, e.g.
+# {"api.groq.com": {"concurrency": 50, "rpm": 30, "tpm": 6000}, "llama-3.1-70b-versatile": {"concurrency": 8}}
+ADMISSION_LIMITS = json.loads(os.getenv("ADMISSION_LIMITS") or "{}")
+# Concurrent streams per provider host not listed above, 0 for no limit
+ADMISSION_CONCURRENCY = int(os.getenv("ADMISSION_CONCURRENCY", "0"))
+# Requests waiting for one provider's capacity, in total and per session. Past either, or
+# when capacity will not free up within ADMISSION_MAX_WAIT_MS, a request is
+# turned away at once (503, or 429 for a session over its share).
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "256"))
+ADMISSION_SESSION_QUEUE = int(os.getenv("ADMISSION_SESSION_QUEUE", "2"))
+ADMISSION_MAX_WAIT_MS = float(os.getenv("ADMISSION_MAX_WAIT_MS", "5000"))
+# Retry-After when the wait depends on other streams finishing
+ADMISSION_RETRY_AFTER = float(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+# How long a provider is paused after a 429 that carries no Retry-After
+ADMISSION_RATE_LIMIT_SECONDS = float(os.getenv("ADMISSION_RATE_LIMIT_SECONDS", "10"))
+
+class Overloaded(Exception):
+    def __init__(self, message: str, status_code: int = 503, retry_after: float = ADMISSION_RETRY_AFTER):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+def retry_after(error) -> float:
+    # Seconds a provider asked us to wait, from a 429's Retry-After header
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else ADMISSION_RATE_LIMIT_SECONDS
+    except ValueError:
+        return ADMISSION_RATE_LIMIT_SECONDS
+
+class TokenBucket:
+    # Refills continuously at per_minute / 60 a second up to per_minute. Token
+    # use is only known once a reply ends, so the level can go negative; new
+    # requests wait until it is back above zero.
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now: float, need: float) -> float:
+        self.refill(now)
+        return max(0.0, (need - self.level) / self.rate)
+
+    def take(self, amount: float, now: float):
+        self.refill(now)
+        self.level -= amount
+
+    def give(self, amount: float, now: float):
+        self.refill(now)
+        self.level = min(self.capacity, self.level + amount)
+
+class Limit:
+    # Concurrency and request/token buckets of one provider or model
+
+    def __init__(self, key: str, concurrency: int = 0, rpm: float = 0, tpm: float = 0):
+        self.key = key
+        self.concurrency = concurrency
+        self.in_flight = 0
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        # Requests waiting for this provider, session_id -> deque of waiters
+        self.queues = OrderedDict()
+        self.queued = 0
+
+    def wait(self, now: float) -> float:
+        # 0 when a request can start now, the seconds until one can, or inf
+        # when that depends on a running stream finishing
+        waits = [self.paused_until - now, 0.0]
+        if self.requests is not None:
+            waits.append(self.requests.wait(now, 1))
+        if self.tokens is not None:
+            waits.append(self.tokens.wait(now, 0))
+        if self.concurrency and self.in_flight >= self.concurrency:
+            waits.append(math.inf)
+        return max(waits)
+
+class Waiter:
+    def __init__(self, session_id: str, limits):
+        self.session_id = session_id
+        self.limits = limits
+        self.queued_at = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+class Ticket:
+    # One admitted request. Hold it until its upstream stream ends.
+
+    def __init__(self, admission, limits):
+        self.admission = admission
+        self.limits = limits
+        self.released = False
+
+    def charge(self, tokens: int):
+        now = time.monotonic()
+        for limit in self.limits:
+            if limit.tokens is not None:
+                limit.tokens.take(tokens, now)
+
+    def release(self, tokens: int = 0, refund: bool = False):
+        # refund gives the request back to the rpm bucket, for turns that
+        # never reached the provider (cache hits, shared streams)
+        if self.released:
+            return
+        self.released = True
+        now = time.monotonic()
+        for limit in self.limits:
+            limit.in_flight -= 1
+            if refund and limit.requests is not None:
+                limit.requests.give(1, now)
+            if limit.tokens is not None and tokens:
+                limit.tokens.take(tokens, now)
+        self.admission.in_flight -= 1
+        self.admission.dispatch()
+
+class Admission:
+    # Admits chat turns to the providers within ADMISSION_LIMITS. Waiting
+    # requests queue per provider and per session, and each provider serves
+    # its sessions round-robin, so a session sending many requests cannot
+    # starve the others and a full provider does not hold up the rest.
+
+    def __init__(self, limits=None, default_concurrency: int = ADMISSION_CONCURRENCY, queue_size: int = ADMISSION_QUEUE_SIZE,
+                 session_queue: int = ADMISSION_SESSION_QUEUE, max_wait_ms: float = ADMISSION_MAX_WAIT_MS):
+        self.config = ADMISSION_LIMITS if limits is None else limits
+        self.default_concurrency = default_concurrency
+        self.queue_size = queue_size
+        self.session_queue = session_queue
+        self.max_wait = max_wait_ms / 1000
+        self.limits = {}
+        self.wakeup = None
+        self.in_flight = 0
+        self.admitted = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.rejected_queue_full = 0
+        self.rejected_session = 0
+        self.rejected_deadline = 0
+        self.throttled = 0
+
+    def limit(self, key: str, default_concurrency: int = 0) -> Limit:
+        limit = self.limits.get(key)
+        if limit is None:
+            config = self.config.get(key, {})
+            limit = self.limits[key] = Limit(key, config.get("concurrency", default_concurrency), config.get("rpm", 0), config.get("tpm", 0))
+        return limit
+
+    def limits_for(self, model_id: str):
+        # Always the provider, so a 429 can pause it; the model too when it has its own limits
+        limits = [self.limit(urlparse(provider_for(model_id)[0]).netloc, self.default_concurrency)]
+        if model_id in self.config:
+            limits.append(self.limit(model_id))
+        return limits
+
+    async def admit(self, model_id: str, session_id: str) -> Ticket:
+        limits = self.limits_for(model_id)
+        provider = limits[0]
+        now = time.monotonic()
+        wait = max(limit.wait(now) for limit in limits)
+        if wait == 0 and not provider.queued:
+            # Only waiters for the same provider go first
+            return self.grant(limits)
+
+        if provider.queued >= self.queue_size:
+            self.rejected_queue_full += 1
+            raise Overloaded("Too many requests waiting, try again shortly", retry_after=self.retry_after(wait))
+        if wait > self.max_wait and wait != math.inf:
+            # Rate limited for longer than anyone would wait
+            self.rejected_deadline += 1
+            raise Overloaded("Provider capacity exhausted, try again shortly", retry_after=wait)
+        queue = provider.queues.get(session_id)
+        if queue is not None and len(queue) >= self.session_queue:
+            self.rejected_session += 1
+            raise Overloaded("Too many requests for this session", status_code=429, retry_after=self.retry_after(wait))
+
+        waiter = Waiter(session_id, limits)
+        provider.queues.setdefault(session_id, deque()).append(waiter)
+        provider.queued += 1
+        self.waited += 1
+        self.dispatch()
+        try:
+            # anyio's scope rather than asyncio.timeout, which needs Python 3.11
+            with anyio.fail_after(self.max_wait):
+                return await waiter.future
+        except BaseException as e:
+            self.remove(waiter)
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Granted just as the caller gave up, give the capacity back
+                waiter.future.result().release(refund=True)
+            if isinstance(e, TimeoutError):
+                self.rejected_deadline += 1
+                raise Overloaded("Timed out waiting for provider capacity", retry_after=self.retry_after(wait)) from None
+            raise
+
+    def grant(self, limits) -> Ticket:
+        now = time.monotonic()
+        for limit in limits:
+            limit.in_flight += 1
+            if limit.requests is not None:
+                limit.requests.take(1, now)
+        self.in_flight += 1
+        self.admitted += 1
+        return Ticket(self, limits)
+
+    def remove(self, waiter: Waiter) -> bool:
+        # True if the waiter was still queued
+        provider = waiter.limits[0]
+        queue = provider.queues.get(waiter.session_id)
+        if queue is None or waiter not in queue:
+            return False
+        queue.remove(waiter)
+        if not queue:
+            del provider.queues[waiter.session_id]
+        provider.queued -= 1
+        return True
+
+    def dispatch(self):
+        # Admit the head of each session's queue that fits, round-robin within
+        # each provider, then wake up again when the next rate-limited head can go
+        if self.wakeup is not None:
+            self.wakeup.cancel()
+            self.wakeup = None
+        next_wait = math.inf
+        for provider in self.limits.values():
+            progress = True
+            while progress and provider.queues:
+                progress = False
+                now = time.monotonic()
+                for session_id in list(provider.queues):
+                    queue = provider.queues.get(session_id)
+                    if queue is None:
+                        continue
+                    waiter = queue[0]
+                    if waiter.future.done():
+                        self.remove(waiter)
+                        continue
+                    wait = max(limit.wait(now) for limit in waiter.limits)
+                    if wait > 0:
+                        next_wait = min(next_wait, wait)
+                        continue
+                    self.remove(waiter)
+                    self.wait_seconds += now - waiter.queued_at
+                    waiter.future.set_result(self.grant(waiter.limits))
+                    # Served: the session goes to the back of the line
+                    if session_id in provider.queues:
+                        provider.queues.move_to_end(session_id)
+                    progress = True
+        if next_wait != math.inf:
+            self.wakeup = asyncio.get_running_loop().call_later(next_wait, self.dispatch)
+
+    def throttle(self, model_id: str, seconds: float):
+        # The provider said 429: hold its new requests for Retry-After
+        limit = self.limits_for(model_id)[0]
+        limit.paused_until = max(limit.paused_until, time.monotonic() + seconds)
+        self.throttled += 1
+        logger.warning("provider %s rate limited us, pausing admissions for %.1fs", limit.key, seconds)
+
+    def retry_after(self, wait: float) -> float:
+        return wait if 0 < wait < math.inf else ADMISSION_RETRY_AFTER
+
+    def stats(self):
+        return {
+            "admitted": self.admitted,
+            "in_flight": self.in_flight,
+            "queued": sum(limit.queued for limit in self.limits.values()),
+            "waited": self.waited,
+            "wait_seconds": self.wait_seconds,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_session": self.rejected_session,
+            "rejected_deadline": self.rejected_deadline,
+            "throttled": self.throttled,
+        }
+
+admission = None
+
+def get_admission() -> Admission:
+    global admission
+    if admission is None:
+        admission = Admission()
+    return admission
@@ -1,49 +1,115 @@
-from fastapi import FastAPI, Request, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, FastAPI, Query, Request, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Generator
+from typing import List, Optional
 from sqlalchemy.orm import Session
+from sqlalchemy import and_, select, tuple_
+from sqlalchemy.exc import IntegrityError
+import anyio
+import asyncio
+import base64
+import gc
+import heapq
+import itertools
+import math
+from collections import Counter
 import time
 import os
+from datetime import datetime
 from src.template import *
-from src.models import Session as DBSession, Message, SessionLocal, init_db
-from src.tarot import card_name_to_description
+from src.models import Session as DBSession, Message, EXPORT_BATCH_SIZE, all_shards, bump_session_version, db_stats, dispose_engines, init_db, iterate_db, run_db, session_shard, shard_info, shards
+from src.retrieval import get_index
+from src.prompts import EXPLAIN_CARDS, cards_prompt
+from src.providers import close_providers, init_providers, is_rate_limit, openai_sdk
+from src.context import build_context, select_context
+from src.cache import message_size, session_cache
+from src.persistence import get_writer, start_writer, stop_writer
+from src.streaming import STREAM_FORMATS, ChatStreamingResponse, generate_streaming_response, stream_events, stream_stats
+from src.metrics import RequestTimer, metrics
+from src.routing import get_router
+from src.response_cache import CachedStream, lookup_reply, response_cache
+from src.coalesce import request_key, session_locks, summary_flights, turn_flights, upstream_flights
+from src.admission import Overloaded, get_admission, retry_after
+from src.batch import BATCH_MAX_ITEMS, batch_limiter, parse_batch, parse_server_timing, run_batch
+from src.retention import retention_stats, start_retention, stop_retention
+from src.memory import load_summary, build_memory_history, delete_summary, update_rolling_summary
+from starlette.background import BackgroundTask
+from contextlib import asynccontextmanager
 import json
 
-app = FastAPI()
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # List of allowed origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-)
-
-# Initialize the database
-init_db()
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def generate_streaming_response(response, db_session_id: int, db: Session, request) -> Generator[str, None, None]:
-    partial_message = ""
-    for i, chunk in enumerate(response):
-        message = chunk.choices[0].delta.content
-        if message is not None:
-            partial_message += message
-            yield message
-
-    # Save the complete response to the database
-    db_session = db.query(DBSession).filter(DBSession.id == db_session_id).first()
-    if db_session:
-        db_message = Message(session_id=db_session.id, role="assistant", content=partial_message, model_id=request.model_id)
-        db.add(db_message)
-        db.commit()
+# Do the shared startup work in create_app instead of in each worker, for
+# gunicorn --preload (set by the Procfile)
+APP_PRELOAD = os.getenv("APP_PRELOAD", "0") == "1"
+
+warmed_up = False
+
+def warm_up():
+    # Schema check and retrieval index, once per process
+    global warmed_up
+    if not warmed_up:
+        init_db()
+        get_index()
+        warmed_up = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Connections inherited from a preloading master are not ours to use
+    dispose_engines(close=False)
+    warm_up()
+    # Provider clients, the DB writer and the retention loop live once per worker
+    # (only the worker holding the retention lease runs the job).
+    # The SDK is loaded here, not on import, so CLIs and tools importing this
+    # module skip it and the first request does not pay for it.
+    openai_sdk()
+    init_providers()
+    await start_writer()
+    await start_retention()
+    yield
+    await stop_retention()
+    await stop_writer()
+    await close_providers()
+
+router = APIRouter()
+
+def create_app(preload: bool = APP_PRELOAD) -> FastAPI:
+    app = FastAPI(lifespan=lifespan)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # List of allowed origins
+        allow_credentials=True,
+        allow_methods=["*"],  # Allows all methods
+        allow_headers=["*"],  # Allows all headers
+    )
+    app.include_router(router)
+    if preload:
+        # Runs once in the gunicorn master; workers share the result copy-on-write
+        warm_up()
+        openai_sdk()
+        dispose_engines()
+        # Keep the collector from writing to the shared objects' pages in every worker
+        gc.freeze()
+    return app
+
+# Largest pages /view_history and /list_sessions return when a limit is given
+HISTORY_MAX_PAGE = int(os.getenv("HISTORY_MAX_PAGE", "1000"))
+SESSIONS_MAX_PAGE = int(os.getenv("SESSIONS_MAX_PAGE", "1000"))
+# Rows fetched at a time while loading a session's history for the cache
+HISTORY_LOAD_BATCH = 200
+
+# /stats counters are also exported on /metrics
+metrics.register("session_cache", session_cache.stats)
+metrics.register("streams", stream_stats.stats)
+metrics.register("db", db_stats.stats)
+metrics.register("routing", lambda: get_router().stats())
+metrics.register("response_cache", response_cache.stats)
+metrics.register("coalesced_turns", turn_flights.stats)
+metrics.register("coalesced_upstream", upstream_flights.stats)
+metrics.register("coalesced_summaries", summary_flights.stats)
+metrics.register("session_locks", session_locks.stats)
+metrics.register("retention", retention_stats.stats)
+metrics.register("batch", batch_limiter.stats)
+metrics.register("admission", lambda: get_admission().stats())
 
 def get_or_create_session(request, db: Session):
     # Retrieve or create session
@@ -51,185 +117,594 @@ def get_or_create_session(request, db: Session):
     if not db_session:
         db_session = DBSession(session_id=request.session_id)
         db.add(db_session)
-        db.commit()
+        try:
+            db.commit()
+        except IntegrityError:
+            # A concurrent request created the same session first
+            db.rollback()
+            return db.query(DBSession).filter(DBSession.session_id == request.session_id).one()
         db.refresh(db_session)
     return db_session
 
-def save_user_message(db_session, request, db: Session, use_rag=False):
-    # Save request message to the database
+def save_user_message(db_session_id: int, request, db: Session, use_rag=False, history=None):
+    # Save request message to the database, returns the session's new version,
+    # the id of the reply row reserved after it and the saved rows
+    messages = []
 
     if len(request.tarot_card) > 0:
-        tarot_card_str = ", ".join(request.tarot_card)
-
         if use_rag:
-            card_prompts = ""
-            for card in request.tarot_card:
-                description = card_name_to_description[card]
-                card_prompts += f"{card}: {description}"
-
-            prompt = f"ฉันเห็นว่าคุณเลือกไพ่นะคะ ไพ่ที่คุณเลือก {tarot_card_str} \n\n โดยไพ่แต่ละใบมีความหมายดังนี้ \n\n {card_prompts}"
-
+            # Retrieve the drawn cards plus passages related to the user's problem
+            problem = get_problem_statement(db_session_id, request, db, history=history)
+            card_passages, related_passages = get_index().retrieve(problem, request.tarot_card)
+            prompt = cards_prompt(request.tarot_card, card_passages, related_passages)
         else:
-            prompt = f"ฉันเห็นว่าคุณเลือกไพ่ ไพ่ที่คุณเลือก {tarot_card_str} นะคะ"
+            prompt = cards_prompt(request.tarot_card)
 
-        db_message = Message(session_id=db_session.id, role="assistant", content=prompt, model_id=request.model_id)
-        db.add(db_message)
-        db_message = Message(session_id=db_session.id, role="user", content=f"เลือกไพ่เรียบร้อยแล้ว อธิบายดวงจากไพ่ให้หน่อย โดยเรื่มพูดจากประโยคหนึ่งสั้นๆที่บอกเกี่ยวกับดวง และ อธิบายเป็นอีกสามประโยค", model_id=request.model_id)
-        db.add(db_message)
-        db.commit()
+        messages.append(Message(session_id=db_session_id, role="assistant", content=prompt, model_id=request.model_id))
+        messages.append(Message(session_id=db_session_id, role="user", content=EXPLAIN_CARDS, model_id=request.model_id))
+    else:
+        messages.append(Message(session_id=db_session_id, role="user", content=request.messages, model_id=request.model_id))
+
+    # The reply's row is reserved in the same transaction, so it follows this
+    # turn in id order whichever worker's writer fills it in. Pending rows are
+    # left out of every read and of message_count until then.
+    reply = Message(session_id=db_session_id, role="assistant", content="", model_id=request.model_id, pending=True)
+    db.add_all(messages + [reply])
+    db.flush()
+    version = bump_session_version(db_session_id, db, len(messages))
+    saved = [{"id": message.id, "role": message.role, "content": message.content} for message in messages]
+    db.commit()
+    return version, reply.id, saved
+
+def get_problem_statement(db_session_id: int, request, db: Session, turns: int = 3, history=None):
+    # The user's latest messages, used as the retrieval query
+    if history is not None:
+        recent = [message["content"] for message in reversed(history) if message["role"] == "user"][:turns]
     else:
-        db_message = Message(session_id=db_session.id, role="user", content=request.messages, model_id=request.model_id)
-        db.add(db_message)
-        db.commit()
-
-def get_chat_history(db_session, request, db: Session):
-    # Retrieve chat history from the database
-    chat_history = db.query(Message).filter(Message.session_id == db_session.id).order_by(Message.id).all()
-    history_openai_format = [{"role": "system", "content": get_default_system_prompt(request.seer_name, request.seer_personality)}]
-    for message in chat_history:
-        history_openai_format.append({"role": message.role, "content": message.content})
-    return history_openai_format
-
-def get_chat_history_by_session_id(session_id: str, db: Session):
-    # Retrieve chat history using only the session_id
+        recent = [content for content, in db.query(Message.content).filter(
+            Message.session_id == db_session_id, Message.role == "user"
+        ).order_by(Message.id.desc()).limit(turns).all()]
+    return " ".join([request.messages] + recent)
+
+def load_session_history(db_session_id: int, db: Session, max_bytes: int = None):
+    # The whole history, or None as soon as it grows past max_bytes
+    query = select(Message.id, Message.role, Message.content).where(
+        Message.session_id == db_session_id, Message.pending.is_(False)
+    ).order_by(Message.id)
+    history, size = [], 0
+    result = db.execute(query.execution_options(yield_per=HISTORY_LOAD_BATCH))
+    try:
+        for message_id, role, content in result:
+            message = {"id": message_id, "role": role, "content": content}
+            size += message_size(message)
+            if max_bytes is not None and size > max_bytes:
+                return None
+            history.append(message)
+    finally:
+        result.close()
+    return history
+
+def save_turn(request, db: Session, timer: RequestTimer, use_rag=False):
+    # Save the user's turn and return the session's full history when it is cacheable.
+    # A cache hit skips the session lookup and the history reload; a session
+    # known to be too large to cache skips the reload too.
+    with timer.stage("session"):
+        cached = session_cache.get(request.session_id)
+        if cached is not None and cached.shard != db.info.get("shard"):
+            # Cached before the session moved to another shard
+            session_cache.invalidate(request.session_id)
+            cached = None
+        if cached is not None:
+            db_session_id = cached.db_session_id
+        else:
+            db_session_id = get_or_create_session(request, db).id
+
+    with timer.stage("save"):
+        version, reply_id, saved = save_user_message(db_session_id, request, db, use_rag=use_rag, history=cached.messages if cached else None)
+    with timer.stage("history"):
+        history = session_cache.append(request.session_id, version, saved)
+        if history is None and not session_cache.is_oversized(request.session_id):
+            history = load_session_history(db_session_id, db, session_cache.max_entry_bytes)
+            if history is None:
+                session_cache.mark_oversized(request.session_id)
+            elif not session_cache.put(request.session_id, db_session_id, version, history, shard=db.info.get("shard")):
+                history = None
+    return db_session_id, reply_id, history
+
+def prepare_chat(request, use_rag, timer: RequestTimer, db: Session):
+    # Everything a turn needs from the DB, done in a single worker-thread hop
+    db_session_id, reply_id, history = save_turn(request, db, timer, use_rag=use_rag)
+    with timer.stage("context"):
+        system_messages = [{"role": "system", "content": get_default_system_prompt(request.seer_name, request.seer_personality)}]
+        if history is not None:
+            history_openai_format, context_stats = select_context(system_messages, history, request.model_id)
+        else:
+            # Too large to cache, let the context builder page through the newest rows
+            history_openai_format, context_stats = build_context(system_messages, db_session_id, request.model_id, db)
+    return db_session_id, reply_id, history_openai_format, context_stats
+
+def prepare_memory_chat(request, timer: RequestTimer, db: Session):
+    # Like prepare_chat, but history is the rolling summary plus unsummarized turns
+    db_session_id, reply_id, history = save_turn(request, db, timer)
+    with timer.stage("context"):
+        summary, last_message_id = load_summary(db_session_id, db)
+        system_prompt = get_default_system_prompt(request.seer_name, request.seer_personality)
+        system_messages = build_memory_history(system_prompt, summary, [])
+        if history is not None:
+            history_openai_format, context_stats = select_context(system_messages, history, request.model_id, after_id=last_message_id)
+        else:
+            history_openai_format, context_stats = build_context(system_messages, db_session_id, request.model_id, db, after_id=last_message_id)
+    return db_session_id, reply_id, history_openai_format, context_stats
+
+def history_query(session_id: str, after: int = 0):
+    # One statement for the session lookup and its messages. The outer join
+    # yields a single all-NULL message row for an existing session with no
+    # messages after the cursor, and nothing at all for an unknown session.
+    return select(
+        DBSession.id, Message.id, Message.role, Message.content, Message.model_id, Message.truncated, Message.created_at
+    ).select_from(DBSession).outerjoin(
+        Message, and_(Message.session_id == DBSession.id, Message.id > after, Message.pending.is_(False))
+    ).where(DBSession.session_id == session_id).order_by(Message.id)
+
+def history_item(message_id, role, content, model_id, truncated, created_at=None):
+    item = {"id": message_id, "role": role, "content": content, "model_id": model_id, "truncated": truncated}
+    if created_at is not None:
+        item["created_at"] = created_at.isoformat()
+    return item
+
+def get_chat_history_by_session_id(session_id: str, after: int, limit: Optional[int], db: Session):
+    # A page of messages with id > after, oldest first; all of them when limit is None
+    query = history_query(session_id, after)
+    if limit is not None:
+        query = query.limit(limit)
+    rows = db.execute(query).all()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Session not found")
+    history = [history_item(*row[1:]) for row in rows if row[1] is not None]
+    next_after = history[-1]["id"] if limit is not None and len(history) == limit else None
+    return history, next_after
+
+def export_session_history(session_id: str, after: int, db: Session):
+    # Batches of one session's rows, streamed from the cursor by iterate_db
+    result = db.execute(history_query(session_id, after).execution_options(yield_per=EXPORT_BATCH_SIZE))
+    yield from result.partitions()
+
+def export_sessions_history(session_ids, prefix, after: int, db: Session):
+    # Batches of (session_id, message) rows for many sessions in message id
+    # order, so an interrupted export resumes from the last id it received
+    query = select(
+        DBSession.session_id, Message.id, Message.role, Message.content, Message.model_id, Message.truncated, Message.created_at
+    ).join(DBSession, Message.session_id == DBSession.id).where(Message.id > after, Message.pending.is_(False)).order_by(Message.id)
+    if session_ids:
+        query = query.where(DBSession.session_id.in_(session_ids))
+    if prefix:
+        query = query.where(DBSession.session_id.startswith(prefix, autoescape=True))
+    result = db.execute(query.execution_options(yield_per=EXPORT_BATCH_SIZE))
+    yield from result.partitions()
+
+def delete_session_history(session_id: str, db: Session):
+    # Retrieve session
     db_session = db.query(DBSession).filter(DBSession.session_id == session_id).first()
     if not db_session:
         raise HTTPException(status_code=404, detail="Session not found")
 
-    chat_history = db.query(Message).filter(Message.session_id == db_session.id).order_by(Message.id).all()
-    history = [{"role": message.role, "content": message.content, "model_id": message.model_id} for message in chat_history]
-    return history
+    # Delete chat history from the database
+    delete_summary(db_session.id, db)
+    messages = db.query(Message).filter(Message.session_id == db_session.id)
+    # Reserved reply rows go too, but were never counted
+    counted = messages.filter(Message.pending.is_(False)).count()
+    messages.delete()
+    bump_session_version(db_session.id, db, -counted)
+    db.commit()
+    session_cache.invalidate(session_id)
+
+def encode_cursor(*values) -> str:
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
 
-@app.post("/chat/rag")
-async def chat_completions_stream(request: ChatRequest, db: Session = Depends(get_db)):
+def decode_cursor(cursor: str, length: int = None):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or (length is not None and len(values) != length):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def session_id_order(db: Session):
+    # Code point order, the order list_sharded_sessions merges shards in;
+    # PostgreSQL would otherwise sort by the database's locale
+    if db.get_bind().dialect.name == "postgresql":
+        return DBSession.session_id.collate("C")
+    return DBSession.session_id
+
+def list_session_info(prefix, active_after, active_before, sort, position, limit, db: Session):
+    # One indexed query over the maintained per-session counters of a shard.
+    # Sorted by last activity (newest first) or session_id, from a keyset position.
+    query = select(DBSession.id, DBSession.session_id, DBSession.message_count, DBSession.last_activity)
+    if prefix:
+        query = query.where(DBSession.session_id.startswith(prefix, autoescape=True))
+    if active_after is not None:
+        query = query.where(DBSession.last_activity >= active_after)
+    if active_before is not None:
+        query = query.where(DBSession.last_activity < active_before)
+
+    if sort == "last_activity":
+        # The same column the active_after/active_before filters use, so a
+        # session whose history was just deleted still lists as recent
+        if position:
+            query = query.where(tuple_(DBSession.last_activity, DBSession.id) < tuple_(*position, types=[DBSession.last_activity.type, DBSession.id.type]))
+        query = query.order_by(DBSession.last_activity.desc().nulls_last(), DBSession.id.desc())
+    else:
+        session_id = session_id_order(db)
+        if position:
+            query = query.where(session_id > position[0])
+        query = query.order_by(session_id)
+    if limit is not None:
+        query = query.limit(limit)
+    return db.execute(query).all()
+
+def session_info(row):
+    _, session_id, message_count, last_activity = row
+    return {"session_id": session_id, "message_count": message_count, "last_activity": last_activity.isoformat() if last_activity else None}
+
+def activity_cursor(cursor: str):
+    # [shard name, last_activity, id] of the last session listed from each
+    # shard, with nulls once a shard has nothing left. Session ids are per
+    # shard, so each shard keeps its own keyset position.
+    positions = {}
+    for entry in decode_cursor(cursor):
+        if not isinstance(entry, list) or len(entry) != 3 or entry[0] not in shards:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        name, last_activity, pk = entry
+        try:
+            positions[name] = None if pk is None else [datetime.fromisoformat(last_activity), pk]
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    return positions
+
+async def list_sharded_sessions(prefix, active_after, active_before, sort, cursor, limit):
+    # Every shard returns its own first page; the pages are merged by
+    # session_id, or newest last_activity first, and cut at limit. The merge
+    # keys follow list_session_info's ORDER BY, which heapq.merge relies on.
+    if sort == "last_activity":
+        positions = activity_cursor(cursor) if cursor else {}
+        # NULLS LAST in a descending sort
+        sort_key, reverse = (lambda item: item[1][3] or datetime.min), True
+    else:
+        position = decode_cursor(cursor, 1) if cursor else None
+        positions = {shard.name: position for shard in all_shards()}
+        sort_key, reverse = (lambda item: item[1][1]), False
+    # Shards already listed to the end are skipped
+    targets = [shard for shard in all_shards() if positions.get(shard.name, True) is not None or sort != "last_activity"]
+    pages = await asyncio.gather(*(
+        run_db(list_session_info, prefix, active_after, active_before, sort, positions.get(shard.name), limit, shard=shard)
+        for shard in targets
+    ))
+    merged = heapq.merge(*([(shard.name, row) for row in rows] for shard, rows in zip(targets, pages)), key=sort_key, reverse=reverse)
+    page = list(itertools.islice(merged, limit))
+
+    next_cursor = None
+    if limit is not None and len(page) == limit:
+        if sort == "last_activity":
+            consumed = Counter(name for name, _ in page)
+            for shard, rows in zip(targets, pages):
+                if consumed[shard.name] == len(rows) < limit:
+                    positions[shard.name] = None
+            for name, (pk, _, _, last_activity) in page:
+                if positions.get(name, True) is not None:
+                    positions[name] = [last_activity, pk]
+            next_cursor = encode_cursor(*(
+                [name, position[0].isoformat(), position[1]] if position else [name, None, None] for name, position in positions.items()
+            ))
+        else:
+            next_cursor = encode_cursor(page[-1][1][1])
+    return [session_info(row) for _, row in page], next_cursor
+
+async def open_upstream(request, history_openai_format):
+    stream = await get_router().open(request.model_id, history_openai_format, request.temperature)
+    return stream.model_id, stream, stream.close
+
+async def open_stream(request, prepare, timer: RequestTimer, ticket, shard, *args):
+    # Shared pre-stream path of the chat routes, each stage timed on the way.
+    # Returns the cache key the finished reply should be stored under, if any.
+    with timer.stage("writer_wait"):
+        await get_writer().wait(request.session_id)
+    async with session_locks.hold(request.session_id):
+        with timer.stage("db"):
+            db_session_id, reply_id, history_openai_format, context_stats = await run_db(prepare, request, *args, timer, shard=shard)
+    try:
+        response, headers, cache_key = await open_reply(request, history_openai_format, context_stats, timer, ticket)
+    except BaseException:
+        # No stream will fill in the reserved reply row
+        with anyio.CancelScope(shield=True):
+            await get_writer().submit(request.session_id, db_session_id, reply_id, None, shard=shard)
+        raise
+    return db_session_id, reply_id, response, headers, cache_key
+
+async def open_reply(request, history_openai_format, context_stats, timer: RequestTimer, ticket):
+    # The cached reply, or the provider stream through coalescing and the router
+    headers = context_stats.headers()
+    ticket.charge(context_stats.tokens_kept)
+
+    cache_key = None
+    if response_cache.eligible(request):
+        cache_key = response_cache.key(request.model_id, request.temperature, history_openai_format)
+        with timer.stage("cache"):
+            cached, outcome = await lookup_reply(cache_key)
+        if cached is not None:
+            ticket.release(refund=True)
+            response = CachedStream(cached.model_id, cached.parts)
+            return response, {**headers, **timer.headers(), "X-Model-Id": response.model_id, "X-Cache": outcome}, None
+        headers["X-Cache"] = "miss"
+    else:
+        response_cache.bypass()
+        headers["X-Cache"] = "bypass"
+
+    # Until the first token, across fallbacks and hedged requests, see src/routing.py.
+    # Near-deterministic prompts already in flight for another session share that stream.
+    with timer.stage("upstream"):
+        if cache_key is not None:
+            response = await upstream_flights.subscribe(cache_key.exact, lambda: open_upstream(request, history_openai_format))
+            if response.coalesced:
+                # Another session's request is already using the provider for this
+                ticket.release(refund=True)
+        else:
+            response = await get_router().open(request.model_id, history_openai_format, request.temperature)
+    return response, {**headers, **timer.headers(), "X-Model-Id": response.model_id}, cache_key
+
+async def stream_chat(request, http_request: Request, route: str, prepare, *args):
+    # A retried or double-submitted request joins the identical one in flight
+    # and gets the same stream, instead of saving the turn and generating twice
+    async def open_turn():
+        timer = RequestTimer(route, request.model_id, request.session_id, http_request.headers)
+        try:
+            with timer.stage("admission"):
+                ticket = await get_admission().admit(request.model_id, request.session_id)
+        except Overloaded:
+            timer.finish("rejected")
+            raise
+        try:
+            shard = await session_shard(request.session_id)
+            db_session_id, reply_id, response, headers, cache_key = await open_stream(request, prepare, timer, ticket, shard, *args)
+        except BaseException:
+            ticket.release()
+            timer.finish("error")
+            raise
+        body = generate_streaming_response(response, db_session_id, reply_id, request, timer, cache_key, ticket, shard)
+        return ((db_session_id, shard), headers), body, body.aclose
+
+    # Returns where the session lives, (db_session_id, shard), with the reply and its headers
+    reply = await turn_flights.subscribe(request_key(route, request.model_dump()), open_turn)
+    db_session, headers = reply.meta
+    if reply.coalesced:
+        headers = {**headers, "X-Coalesced": "1"}
+    return db_session, reply, headers
+
+def chat_error(e: Exception) -> HTTPException:
+    # Overload and provider rate limits keep their status and tell the client when to retry
+    if isinstance(e, Overloaded):
+        return HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(math.ceil(e.retry_after))})
+    if is_rate_limit(e):
+        return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": str(math.ceil(retry_after(e)))})
+    return HTTPException(status_code=500, detail=str(e))
+
+def stream_format(http_request: Request, format: Optional[str]) -> str:
+    # ?format= wins, then the Accept header; plain text for existing clients
+    if format:
+        return format
+    accept = http_request.headers.get("accept", "")
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    return "text"
+
+def chat_response(reply, headers, format: str, background=None):
+    if format == "text":
+        return ChatStreamingResponse(reply, media_type="text/plain", headers=headers, background=background)
+    # Events end with usage and done, or error, so clients can tell a finished reply from a cut-off one
+    usage = {"model_id": headers.get("X-Model-Id"), "prompt_tokens": int(headers.get("X-Context-Tokens-Kept", 0))}
+    return ChatStreamingResponse(
+        stream_events(reply, format, usage),
+        media_type=STREAM_FORMATS[format][0],
+        headers={**headers, "Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=background,
+    )
+
+FORMAT_QUERY = Query(None, pattern="^(text|sse|ndjson)$")
+
+@router.post("/chat/rag")
+async def chat_rag_stream(request: ChatRequest, http_request: Request, format: Optional[str] = FORMAT_QUERY):
     try:
-        db_session = get_or_create_session(request, db)
-        save_user_message(db_session, request, db, use_rag=True)
-        history_openai_format = get_chat_history(db_session, request, db)
-
-        client = get_client(request.model_id)   
-        response = client.chat.completions.create(
-            model=request.model_id,
-            messages=history_openai_format,
-            temperature=request.temperature,
-            stream=True
-        )
-        return StreamingResponse(generate_streaming_response(response, db_session.id, db, request), media_type="text/plain")
+        _, reply, headers = await stream_chat(request, http_request, "/chat/rag", prepare_chat, True)
+        return chat_response(reply, headers, stream_format(http_request, format))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise chat_error(e)
 
-@app.post("/chat/default")
-async def chat_completions_stream(request: ChatRequest, db: Session = Depends(get_db)):
+@router.post("/chat/default")
+async def chat_completions_stream(request: ChatRequest, http_request: Request, format: Optional[str] = FORMAT_QUERY):
     try:
-        db_session = get_or_create_session(request, db)
-        save_user_message(db_session, request, db)
-        history_openai_format = get_chat_history(db_session, request, db)
-
-        client = get_client(request.model_id)   
-        response = client.chat.completions.create(
-            model=request.model_id,
-            messages=history_openai_format,
-            temperature=request.temperature,
-            stream=True
-        )
-        return StreamingResponse(generate_streaming_response(response, db_session.id, db, request), media_type="text/plain")
+        _, reply, headers = await stream_chat(request, http_request, "/chat/default", prepare_chat, False)
+        return chat_response(reply, headers, stream_format(http_request, format))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        raise chat_error(e)
 
-@app.post("/chat/memory")
-async def chat_completions_with_memory_stream(request: ChatRequestWithMemory, db: Session = Depends(get_db)):
+@router.post("/chat/memory")
+async def chat_completions_with_memory_stream(request: ChatRequestWithMemory, http_request: Request, format: Optional[str] = FORMAT_QUERY):
     try:
-        db_session = get_or_create_session(request, db)
-        save_user_message(db_session, request, db)
-        history_openai_format = get_chat_history(db_session, request, db)
-
-        client = get_client(request.model_id)
-        if len(history_openai_format) > request.summary_threshold:
-            # Prepare the conversation history for summarization
-            system_prompt = [{'role': 'system', 'content': 'Summarize the following conversation into a paragraph that have about 300 words in Thai.'}]
-            history_combine = system_prompt + [{'role': 'user', 'content': str(json.dumps(history_openai_format[1:], ensure_ascii=False))}]
-
-            # Request summary from OpenAI
-            response = client.chat.completions.create(
-                model=request.model_id,
-                messages=history_combine,
-                temperature=request.temperature,
-                stream=False
-            )
-
-            # Generate memory summary
-            summarized_history = response.choices[0].message.content
-
-            # Prepare the new history format
-            history_openai_format_memory = [
-                {"role": "system", "content": get_default_system_prompt(request.seer_name, request.seer_personality)},
-                {"role": "system", "content": f"conversation summary: \n{summarized_history}"},
-            ]
-            history_openai_format_memory.extend(history_openai_format[-2:])
-            # history_openai_format_memory.append({"role": "user", "content": request.messages})    
-
-            # Remove old chat history from the database
-            db.query(Message).filter(Message.session_id == db_session.id).delete()
-            db.commit()
+        (db_session_id, shard), reply, headers = await stream_chat(request, http_request, "/chat/memory", prepare_memory_chat)
 
-            # Save the new history to the database
-            db.add_all([
-                Message(session_id=db_session.id, role=msg["role"], content=msg["content"], model_id=request.model_id)
-                for msg in history_openai_format_memory[1:]
-            ])
-            db.commit()
-
-            # Add the new user message to the history
-            response = client.chat.completions.create(
-                model=request.model_id,
-                messages=history_openai_format_memory,
-                temperature=request.temperature,
-                stream=True
-            )
-        else:
-            response = client.chat.completions.create(
-                model=request.model_id,
-                messages=history_openai_format,
-                temperature=request.temperature,
-                stream=True
-            )
-
-        return StreamingResponse(generate_streaming_response(response, db_session.id, db, request), media_type="text/plain")
+        # Fold older turns into the rolling summary once the reply is out
+        return chat_response(reply, headers, stream_format(http_request, format), background=BackgroundTask(update_rolling_summary, db_session_id, request, shard))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.get("/view_history")
-async def view_chat_history(session_id: str, db: Session = Depends(get_db)):
+        raise chat_error(e)
+
+BATCH_ROUTES = {
+    "default": (ChatRequest, prepare_chat, (False,)),
+    "rag": (ChatRequest, prepare_chat, (True,)),
+    "memory": (ChatRequestWithMemory, prepare_memory_chat, ()),
+}
+
+async def run_batch_item(item, http_request: Request):
+    # One chat turn through the same path as the chat routes, read to the end
+    request_type, prepare, args = BATCH_ROUTES[item.route]
+    result = {"index": item.index, "id": item.id, "route": item.route, "session_id": item.request.session_id}
+    started = time.perf_counter()
+    first_token_at = None
     try:
-        history = get_chat_history_by_session_id(session_id, db)
-        return {"session_id": session_id, "history": history}
+        (db_session_id, shard), reply, headers = await stream_chat(item.request, http_request, f"/chat/{item.route}", prepare, *args)
+        parts = []
+        try:
+            async for part in reply:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                parts.append(part)
+        finally:
+            await reply.aclose()
+        if item.route == "memory":
+            await update_rolling_summary(db_session_id, item.request, shard)
+        result.update(status=200, model_id=headers.get("X-Model-Id"), cache=headers.get("X-Cache"), reply="".join(parts))
+        timings = parse_server_timing(headers.get("Server-Timing"))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
-
-@app.delete("/delete_history")
-async def delete_chat_history(session_id: str, db: Session = Depends(get_db)):
+        error = chat_error(e)
+        result.update(status=error.status_code, error=error.detail)
+        if isinstance(e, Overloaded) or is_rate_limit(e):
+            result["retry_after"] = e.retry_after if isinstance(e, Overloaded) else retry_after(e)
+        timings = {}
+    timings["total_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    if first_token_at is not None:
+        timings["ttft_ms"] = round((first_token_at - started) * 1000, 2)
+    result["timings"] = timings
+    return result
+
+@router.post("/chat/batch")
+async def chat_batch(http_request: Request):
+    # JSONL of chat requests in, NDJSON results out as each item finishes,
+    # then one {"summary": ...} line. See src/batch.py.
+    body = (await http_request.body()).decode("utf-8")
+    items = parse_batch(body.splitlines(), {route: request_type for route, (request_type, _, _) in BATCH_ROUTES.items()})
+    if not items:
+        raise HTTPException(status_code=400, detail="Empty batch")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+
+    async def lines():
+        started = time.perf_counter()
+        statuses = Counter()
+        async for result in run_batch(items, lambda item: run_batch_item(item, http_request)):
+            statuses[result["status"]] += 1
+            yield json.dumps(result, ensure_ascii=False) + "\n"
+        summary = {"items": len(items), "ok": statuses[200], "failed": len(items) - statuses[200],
+                   "statuses": {str(status): count for status, count in sorted(statuses.items())},
+                   "seconds": round(time.perf_counter() - started, 3)}
+        yield json.dumps({"summary": summary}) + "\n"
+
+    return ChatStreamingResponse(lines(), media_type="application/x-ndjson")
+
+@router.get("/view_history")
+async def view_chat_history(
+    session_id: str,
+    after: int = 0,
+    limit: Optional[int] = Query(None, ge=1, le=HISTORY_MAX_PAGE),
+    format: str = Query("json", pattern="^(json|ndjson)$"),
+):
     try:
-        # Retrieve session
-        db_session = db.query(DBSession).filter(DBSession.session_id == session_id).first()
-        if not db_session:
-            raise HTTPException(status_code=404, detail="Session not found")
+        await get_writer().wait(session_id)
+        shard = await session_shard(session_id)
+        if format == "ndjson":
+            return await stream_session_history(session_id, after, shard)
+        history, next_after = await run_db(get_chat_history_by_session_id, session_id, after, limit, shard=shard)
+        return {"session_id": session_id, "history": history, "next_after": next_after}
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # Delete chat history from the database
-        db.query(Message).filter(Message.session_id == db_session.id).delete()
-        db.commit()
+async def stream_session_history(session_id: str, after: int, shard):
+    batches = iterate_db(export_session_history, session_id, after, shard=shard)
+    # The first batch tells an empty session from an unknown one before the response starts
+    first = await anext(batches, None)
+    if not first:
+        await batches.aclose()
+        raise HTTPException(status_code=404, detail="Session not found")
 
+    async def lines():
+        try:
+            yield ndjson_lines(history_item(*row[1:]) for row in first if row[1] is not None)
+            async for batch in batches:
+                yield ndjson_lines(history_item(*row[1:]) for row in batch)
+        finally:
+            await batches.aclose()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+def ndjson_lines(items) -> str:
+    return "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+
+@router.get("/export_history")
+async def export_history(session_id: List[str] = Query([]), prefix: Optional[str] = None, after: int = 0, shard: Optional[str] = None):
+    # NDJSON of every message of the selected sessions (all sessions by default),
+    # one {"session_id", "shard", "id", "role", ...} object per line, shard by
+    # shard in message id order. Message ids are per shard: resume an
+    # interrupted export with ?shard= and after= the last id of that shard.
+    if shard is not None and shard not in shards:
+        raise HTTPException(status_code=404, detail="Shard not found")
+    if session_id:
+        located = {}
+        for sid, target in zip(session_id, await asyncio.gather(*(session_shard(sid) for sid in session_id))):
+            located.setdefault(target.name, []).append(sid)
+        targets = [(shards[name], sids) for name, sids in located.items()]
+    else:
+        targets = [(target, []) for target in all_shards()]
+    targets = [(target, sids) for target, sids in targets if shard is None or target.name == shard]
+
+    async def lines():
+        for target, sids in targets:
+            batches = iterate_db(export_sessions_history, sids, prefix, after, shard=target)
+            try:
+                async for batch in batches:
+                    yield ndjson_lines({"session_id": row[0], "shard": target.name, **history_item(*row[1:])} for row in batch)
+            finally:
+                await batches.aclose()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@router.delete("/delete_history")
+async def delete_chat_history(session_id: str):
+    try:
+        async with session_locks.hold(session_id):
+            await get_writer().wait(session_id)
+            await run_db(delete_session_history, session_id, shard=await session_shard(session_id))
         return {"message": "Chat history deleted successfully"}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@app.get("/list_sessions")
-async def list_sessions(db: Session = Depends(get_db)):
+@router.get("/stats")
+async def stats():
+    return {"session_cache": session_cache.stats(), "streams": stream_stats.stats(), "db": db_stats.stats(),
+            "routing": {**get_router().stats(), "models": get_router().models()}, "response_cache": response_cache.stats(),
+            "coalescing": {"turns": turn_flights.stats(), "upstream": upstream_flights.stats(), "summaries": summary_flights.stats(), "session_locks": session_locks.stats()},
+            "retention": {**retention_stats.stats(), "last_run": retention_stats.last_run}, "batch": batch_limiter.stats(), "admission": get_admission().stats(), "shards": shard_info()}
+
+@router.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@router.get("/list_sessions")
+async def list_sessions(
+    prefix: Optional[str] = None,
+    active_after: Optional[datetime] = None,
+    active_before: Optional[datetime] = None,
+    sort: str = Query("last_activity", pattern="^(last_activity|session_id)$"),
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=SESSIONS_MAX_PAGE),
+):
     try:
-        sessions = db.query(DBSession).all()
-        session_info = [
-            {"session_id": session.session_id, "message_count": db.query(Message).filter(Message.session_id == session.id).count()}
-            for session in sessions
-        ]
-        return {"sessions": session_info}
+        sessions, next_cursor = await list_sharded_sessions(prefix, active_after, active_before, sort, cursor, limit)
+        return {"sessions": sessions, "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
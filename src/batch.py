@@ -0,0 +1,173 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from src.admission import ADMISSION_RATE_LIMIT_SECONDS
+from src.providers import provider_for
+
+logger = logging.getLogger(__name__)
+
+# Batch items in flight per provider, shared by every running batch so the
+# total stays within the provider's quota. Per-provider overrides by host,
+# e.g. {"api.groq.com": 2}.
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_PROVIDER_CONCURRENCY = json.loads(os.getenv("BATCH_PROVIDER_CONCURRENCY") or "{}")
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "5000"))
+
+ROUTES = ("default", "rag", "memory")
+
+@dataclass
+class BatchItem:
+    index: int
+    id: object  # echoed back so results can be matched to inputs
+    route: str
+    request: object = None
+    error: str = None
+
+def parse_batch(lines, request_types):
+    # One item per non-empty line: a chat request body plus optional "route"
+    # (default, rag or memory) and "id". Lines that do not validate become
+    # items with an error, reported in order with the rest.
+    items = []
+    for index, line in enumerate(line for line in lines if line.strip()):
+        item = BatchItem(index, index, "default")
+        try:
+            body = json.loads(line)
+            if not isinstance(body, dict):
+                raise ValueError("each line must be a JSON object")
+            item.id = body.pop("id", index)
+            item.route = str(body.pop("route", "default")).removeprefix("/chat/")
+            if item.route not in ROUTES:
+                item.error = f"unknown route {item.route!r}, expected one of {', '.join(ROUTES)}"
+            else:
+                item.request = request_types[item.route].model_validate(body)
+        except ValueError as e:
+            # includes pydantic's ValidationError
+            item.error = str(e)
+        items.append(item)
+    return items
+
+class ProviderLimiter:
+    # Bounded concurrency per provider host, paused for everyone while the
+    # provider is rate limiting us
+
+    def __init__(self, concurrency: int = BATCH_CONCURRENCY, overrides=None):
+        self.concurrency = concurrency
+        self.overrides = BATCH_PROVIDER_CONCURRENCY if overrides is None else overrides
+        self.semaphores = {}
+        self.paused_until = {}
+        self.rate_limited_count = 0
+        self.paused_seconds = 0.0
+
+    def provider(self, model_id: str) -> str:
+        return urlparse(provider_for(model_id)[0]).netloc
+
+    @asynccontextmanager
+    async def slot(self, model_id: str):
+        host = self.provider(model_id)
+        semaphore = self.semaphores.get(host)
+        if semaphore is None:
+            semaphore = self.semaphores[host] = asyncio.Semaphore(self.overrides.get(host, self.concurrency))
+        async with semaphore:
+            # Re-check after every sleep, another item may have extended the pause
+            while (wait := self.paused_until.get(host, 0.0) - time.monotonic()) > 0:
+                self.paused_seconds += wait
+                await asyncio.sleep(wait)
+            yield
+
+    def rate_limited(self, model_id: str, seconds: float):
+        host = self.provider(model_id)
+        self.rate_limited_count += 1
+        self.paused_until[host] = max(self.paused_until.get(host, 0.0), time.monotonic() + seconds)
+        logger.warning("provider %s rate limited batch items, pausing %.1fs", host, seconds)
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "rate_limited": self.rate_limited_count,
+            "paused_seconds": self.paused_seconds,
+            "providers_paused": sum(until > now for until in self.paused_until.values()),
+        }
+
+batch_limiter = ProviderLimiter()
+
+async def run_batch(items, run_item, limiter: ProviderLimiter = batch_limiter):
+    # Yields one result per item as it finishes. Items of the same session run
+    # in input order, so scripted conversations build on their earlier turns;
+    # different sessions run concurrently within the provider limits.
+    results = asyncio.Queue()
+    sessions = OrderedDict()
+    for item in items:
+        if item.error is not None:
+            results.put_nowait({"index": item.index, "id": item.id, "route": item.route, "status": 422, "error": item.error})
+        else:
+            sessions.setdefault(item.request.session_id, []).append(item)
+
+    async def run_session(session_items):
+        for item in session_items:
+            queued = time.perf_counter()
+            async with limiter.slot(item.request.model_id):
+                waited = time.perf_counter() - queued
+                result = await run_item(item)
+            result["timings"]["queued_ms"] = round(waited * 1000, 2)
+            if result["status"] in (429, 503):
+                limiter.rate_limited(item.request.model_id, result.pop("retry_after", ADMISSION_RATE_LIMIT_SECONDS))
+            results.put_nowait(result)
+
+    tasks = [asyncio.create_task(run_session(session_items)) for session_items in sessions.values()]
+    try:
+        for _ in range(len(items)):
+            yield await results.get()
+    finally:
+        # The client went away: stop the items that have not finished
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+def parse_server_timing(value: str):
+    timings = {}
+    for entry in filter(None, (part.strip() for part in (value or "").split(","))):
+        name, _, duration = entry.partition(";dur=")
+        if duration:
+            timings[f"{name}_ms"] = float(duration)
+    return timings
+
+if __name__ == "__main__":
+    # Post a JSONL file of chat requests to a running server's /chat/batch and
+    # write the NDJSON results as they arrive:
+    #   python -m src.batch requests.jsonl --url http://127.0.0.1:8000 --output results.ndjson
+    import argparse
+
+    import httpx
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input")
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--output", help="results file, stdout when omitted")
+    args = parser.parse_args()
+
+    with open(args.input, "rb") as f:
+        body = f.read()
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    try:
+        with httpx.stream("POST", f"{args.url.rstrip('/')}/chat/batch", content=body,
+                          headers={"Content-Type": "application/x-ndjson"}, timeout=httpx.Timeout(30, read=None)) as response:
+            response.raise_for_status()
+            for line in response.iter_lines():
+                if line:
+                    output.write(line + "\n")
+                    output.flush()
+                    result = json.loads(line)
+                    if "summary" in result:
+                        print(json.dumps(result["summary"]), file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,169 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+# Bounds for the per-worker session history cache
+SESSION_CACHE_MAX_SESSIONS = int(os.getenv("SESSION_CACHE_MAX_SESSIONS", "10000"))
+SESSION_CACHE_MAX_BYTES = int(os.getenv("SESSION_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_CACHE_MAX_ENTRY_BYTES = int(os.getenv("SESSION_CACHE_MAX_ENTRY_BYTES", str(1024 * 1024)))
+SESSION_CACHE_TTL_SECONDS = float(os.getenv("SESSION_CACHE_TTL_SECONDS", "1800"))
+
+# Rough per-message cost of the dict, keys and id on top of the content string
+MESSAGE_OVERHEAD_BYTES = 250
+
+def message_size(message) -> int:
+    return sys.getsizeof(message["content"]) + MESSAGE_OVERHEAD_BYTES
+
+@dataclass
+class CachedSession:
+    db_session_id: int
+    version: int
+    messages: list  # [{"id", "role", "content"}], oldest first
+    size: int = 0
+    expires_at: float = field(default=0.0)
+    shard: str = None  # db_session_id is only meaningful on this shard
+
+class SessionCache:
+    # LRU + TTL cache of per-session history, keyed by the client session_id.
+    #
+    # Coherence across workers relies on sessions.version, which every write
+    # to a session's messages increments. A writer that bumped the version to
+    # v may only append to an entry still at v - 1; anything else means some
+    # other process wrote in between and the entry is dropped.
+
+    def __init__(
+        self,
+        max_sessions: int = SESSION_CACHE_MAX_SESSIONS,
+        max_bytes: int = SESSION_CACHE_MAX_BYTES,
+        max_entry_bytes: int = SESSION_CACHE_MAX_ENTRY_BYTES,
+        ttl: float = SESSION_CACHE_TTL_SECONDS,
+    ):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        # Sessions whose history is known not to fit, key -> expiry, so their
+        # turns skip the history load and page the database instead
+        self.oversized = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.oversized_skips = 0
+        self.lock = threading.Lock()  # used from DB worker threads and the event loop
+
+    def get(self, key: str):
+        # A snapshot of the entry, safe to read while other requests append
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.expires_at < time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return CachedSession(entry.db_session_id, entry.version, list(entry.messages), entry.size, entry.expires_at, entry.shard)
+
+    def put(self, key: str, db_session_id: int, version: int, messages, shard: str = None) -> bool:
+        size = sum(message_size(message) for message in messages)
+        with self.lock:
+            self._remove(key)
+            if size > self.max_entry_bytes:
+                self._mark_oversized(key)
+                return False
+            self.entries[key] = CachedSession(db_session_id, version, list(messages), size, time.monotonic() + self.ttl, shard)
+            self.bytes += size
+            self._evict()
+            return True
+
+    def append(self, key: str, version: int, messages):
+        # Add rows written under `version`; returns the updated history or None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            if entry.version != version - 1:
+                self.invalidations += 1
+                self._remove(key)
+                return None
+            last_id = entry.messages[-1]["id"] if entry.messages else 0
+            entry.messages.extend(messages)
+            if messages and messages[0]["id"] < last_id:
+                # A reply filled in after the session's next turn was saved
+                entry.messages.sort(key=lambda message: message["id"])
+            added = sum(message_size(message) for message in messages)
+            entry.size += added
+            self.bytes += added
+            entry.version = version
+            entry.expires_at = time.monotonic() + self.ttl
+            if entry.size > self.max_entry_bytes:
+                self._remove(key)
+                self._mark_oversized(key)
+                return None
+            self.entries.move_to_end(key)
+            self._evict()
+            return list(entry.messages)
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self.oversized.pop(key, None)
+            if key in self.entries:
+                self.invalidations += 1
+                self._remove(key)
+
+    def is_oversized(self, key: str) -> bool:
+        with self.lock:
+            expires_at = self.oversized.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < time.monotonic():
+                del self.oversized[key]
+                return False
+            self.oversized_skips += 1
+            return True
+
+    def mark_oversized(self, key: str):
+        with self.lock:
+            self._remove(key)
+            self._mark_oversized(key)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "oversized": len(self.oversized),
+                "oversized_skips": self.oversized_skips,
+            }
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def _mark_oversized(self, key: str):
+        self.oversized[key] = time.monotonic() + self.ttl
+        self.oversized.move_to_end(key)
+        while len(self.oversized) > self.max_sessions:
+            self.oversized.popitem(last=False)
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_sessions or self.bytes > self.max_bytes):
+            _, entry = self.entries.popitem(last=False)
+            self.bytes -= entry.size
+            self.evictions += 1
+
+session_cache = SessionCache()
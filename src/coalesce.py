@@ -0,0 +1,234 @@
+import asyncio
+import hashlib
+import json
+import os
+from contextlib import asynccontextmanager
+
+import anyio
+
+# Chunks a stream's source may read ahead of its slowest subscriber before it
+# waits, so a slow client slows the upstream read instead of piling up
+STREAM_BUFFER_CHUNKS = int(os.getenv("STREAM_BUFFER_CHUNKS", "256"))
+
+def request_key(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str).encode()).hexdigest()
+
+class Flight:
+    # One in-flight source whose items are buffered for every subscriber
+
+    def __init__(self):
+        self.meta = None
+        self.items = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self.readers = set()
+        self.ready = asyncio.Event()
+        self.changed = asyncio.Event()
+        self.progress = None
+        self.task = None
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def advanced(self):
+        # A reader moved on or left; wake the source if it is waiting for that
+        if self.progress is not None:
+            self.progress.set()
+
+    async def drain(self, limit: int):
+        # Wait until every reader is within limit items of the source
+        while self.readers and len(self.items) - min(reader.position for reader in self.readers) >= limit:
+            self.progress = asyncio.Event()
+            await self.progress.wait()
+        self.progress = None
+
+class Subscription:
+    # Iterates a flight from its first item. close() leaves the flight, and
+    # the last subscriber to leave cancels the source.
+
+    def __init__(self, flights, key: str, flight: Flight, coalesced: bool):
+        self.flights = flights
+        self.key = key
+        self.flight = flight
+        self.coalesced = coalesced
+        self.position = 0
+        self.closed = False
+
+    @property
+    def meta(self):
+        return self.flight.meta
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        flight = self.flight
+        while self.position >= len(flight.items):
+            if flight.error is not None:
+                raise flight.error
+            if flight.done:
+                raise StopAsyncIteration
+            await flight.changed.wait()
+        item = flight.items[self.position]
+        self.position += 1
+        flight.advanced()
+        return item
+
+    async def close(self):
+        if not self.closed:
+            self.closed = True
+            self.flight.readers.discard(self)
+            self.flight.advanced()
+            self.flights.release(self.key, self.flight)
+
+    async def aclose(self):
+        await self.close()
+
+class SharedStream(Subscription):
+    # A subscription to an upstream chat stream, usable wherever a RoutedStream is
+
+    @property
+    def model_id(self):
+        return self.flight.meta
+
+class Flights:
+    # Singleflight for streams: callers with the same key while a source is in
+    # flight share it instead of opening another one. open() returns
+    # (meta, async iterator, async close function). With max_buffer the source
+    # reads at most that many items ahead of its slowest subscriber.
+
+    def __init__(self, subscription=Subscription, max_buffer: int = STREAM_BUFFER_CHUNKS):
+        self.subscription = subscription
+        self.max_buffer = max_buffer
+        self.flights = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def subscribe(self, key: str, open):
+        flight = self.flights.get(key)
+        coalesced = flight is not None
+        if flight is None:
+            flight = self.flights[key] = Flight()
+            flight.task = asyncio.create_task(self._run(key, flight, open))
+            self.started += 1
+        else:
+            self.coalesced += 1
+        flight.subscribers += 1
+        subscription = self.subscription(self, key, flight, coalesced)
+        flight.readers.add(subscription)
+        try:
+            await flight.ready.wait()
+        except BaseException:
+            await subscription.close()
+            raise
+        if flight.meta is None and flight.error is not None:
+            await subscription.close()
+            raise flight.error
+        return subscription
+
+    def release(self, key: str, flight: Flight):
+        flight.subscribers -= 1
+        if flight.subscribers == 0:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if not flight.done:
+                flight.task.cancel()
+
+    async def _run(self, key: str, flight: Flight, open):
+        close = None
+        try:
+            flight.meta, iterator, close = await open()
+            flight.ready.set()
+            async for item in iterator:
+                flight.items.append(item)
+                flight.notify()
+                if self.max_buffer:
+                    await flight.drain(self.max_buffer)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            flight.ready.set()
+            flight.notify()
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+            if close is not None:
+                with anyio.CancelScope(shield=True):
+                    await close()
+
+    def stats(self):
+        return {"started": self.started, "coalesced": self.coalesced, "in_flight": len(self.flights)}
+
+class SingleFlight:
+    # Callers with the same key while a call is running wait for its result
+    # instead of making their own
+
+    def __init__(self):
+        self.calls = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn, *args):
+        future = self.calls.get(key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        self.started += 1
+        try:
+            result = await fn(*args)
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()  # only waiters need to see it
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self.calls[key]
+
+    def stats(self):
+        return {"started": self.started, "coalesced": self.coalesced, "in_flight": len(self.calls)}
+
+class SessionLocks:
+    # Per-session asyncio locks, created on first use and dropped when no one
+    # holds or waits for them. Serializes one worker's writes to a session's
+    # history; other workers are kept coherent by sessions.version.
+
+    def __init__(self):
+        self.locks = {}  # key -> [lock, users]
+        self.contended = 0
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        elif entry[0].locked():
+            self.contended += 1
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+    def stats(self):
+        return {"held": len(self.locks), "contended": self.contended}
+
+# Identical chat requests (same route and body) share one turn
+turn_flights = Flights()
+# Identical prompts from different sessions share one upstream stream
+upstream_flights = Flights(SharedStream)
+# Rolling summary updates, one per session at a time
+summary_flights = SingleFlight()
+session_locks = SessionLocks()
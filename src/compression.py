@@ -0,0 +1,204 @@
+import importlib.util
+import logging
+import os
+import re
+import struct
+import zlib
+from collections import Counter
+
+from sqlalchemy import Text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import GenericFunction
+from sqlalchemy.types import Integer, TypeDecorator
+
+logger = logging.getLogger(__name__)
+
+# Message bodies and summaries at least CONTENT_COMPRESSION_MIN_BYTES long (as
+# UTF-8) are stored compressed on SQLite: zlib, zstd (needs the zstandard
+# package) or off. Postgres and other servers already compress large text.
+CONTENT_COMPRESSION = os.getenv("CONTENT_COMPRESSION", "zlib").lower()
+CONTENT_COMPRESSION_MIN_BYTES = int(os.getenv("CONTENT_COMPRESSION_MIN_BYTES", "256"))
+CONTENT_COMPRESSION_LEVEL = int(os.getenv("CONTENT_COMPRESSION_LEVEL", "6"))
+# Dictionary files, separated by os.pathsep. New rows use the first; the rest
+# are only kept so rows written with an older dictionary stay readable.
+CONTENT_COMPRESSION_DICTIONARY = os.getenv("CONTENT_COMPRESSION_DICTIONARY", "")
+HAS_ZSTANDARD = importlib.util.find_spec("zstandard") is not None
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+# codec, dictionary id (crc32, 0 for none), length of the text in characters
+HEADER = struct.Struct(">BII")
+# zlib only looks back 32KB, so a longer preset dictionary is wasted
+ZLIB_DICTIONARY_BYTES = 32 * 1024
+
+def load_dictionaries(paths: str):
+    dictionaries = []
+    for path in filter(None, paths.split(os.pathsep)):
+        with open(path, "rb") as f:
+            dictionaries.append(f.read())
+    return dictionaries
+
+class Codec:
+    # Compresses text into HEADER + payload and back. Any dictionary this
+    # process was given can be read, only the first is written with.
+
+    def __init__(self, codec: str = CONTENT_COMPRESSION, min_bytes: int = CONTENT_COMPRESSION_MIN_BYTES,
+                 level: int = CONTENT_COMPRESSION_LEVEL, dictionaries=None):
+        if codec == "zstd" and not HAS_ZSTANDARD:
+            logger.warning("zstandard is not installed, compressing message content with zlib")
+            codec = "zlib"
+        self.codec = {"zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}.get(codec)
+        self.min_bytes = min_bytes
+        self.level = level
+        dictionaries = load_dictionaries(CONTENT_COMPRESSION_DICTIONARY) if dictionaries is None else dictionaries
+        self.dictionaries = {zlib.crc32(d): d for d in dictionaries}
+        self.dictionary_id = zlib.crc32(dictionaries[0]) if dictionaries else 0
+        self.zstd_dictionaries = {}
+        # Priming zlib with a dictionary costs more than compressing a message,
+        # so each message gets a copy of one primed compressor
+        self.zlib_compressor = zlib.compressobj(level, zdict=dictionaries[0]) if dictionaries else None
+
+    def compress(self, text: str):
+        # bytes, or the text itself when it is short or would not shrink
+        if self.codec is None:
+            return text
+        raw = text.encode("utf-8")
+        if len(raw) < self.min_bytes:
+            return text
+        if self.codec == CODEC_ZSTD:
+            payload = self.zstd_compressor().compress(raw)
+        else:
+            compressor = self.zlib_compressor.copy() if self.zlib_compressor else zlib.compressobj(self.level)
+            payload = compressor.compress(raw) + compressor.flush()
+        if len(payload) + HEADER.size >= len(raw):
+            return text
+        return HEADER.pack(self.codec, self.dictionary_id, len(text)) + payload
+
+    def decompress(self, data: bytes) -> str:
+        codec, dictionary_id, _ = HEADER.unpack_from(data)
+        payload = memoryview(data)[HEADER.size:]
+        if dictionary_id and dictionary_id not in self.dictionaries:
+            raise ValueError(f"content was compressed with dictionary {dictionary_id:08x}, which is not in CONTENT_COMPRESSION_DICTIONARY")
+        if codec == CODEC_ZSTD:
+            return self.zstd_decompressor(dictionary_id).decompress(payload).decode("utf-8")
+        if dictionary_id:
+            decompressor = zlib.decompressobj(zdict=self.dictionaries[dictionary_id])
+            return (decompressor.decompress(payload) + decompressor.flush()).decode("utf-8")
+        return zlib.decompress(payload).decode("utf-8")
+
+    def zstd_dictionary(self, dictionary_id: int):
+        import zstandard
+        if dictionary_id not in self.zstd_dictionaries:
+            self.zstd_dictionaries[dictionary_id] = zstandard.ZstdCompressionDict(self.dictionaries[dictionary_id])
+        return self.zstd_dictionaries[dictionary_id]
+
+    def zstd_compressor(self):
+        # zstandard contexts are not thread-safe, and DB calls run on worker threads
+        import zstandard
+        if self.dictionary_id:
+            return zstandard.ZstdCompressor(level=self.level, dict_data=self.zstd_dictionary(self.dictionary_id))
+        return zstandard.ZstdCompressor(level=self.level)
+
+    def zstd_decompressor(self, dictionary_id: int):
+        import zstandard
+        if dictionary_id:
+            return zstandard.ZstdDecompressor(dict_data=self.zstd_dictionary(dictionary_id))
+        return zstandard.ZstdDecompressor()
+
+codec = Codec()
+
+class CompressedText(TypeDecorator):
+    # Text that is stored as a compressed BLOB on SQLite once it is long
+    # enough. Rows written before compression was enabled, or below the size
+    # threshold, stay plain text, so both read back as str.
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name != "sqlite":
+            return value
+        return codec.compress(value)
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return codec.decompress(value)
+        return value
+
+def content_length(value) -> int:
+    # Characters in a stored value, read from the header for compressed rows
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return HEADER.unpack_from(value)[2]
+    return len(value)
+
+class stored_length(GenericFunction):
+    # length() of a CompressedText column in characters, without decompressing
+    type = Integer()
+    inherit_cache = True
+
+@compiles(stored_length)
+def compile_stored_length(element, compiler, **kw):
+    return f"length({compiler.process(element.clauses, **kw)})"
+
+@compiles(stored_length, "sqlite")
+def compile_stored_length_sqlite(element, compiler, **kw):
+    return f"content_length({compiler.process(element.clauses, **kw)})"
+
+def register_sqlite_functions(dbapi_connection):
+    dbapi_connection.create_function("content_length", 1, content_length, deterministic=True)
+
+def build_zlib_dictionary(samples, size: int = ZLIB_DICTIONARY_BYTES) -> bytes:
+    # zlib has no trainer: keep the phrases that save the most bytes
+    # (count x length), with the most valuable last, nearest the data
+    counts = Counter()
+    for sample in samples:
+        for phrase in re.split(r"(?<=[\s.,!?])", sample):
+            if len(phrase.encode("utf-8")) >= 8:
+                counts[phrase] += 1
+    scored = sorted((phrase for phrase, count in counts.items() if count > 1),
+                    key=lambda phrase: counts[phrase] * len(phrase.encode("utf-8")), reverse=True)
+    chosen, used = [], 0
+    for phrase in scored:
+        encoded = phrase.encode("utf-8")
+        if used + len(encoded) > size:
+            continue
+        chosen.append(encoded)
+        used += len(encoded)
+    return b"".join(reversed(chosen))
+
+def train_dictionary(samples, codec_name: str = CONTENT_COMPRESSION, size: int = ZLIB_DICTIONARY_BYTES) -> bytes:
+    samples = list(samples)
+    if codec_name == "zstd" and HAS_ZSTANDARD:
+        import zstandard
+        return zstandard.train_dictionary(size, [sample.encode("utf-8") for sample in samples]).as_bytes()
+    return build_zlib_dictionary(samples, size)
+
+if __name__ == "__main__":
+    # Train a dictionary on the stored messages and summaries:
+    #   python -m src.compression content.dict [--size 32768] [--samples 20000]
+    # then set CONTENT_COMPRESSION_DICTIONARY=content.dict (keep older
+    # dictionaries after it so existing rows can still be read)
+    import argparse
+
+    from sqlalchemy import select
+
+    from src.models import Message, SessionSummary, all_shards
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output")
+    parser.add_argument("--size", type=int, default=ZLIB_DICTIONARY_BYTES)
+    parser.add_argument("--samples", type=int, default=20000)
+    args = parser.parse_args()
+
+    # The newest rows of every shard, in equal parts
+    samples = []
+    per_shard = max(1, args.samples // len(all_shards()))
+    for shard in all_shards():
+        with shard.SessionLocal() as db:
+            samples += [content for content, in db.execute(select(Message.content).where(Message.pending.is_(False)).order_by(Message.id.desc()).limit(per_shard))]
+            samples += [summary for summary, in db.execute(select(SessionSummary.summary).limit(per_shard // 10))]
+    dictionary = train_dictionary(samples, size=args.size)
+    with open(args.output, "wb") as f:
+        f.write(dictionary)
+    print(f"wrote {len(dictionary)} byte {CONTENT_COMPRESSION} dictionary {zlib.crc32(dictionary):08x} from {len(samples)} samples to {args.output}")
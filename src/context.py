@@ -0,0 +1,158 @@
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from src.compression import stored_length
+from src.models import Message
+
+logger = logging.getLogger(__name__)
+
+# Prompt token budget per model id; CONTEXT_TOKEN_BUDGETS='{"typhoon-v1.5-instruct": 3000}' overrides
+DEFAULT_CONTEXT_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_BUDGETS = json.loads(os.getenv("CONTEXT_TOKEN_BUDGETS") or "{}")
+
+# Rows fetched per newest-first page while filling the budget
+CONTEXT_PAGE_SIZE = int(os.getenv("CONTEXT_PAGE_SIZE", "20"))
+
+# Approximate characters per token as (Thai script, everything else), by model id prefix.
+# Typhoon extends the Llama 3 vocabulary with Thai, so it packs Thai text much denser.
+TOKENIZER_RATIOS = [
+    ("typhoon", 2.6, 4.0),
+    ("llama", 1.3, 4.0),
+    ("gemma", 1.8, 4.0),
+]
+DEFAULT_TOKENIZER_RATIO = (1.3, 3.5)
+
+# Role markers and separators the chat template adds around every message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# Floor for the latest message when the pinned prompt already fills the budget
+MIN_TRIMMED_TOKENS = 64
+
+THAI_RE = re.compile(r"[฀-๿]")
+
+@dataclass
+class ContextStats:
+    budget: int
+    tokens_kept: int = 0
+    tokens_dropped: int = 0
+    messages_kept: int = 0
+    messages_dropped: int = 0
+    trimmed: bool = False
+
+    def headers(self):
+        return {
+            "X-Context-Budget": str(self.budget),
+            "X-Context-Tokens-Kept": str(self.tokens_kept),
+            "X-Context-Tokens-Dropped": str(self.tokens_dropped),
+            "X-Context-Messages-Dropped": str(self.messages_dropped),
+        }
+
+def tokenizer_ratio(model_id: str):
+    for prefix, thai, other in TOKENIZER_RATIOS:
+        if model_id.startswith(prefix):
+            return thai, other
+    return DEFAULT_TOKENIZER_RATIO
+
+def context_budget(model_id: str) -> int:
+    return int(CONTEXT_BUDGETS.get(model_id, DEFAULT_CONTEXT_BUDGET))
+
+def estimate_tokens(text: str, model_id: str) -> int:
+    thai_ratio, other_ratio = tokenizer_ratio(model_id)
+    thai_chars = len(text) - len(THAI_RE.sub("", text))
+    return int(thai_chars / thai_ratio + (len(text) - thai_chars) / other_ratio) + 1
+
+def message_tokens(message, model_id: str) -> int:
+    return estimate_tokens(message["content"], model_id) + MESSAGE_OVERHEAD_TOKENS
+
+def trim_to_tokens(text: str, tokens: int, model_id: str) -> str:
+    # Keep the end of an oversized message, it is the part the model needs to answer
+    thai_ratio, _ = tokenizer_ratio(model_id)
+    keep = max(0, int(tokens * thai_ratio))
+    while keep and estimate_tokens(text[-keep:], model_id) > tokens:
+        keep = int(keep * 0.9)
+    return text[-keep:] if keep else ""
+
+def new_stats(system_messages, model_id: str):
+    stats = ContextStats(budget=context_budget(model_id))
+    stats.tokens_kept = sum(message_tokens(message, model_id) for message in system_messages)
+    return stats
+
+def fit_newest(rows, kept, stats: ContextStats, model_id: str):
+    # Append (id, role, content) rows, newest first, to kept while they fit the budget.
+    # Returns the id of the first row that did not fit, or None.
+    remaining = stats.budget - stats.tokens_kept
+    for message_id, role, content in rows:
+        message = {"role": role, "content": content}
+        tokens = message_tokens(message, model_id)
+        if tokens > remaining and not kept:
+            # The latest message alone is over budget, send its tail
+            limit = max(remaining - MESSAGE_OVERHEAD_TOKENS, MIN_TRIMMED_TOKENS)
+            message["content"] = trim_to_tokens(content, limit, model_id)
+            stats.trimmed = True
+            stats.tokens_dropped += tokens - message_tokens(message, model_id)
+            tokens = message_tokens(message, model_id)
+        elif tokens > remaining:
+            return message_id
+        kept.append(message)
+        stats.tokens_kept += tokens
+        remaining -= tokens
+    return None
+
+def finish_context(system_messages, kept, stats: ContextStats, model_id: str):
+    kept.reverse()
+    stats.messages_kept = len(kept)
+    if stats.messages_dropped or stats.trimmed:
+        logger.info(
+            "context trimmed model_id=%s budget=%d tokens_kept=%d tokens_dropped=%d messages_dropped=%d",
+            model_id, stats.budget, stats.tokens_kept, stats.tokens_dropped, stats.messages_dropped,
+        )
+    return list(system_messages) + kept, stats
+
+def build_context(system_messages, db_session_id: int, model_id: str, db: Session, after_id: int = 0):
+    # Pinned system messages plus as many of the newest turns as fit the model's budget.
+    # Rows are read newest-first a page at a time, so older history is never loaded.
+    stats = new_stats(system_messages, model_id)
+    kept = []
+    before_id = None
+    overflow_id = None  # newest message that did not fit, everything from here back is dropped
+    while overflow_id is None:
+        query = db.query(Message.id, Message.role, Message.content).filter(
+            Message.session_id == db_session_id, Message.id > after_id, Message.pending.is_(False)
+        )
+        if before_id is not None:
+            query = query.filter(Message.id < before_id)
+        page = query.order_by(Message.id.desc()).limit(CONTEXT_PAGE_SIZE).all()
+
+        overflow_id = fit_newest(page, kept, stats, model_id)
+        if overflow_id is None and len(page) < CONTEXT_PAGE_SIZE:
+            break
+        if page:
+            before_id = page[-1][0]
+
+    if overflow_id is not None:
+        # Size the dropped history with one aggregate instead of loading it
+        dropped_count, dropped_chars = db.query(
+            func.count(Message.id), func.coalesce(func.sum(stored_length(Message.content)), 0)
+        ).filter(Message.session_id == db_session_id, Message.id > after_id, Message.id <= overflow_id, Message.pending.is_(False)).one()
+        stats.messages_dropped = dropped_count
+        stats.tokens_dropped += int(dropped_chars / tokenizer_ratio(model_id)[0]) + dropped_count * MESSAGE_OVERHEAD_TOKENS
+
+    return finish_context(system_messages, kept, stats, model_id)
+
+def select_context(system_messages, messages, model_id: str, after_id: int = 0):
+    # build_context over an already loaded, oldest-first message list
+    stats = new_stats(system_messages, model_id)
+    kept = []
+    rows = [(m["id"], m["role"], m["content"]) for m in reversed(messages) if m["id"] > after_id]
+    overflow_id = fit_newest(rows, kept, stats, model_id)
+    if overflow_id is not None:
+        dropped = [row for row in rows if row[0] <= overflow_id]
+        stats.messages_dropped = len(dropped)
+        stats.tokens_dropped += sum(estimate_tokens(content, model_id) + MESSAGE_OVERHEAD_TOKENS for _, _, content in dropped)
+    return finish_context(system_messages, kept, stats, model_id)
@@ -0,0 +1,120 @@
+import json
+import logging
+import os
+from datetime import timedelta
+
+from sqlalchemy.orm import Session
+
+from src.admission import Overloaded, get_admission
+from src.coalesce import session_locks, summary_flights
+from src.context import message_tokens
+from src.models import Message, SessionSummary, run_db
+from src.persistence import get_writer
+from src.retention import utcnow
+from src.routing import get_router
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = 'Update the conversation summary with the new messages. Write one paragraph that have about 300 words in Thai.'
+
+# Messages kept verbatim after the summary, the latest user turn and reply
+KEEP_RECENT = 2
+# A reserved reply row still pending after this long was abandoned (its worker
+# stopped mid-stream) and no longer holds the summary back
+PENDING_REPLY_SECONDS = float(os.getenv("PENDING_REPLY_SECONDS", "600"))
+
+def load_summary(db_session_id: int, db: Session):
+    summary_row = db.get(SessionSummary, db_session_id)
+    if summary_row is None:
+        return None, 0
+    return summary_row.summary, summary_row.last_message_id
+
+def load_memory(db_session_id: int, db: Session):
+    # Current summary plus the messages it has not folded in yet
+    summary, last_message_id = load_summary(db_session_id, db)
+
+    tail = db.query(Message).filter(Message.session_id == db_session_id, Message.id > last_message_id).order_by(Message.id).all()
+    abandoned_before = utcnow() - timedelta(seconds=PENDING_REPLY_SECONDS)
+    messages = []
+    for message in tail:
+        if message.pending:
+            if message.created_at is not None and message.created_at < abandoned_before:
+                continue
+            # A reply still streaming, possibly on another worker: folding past
+            # it would hide it behind the summary once it is filled in
+            break
+        messages.append({"id": message.id, "role": message.role, "content": message.content})
+    return summary, last_message_id, messages
+
+def build_memory_history(system_prompt: str, summary, messages):
+    history = [{"role": "system", "content": system_prompt}]
+    if summary:
+        history.append({"role": "system", "content": f"conversation summary: \n{summary}"})
+    history.extend({"role": message["role"], "content": message["content"]} for message in messages)
+    return history
+
+def save_summary(db_session_id: int, summary: str, last_message_id: int, previous_last_message_id: int, db: Session):
+    # Only advance the summary if nobody else folded the same messages meanwhile
+    summary_row = db.get(SessionSummary, db_session_id)
+    current = summary_row.last_message_id if summary_row else 0
+    if current != previous_last_message_id:
+        return False
+    if summary_row is None:
+        db.add(SessionSummary(session_id=db_session_id, summary=summary, last_message_id=last_message_id))
+    else:
+        summary_row.summary = summary
+        summary_row.last_message_id = last_message_id
+    db.commit()
+    return True
+
+def delete_summary(db_session_id: int, db: Session):
+    db.query(SessionSummary).filter(SessionSummary.session_id == db_session_id).delete()
+
+async def fold_messages(summary, messages, model_id: str, temperature: float, session_id: str) -> str:
+    # Summarization cost only grows with the new messages, not the session length
+    new_messages = [{"role": message["role"], "content": message["content"]} for message in messages]
+    content = f"current summary: \n{summary or '-'}\n\nnew messages: \n{json.dumps(new_messages, ensure_ascii=False)}"
+    prompt = [{'role': 'system', 'content': SUMMARY_PROMPT}, {'role': 'user', 'content': content}]
+
+    # Admitted, routed and charged like a chat turn, so summaries share the
+    # provider's limits and back off when it rate limits us
+    ticket = await get_admission().admit(model_id, session_id)
+    parts = []
+    try:
+        ticket.charge(sum(message_tokens(message, model_id) for message in prompt))
+        stream = await get_router().open(model_id, prompt, temperature)
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+        finally:
+            await stream.close()
+    finally:
+        ticket.release(len(parts))
+    return "".join(parts)
+
+async def update_rolling_summary(db_session_id: int, request, shard=None):
+    # Runs after the reply has been streamed, off the next request's critical path.
+    # Requests finishing while an update for the session runs share that update.
+    await summary_flights.do(request.session_id, fold_rolling_summary, db_session_id, request, shard)
+
+async def fold_rolling_summary(db_session_id: int, request, shard=None):
+    try:
+        await get_writer().wait(request.session_id)
+        summary, last_message_id, messages = await run_db(load_memory, db_session_id, shard=shard)
+        if len(messages) <= request.summary_threshold:
+            return
+
+        to_fold = messages[:-KEEP_RECENT]
+        if not to_fold:
+            return
+        new_summary = await fold_messages(summary, to_fold, request.model_id, request.temperature, request.session_id)
+        if not new_summary:
+            return
+        async with session_locks.hold(request.session_id):
+            await run_db(save_summary, db_session_id, new_summary, to_fold[-1]["id"], last_message_id, shard=shard)
+    except Overloaded as e:
+        # The messages stay unfolded and are picked up after a later turn
+        logger.warning("rolling summary for session %s deferred: %s", db_session_id, e)
+    except Exception:
+        logger.exception("rolling summary update failed for session %s", db_session_id)
@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+try:
+    from pyinstrument import Profiler
+except ImportError:
+    Profiler = None
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, tokens/sec buckets for stream throughput
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 25, 50, 100, 200, 400, 800, 1600)
+# model_id comes from the client, so cap how many distinct label values we keep
+METRICS_MAX_MODELS = int(os.getenv("METRICS_MAX_MODELS", "32"))
+# Structured per-request timing lines, logged at INFO
+METRICS_LOG_REQUESTS = os.getenv("METRICS_LOG_REQUESTS", "1") == "1"
+
+# Opt-in sampling profiler (needs pyinstrument). A request is profiled when it
+# sends PROFILE_HEADER with a truthy value or wins the PROFILE_SAMPLE_RATE draw.
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "1"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(names, values, extra=()) -> str:
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Histogram:
+    # Cumulative-bucket histogram in the Prometheus exposition format
+
+    def __init__(self, name: str, help: str, labels=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [bucket counts..., +Inf count, sum]
+
+    def observe(self, value: float, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, [('le', bound)])} {cumulative}")
+            labels = format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Metrics:
+    # Process-wide histograms plus collectors for the counters other modules
+    # already keep (session cache, streams, DB pool), rendered on /metrics
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage_seconds = Histogram("chat_stage_seconds", "Time spent per chat request stage.", ("route", "model_id", "stage"))
+        self.request_seconds = Histogram("chat_request_seconds", "Chat request duration until the stream ends.", ("route", "model_id", "status"))
+        self.tokens_per_second = Histogram("chat_stream_tokens_per_second", "Streamed chunks per second after the first token.", ("route", "model_id"), TOKENS_PER_SECOND_BUCKETS)
+        self.upstream_seconds = Histogram("upstream_first_token_seconds", "Upstream time to first token per attempt; lost attempts were cancelled by a faster hedge.", ("model_id", "outcome"))
+        self.persist_seconds = Histogram("persist_commit_seconds", "Write-behind batch commit duration.")
+        self.histograms = [self.stage_seconds, self.request_seconds, self.tokens_per_second, self.upstream_seconds, self.persist_seconds]
+        self.collectors = {}
+        self.models = set()
+
+    def model_label(self, model_id: str) -> str:
+        if model_id in self.models:
+            return model_id
+        if len(self.models) >= METRICS_MAX_MODELS:
+            return "other"
+        self.models.add(model_id)
+        return model_id
+
+    def observe_request(self, route: str, model_id: str, status: str, total: float, stages, tokens_per_second=None):
+        with self.lock:
+            model = self.model_label(model_id)
+            for stage, seconds in stages.items():
+                self.stage_seconds.observe(seconds, route, model, stage)
+            self.request_seconds.observe(total, route, model, status)
+            if tokens_per_second is not None:
+                self.tokens_per_second.observe(tokens_per_second, route, model)
+
+    def observe_upstream(self, model_id: str, outcome: str, seconds: float):
+        with self.lock:
+            self.upstream_seconds.observe(seconds, self.model_label(model_id), outcome)
+
+    def observe_persist(self, seconds: float):
+        with self.lock:
+            self.persist_seconds.observe(seconds)
+
+    def register(self, prefix: str, collect):
+        # collect() returns a flat dict of numbers, exported as prefix_key
+        self.collectors[prefix] = collect
+
+    def render(self) -> str:
+        with self.lock:
+            lines = [line for histogram in self.histograms for line in histogram.render()]
+        for prefix, collect in self.collectors.items():
+            for key, value in collect().items():
+                name = f"{prefix}_{key}"
+                lines.append(f"# TYPE {name} untyped")
+                lines.append(f"{name} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+_profiling = threading.Lock()
+
+def start_profiler(headers=None):
+    # Returns a running profiler when this request is selected, else None.
+    # The profiler samples the whole event loop thread, so concurrent requests
+    # show up too; only one request is profiled at a time.
+    selected = bool(PROFILE_HEADER and headers is not None and headers.get(PROFILE_HEADER, "").lower() in ("1", "true", "yes"))
+    if not selected and not (PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE):
+        return None
+    if Profiler is None:
+        logger.warning("request selected for profiling but pyinstrument is not installed")
+        return None
+    if not _profiling.acquire(blocking=False):
+        return None
+    try:
+        profiler = Profiler(interval=PROFILE_INTERVAL_MS / 1000, async_mode="disabled")
+        profiler.start()
+    except Exception:
+        _profiling.release()
+        logger.exception("could not start profiler")
+        return None
+    return profiler
+
+def stop_profiler(profiler, name: str):
+    try:
+        profiler.stop()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        path = os.path.join(PROFILE_DIR, f"{name}-{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.html")
+        with open(path, "w") as f:
+            f.write(profiler.output_html())
+        logger.info("wrote profile %s", path)
+    except Exception:
+        logger.exception("could not write profile")
+    finally:
+        _profiling.release()
+
+class RequestTimer:
+    # Per-request stage timings. Stages before the stream starts go out in the
+    # Server-Timing header; time to first token, stream time and tokens/sec are
+    # only known once the stream ends and go to the log line and histograms.
+
+    def __init__(self, route: str, model_id: str, session_id: str, headers=None):
+        self.route = route
+        self.model_id = model_id
+        self.session_id = session_id
+        self.started = time.perf_counter()
+        self.stages = {}
+        self.finished = False
+        self.profiler = start_profiler(headers)
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    def mark(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.stages.items())
+
+    def headers(self):
+        return {"Server-Timing": self.server_timing()}
+
+    def finish(self, status: str, tokens: int = 0, first_token_at=None):
+        if self.finished:
+            return
+        self.finished = True
+        total = self.elapsed()
+        tokens_per_second = None
+        if first_token_at is not None:
+            self.mark("ttft", first_token_at - self.started)
+            streamed = time.perf_counter() - first_token_at
+            self.mark("stream", streamed)
+            if tokens > 1 and streamed > 0:
+                tokens_per_second = (tokens - 1) / streamed
+        metrics.observe_request(self.route, self.model_id, status, total, self.stages, tokens_per_second)
+        if METRICS_LOG_REQUESTS:
+            logger.info(json.dumps({
+                "event": "chat_timing",
+                "route": self.route,
+                "model_id": self.model_id,
+                "session_id": self.session_id,
+                "status": status,
+                "total_ms": round(total * 1000, 2),
+                "stages_ms": {name: round(seconds * 1000, 2) for name, seconds in self.stages.items()},
+                "tokens": tokens,
+                "tokens_per_second": round(tokens_per_second, 1) if tokens_per_second is not None else None,
+            }, ensure_ascii=False))
+        if self.profiler is not None:
+            stop_profiler(self.profiler, self.route.strip("/").replace("/", "_"))
+            self.profiler = None
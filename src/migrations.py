@@ -0,0 +1,116 @@
+import logging
+
+from sqlalchemy import inspect, text
+
+from src.models import Base
+
+logger = logging.getLogger(__name__)
+
+# Ordered (version, description, upgrade) steps. An upgrade gets the open
+# connection and must be safe to re-run, since a second worker may race it.
+MIGRATIONS = []
+
+def migration(version: int, description: str):
+    def register(upgrade):
+        MIGRATIONS.append((version, description, upgrade))
+        return upgrade
+    return register
+
+def column_names(conn, table: str):
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+@migration(1, "add created_at to sessions and messages")
+def add_created_at(conn):
+    for table in ("sessions", "messages"):
+        if "created_at" not in column_names(conn, table):
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN created_at TIMESTAMP"))
+
+@migration(2, "index messages on (session_id, id)")
+def index_messages_by_session(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_messages_session_id_id ON messages (session_id, id)"))
+
+@migration(3, "add sessions.version for session cache coherence")
+def add_session_version(conn):
+    if "version" not in column_names(conn, "sessions"):
+        conn.execute(text("ALTER TABLE sessions ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+@migration(4, "add messages.truncated for replies cut off by a client disconnect")
+def add_message_truncated(conn):
+    if "truncated" not in column_names(conn, "messages"):
+        conn.execute(text("ALTER TABLE messages ADD COLUMN truncated BOOLEAN NOT NULL DEFAULT FALSE"))
+
+@migration(5, "maintain sessions.message_count, last_message_id and last_activity")
+def add_session_activity(conn):
+    columns = column_names(conn, "sessions")
+    if "message_count" not in columns:
+        conn.execute(text("ALTER TABLE sessions ADD COLUMN message_count INTEGER NOT NULL DEFAULT 0"))
+    if "last_message_id" not in columns:
+        conn.execute(text("ALTER TABLE sessions ADD COLUMN last_message_id INTEGER NOT NULL DEFAULT 0"))
+    if "last_activity" not in columns:
+        conn.execute(text("ALTER TABLE sessions ADD COLUMN last_activity TIMESTAMP"))
+    # One pass over ix_messages_session_id_id
+    conn.execute(text(
+        "UPDATE sessions SET "
+        "message_count = (SELECT COUNT(*) FROM messages WHERE messages.session_id = sessions.id), "
+        "last_message_id = COALESCE((SELECT MAX(id) FROM messages WHERE messages.session_id = sessions.id), 0), "
+        "last_activity = COALESCE((SELECT MAX(created_at) FROM messages WHERE messages.session_id = sessions.id), created_at, CURRENT_TIMESTAMP)"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sessions_last_message_id_id ON sessions (last_message_id, id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sessions_last_activity ON sessions (last_activity)"))
+
+@migration(6, "backfill sessions.last_activity left NULL by version 5")
+def backfill_last_activity(conn):
+    # Sessions from before created_at existed with no timestamped messages got
+    # no last_activity, which no retention cutoff matches. Count them as active
+    # now so they expire one TTL after the upgrade.
+    conn.execute(text("UPDATE sessions SET last_activity = CURRENT_TIMESTAMP WHERE last_activity IS NULL"))
+
+@migration(7, "index sessions on (last_activity, id) for /list_sessions")
+def index_sessions_by_activity(conn):
+    # Replaces both version 5 indexes: sessions are listed by last_activity,
+    # which, unlike last_message_id, also moves when history is deleted
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_sessions_last_activity_id ON sessions (last_activity, id)"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_sessions_last_activity"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_sessions_last_message_id_id"))
+
+@migration(8, "add messages.pending for reply rows reserved with their user turn")
+def add_message_pending(conn):
+    if "pending" not in column_names(conn, "messages"):
+        conn.execute(text("ALTER TABLE messages ADD COLUMN pending BOOLEAN NOT NULL DEFAULT FALSE"))
+
+@migration(9, "drop sessions.last_message_id")
+def drop_session_last_message_id(conn):
+    # Nothing reads it since sessions are listed by last_activity, and keeping
+    # it up to date cost every write a MAX(messages.id) lookup
+    if "last_message_id" in column_names(conn, "sessions"):
+        conn.execute(text("DROP INDEX IF EXISTS ix_sessions_last_message_id_id"))
+        conn.execute(text("ALTER TABLE sessions DROP COLUMN last_message_id"))
+
+def latest_version():
+    return max(version for version, _, _ in MIGRATIONS)
+
+def current_version(conn):
+    return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+
+def stamp(conn, version: int):
+    conn.execute(text("INSERT INTO schema_version (version) VALUES (:version)"), {"version": version})
+
+def migrate(engine):
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)"))
+        version = current_version(conn)
+
+        if version is None and not inspect(conn).has_table("messages"):
+            # Fresh database, the models already describe the latest schema
+            Base.metadata.create_all(bind=conn)
+            stamp(conn, latest_version())
+            return
+
+        for step, description, upgrade in sorted(MIGRATIONS, key=lambda m: m[0]):
+            if step > (version or 0):
+                logger.info("migrating database to version %d: %s", step, description)
+                upgrade(conn)
+                stamp(conn, step)
+
+        # Tables added since the last migration need no upgrade step
+        Base.metadata.create_all(bind=conn)
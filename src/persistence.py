@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+
+from sqlalchemy import delete, update
+from sqlalchemy.orm import Session
+
+from src.cache import session_cache
+from src.metrics import metrics
+from src.models import Message, bump_session_version, run_db
+
+logger = logging.getLogger(__name__)
+
+# Finished replies are written in batches of up to PERSIST_BATCH_SIZE rows,
+# collected for at most PERSIST_FLUSH_MS after the first one arrives
+PERSIST_BATCH_SIZE = int(os.getenv("PERSIST_BATCH_SIZE", "200"))
+PERSIST_FLUSH_MS = float(os.getenv("PERSIST_FLUSH_MS", "20"))
+PERSIST_QUEUE_SIZE = int(os.getenv("PERSIST_QUEUE_SIZE", "10000"))
+
+def write_replies(rows, db: Session):
+    # Fill in reserved reply rows, deleting those left with no content. A row
+    # already gone (its history was deleted meanwhile) matches nothing.
+    # Returns the new version of each session that changed.
+    added, changed = Counter(), set()
+    for row in rows:
+        if row["content"] is None:
+            written = db.execute(delete(Message).where(Message.id == row["id"], Message.pending.is_(True))).rowcount
+        else:
+            written = db.execute(update(Message).where(Message.id == row["id"], Message.pending.is_(True)).values(
+                content=row["content"], model_id=row["model_id"], truncated=row["truncated"], pending=False,
+            )).rowcount
+            added[row["session_id"]] += written
+        if written:
+            changed.add(row["session_id"])
+    versions = {db_session_id: bump_session_version(db_session_id, db, added[db_session_id]) for db_session_id in changed}
+    db.commit()
+    return versions
+
+def write_replies_one_by_one(rows, db: Session):
+    # Fallback after a failed batch, so one bad row does not lose the others
+    for row in rows:
+        try:
+            write_replies([row], db)
+        except Exception:
+            db.rollback()
+            logger.exception("dropping reply for session %s", row["session_id"])
+
+class MessageWriter:
+    # Write-behind queue for streamed replies. Each reply's row is reserved,
+    # pending, in the transaction that saves its user turn, so it keeps its
+    # place in the session whichever worker serves the next turn. Streams hand
+    # over the finished content and return immediately; one task fills in many
+    # streams' rows per transaction. Readers in this worker call wait() first
+    # so a session's next turn here never sees history without its previous reply.
+
+    def __init__(self, batch_size: int = PERSIST_BATCH_SIZE, flush_ms: float = PERSIST_FLUSH_MS, queue_size: int = PERSIST_QUEUE_SIZE):
+        self.batch_size = batch_size
+        self.flush_interval = flush_ms / 1000
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.pending = {}  # session key -> future of its latest queued row
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+
+    async def submit(self, key: str, db_session_id: int, reply_id: int, content, model_id: str = None, truncated: bool = False, shard=None):
+        # content None drops the reserved row, for turns that produced no reply
+        done = asyncio.get_running_loop().create_future()
+        self.pending[key] = done
+        row = {"id": reply_id, "session_id": db_session_id, "content": content, "model_id": model_id, "truncated": truncated}
+        # Only waits when PERSIST_QUEUE_SIZE rows are already in flight
+        await self.queue.put((key, row, done, shard))
+
+    async def wait(self, key: str):
+        done = self.pending.get(key)
+        if done is not None:
+            await asyncio.shield(done)
+
+    async def stop(self):
+        # Flush everything still queued, used at shutdown
+        if self.task is not None:
+            await self.queue.put(None)
+            await self.task
+            self.task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                if self.queue.empty():
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    item = self.queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._write(batch)
+
+        # Rows queued behind the stop sentinel
+        remaining = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        if remaining:
+            await self._write(remaining)
+
+    async def _write(self, batch):
+        # One transaction per shard, the shards written concurrently
+        by_shard = {}
+        for item in batch:
+            by_shard.setdefault(item[3], []).append(item)
+        await asyncio.gather(*(self._write_shard(shard, items) for shard, items in by_shard.items()))
+        for key, _, done, _ in batch:
+            done.set_result(None)
+            if self.pending.get(key) is done:
+                del self.pending[key]
+
+    async def _write_shard(self, shard, batch):
+        rows = [row for _, row, _, _ in batch]
+        try:
+            started = time.perf_counter()
+            versions = await run_db(write_replies, rows, shard=shard)
+            metrics.observe_persist(time.perf_counter() - started)
+            appended = {}
+            for key, row, _, _ in batch:
+                messages = appended.setdefault(key, (row["session_id"], []))[1]
+                if row["content"] is not None:
+                    messages.append({"id": row["id"], "role": "assistant", "content": row["content"]})
+            for key, (db_session_id, messages) in appended.items():
+                if db_session_id in versions:
+                    session_cache.append(key, versions[db_session_id], messages)
+        except Exception:
+            logger.exception("batch write of %d replies failed, retrying one by one", len(rows))
+            for key, _, _, _ in batch:
+                session_cache.invalidate(key)
+            try:
+                await run_db(write_replies_one_by_one, rows, shard=shard)
+            except Exception:
+                logger.exception("could not persist %d replies", len(rows))
+
+writer = None
+
+def get_writer() -> MessageWriter:
+    global writer
+    if writer is None:
+        writer = MessageWriter()
+    return writer
+
+async def start_writer():
+    get_writer().start()
+
+async def stop_writer():
+    global writer
+    if writer is not None:
+        await writer.stop()
+        writer = None
@@ -0,0 +1,53 @@
+import os
+import sys
+from functools import lru_cache
+
+from src.tarot import card_names
+
+# Rendered system prompts kept per (seer_name, seer_personality)
+SYSTEM_PROMPT_CACHE_SIZE = int(os.getenv("SYSTEM_PROMPT_CACHE_SIZE", "1024"))
+
+# Instructions shared by every seer. They come first and never change, so
+# providers that cache prompt prefixes can reuse them across all sessions;
+# only the seer lines at the end vary.
+SYSTEM_INSTRUCTIONS = sys.intern("""\
+You are an empathetic Thai woman assistant. (Thai woman will say 'ค่ะ'/'ka' at the end of every sentence).
+You provide insights and support offering clarity and healing.
+You always answer in Thai or English based on the language of the user's message you cannot say both language in one answer.
+First, you need to know these insight ask each one separately.
+- What is the problem that user faced.
+- How long that user faced.
+If the statement is not clear and concise, you can ask multiple times.
+If the statement is clear and concise, you will ask user if they want to open tarot card or not.
+If user ask to open tarot card (example: ฉันอยากเลือกไพ่เพื่อดูดวง), you will say strictly "(ฉันเตรียมไพ่มาแล้วค่ะ)" at the end of your answer.
+You cannot select tarot card by yourself.
+You cannot open tarot card before saying "ฉันเห็นว่าคุณเลือกไพ่นะคะ".
+After open tarot card, explain the future of how to fix the problem in with one sentence and explain in a short 3 sentences.
+If user ask to open new tarot card, you will not reuse the same tarot card again.
+""")
+SEER_TEMPLATE = 'Your name is {seer_name}.\nYour personality is "{seer_personality}".\n'
+
+# Turn saved when the user has drawn cards
+CARDS_DRAWN = sys.intern("ฉันเห็นว่าคุณเลือกไพ่ ไพ่ที่คุณเลือก {cards} นะคะ")
+CARDS_DRAWN_RAG = sys.intern("ฉันเห็นว่าคุณเลือกไพ่นะคะ ไพ่ที่คุณเลือก {cards} \n\n โดยไพ่แต่ละใบมีความหมายดังนี้ \n\n ")
+RELATED_PASSAGES = sys.intern("\n\n ข้อมูลที่เกี่ยวข้องกับปัญหาของคุณ \n\n ")
+EXPLAIN_CARDS = sys.intern("เลือกไพ่เรียบร้อยแล้ว อธิบายดวงจากไพ่ให้หน่อย โดยเรื่มพูดจากประโยคหนึ่งสั้นๆที่บอกเกี่ยวกับดวง และ อธิบายเป็นอีกสามประโยค")
+
+CARD_NAMES = frozenset(card_names)
+
+@lru_cache(maxsize=SYSTEM_PROMPT_CACHE_SIZE)
+def system_prompt(seer_name: str, seer_personality: str) -> str:
+    return SYSTEM_INSTRUCTIONS + SEER_TEMPLATE.format(seer_name=seer_name, seer_personality=seer_personality)
+
+def cards_prompt(cards, card_passages=None, related_passages=()) -> str:
+    # The assistant turn naming the drawn cards, with their retrieved meanings on /chat/rag
+    names = ", ".join(cards)
+    if card_passages is None:
+        return CARDS_DRAWN.format(cards=names)
+    parts = [CARDS_DRAWN_RAG.format(cards=names), "\n".join(passage.prompt() for passage in card_passages)]
+    if related_passages:
+        parts += [RELATED_PASSAGES, "\n".join(passage.prompt() for passage in related_passages)]
+    return "".join(parts)
+
+def unknown_cards(cards):
+    return [card for card in cards if card not in CARD_NAMES]
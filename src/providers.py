@@ -0,0 +1,96 @@
+import importlib.util
+import os
+import sys
+
+TYPHOON_BASE_URL = os.getenv("TYPHOON_BASE_URL") or 'https://api.opentyphoon.ai/v1'
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL") or 'https://api.groq.com/openai/v1'
+
+# Connection pool tuning, shared by every request in a worker
+PROVIDER_MAX_CONNECTIONS = int(os.getenv("PROVIDER_MAX_CONNECTIONS", "100"))
+PROVIDER_MAX_KEEPALIVE = int(os.getenv("PROVIDER_MAX_KEEPALIVE", "20"))
+PROVIDER_KEEPALIVE_EXPIRY = float(os.getenv("PROVIDER_KEEPALIVE_EXPIRY", "30"))
+PROVIDER_CONNECT_TIMEOUT = float(os.getenv("PROVIDER_CONNECT_TIMEOUT", "5"))
+PROVIDER_READ_TIMEOUT = float(os.getenv("PROVIDER_READ_TIMEOUT", "60"))
+# HTTP/2 needs the optional h2 package (pip install "httpx[http2]")
+PROVIDER_HTTP2 = os.getenv("PROVIDER_HTTP2", "1") == "1" and importlib.util.find_spec("h2") is not None
+
+def openai_sdk():
+    # The SDK is the slowest import of the app, so it is loaded on first use
+    import openai
+    return openai
+
+def is_rate_limit(error) -> bool:
+    # A 429 from a provider; nothing can have raised one before the SDK is loaded
+    openai = sys.modules.get("openai")
+    return openai is not None and isinstance(error, openai.RateLimitError)
+
+def provider_for(model_id: str):
+    # (base_url, api key env var) for a model id
+    if model_id.startswith("typhoon"):
+        return TYPHOON_BASE_URL, "TYPHOON_API_KEY"
+    # groq
+    return GROQ_BASE_URL, "GROQ_API_KEY"
+
+class ProviderRegistry:
+    # One long-lived keep-alive client per provider base URL
+
+    def __init__(
+        self,
+        max_connections: int = PROVIDER_MAX_CONNECTIONS,
+        max_keepalive_connections: int = PROVIDER_MAX_KEEPALIVE,
+        keepalive_expiry: float = PROVIDER_KEEPALIVE_EXPIRY,
+        connect_timeout: float = PROVIDER_CONNECT_TIMEOUT,
+        read_timeout: float = PROVIDER_READ_TIMEOUT,
+        http2: bool = PROVIDER_HTTP2,
+    ):
+        import httpx
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.http2 = http2
+        self._clients = {}
+
+    def get(self, model_id: str, max_retries: int = None):
+        # max_retries overrides the SDK's own retries, sharing the same pool
+        base_url, api_key_env = provider_for(model_id)
+        if max_retries is not None:
+            client = self._clients.get((base_url, max_retries))
+            if client is None:
+                client = self._clients[(base_url, max_retries)] = self.get(model_id).with_options(max_retries=max_retries)
+            return client
+        client = self._clients.get(base_url)
+        if client is None:
+            import httpx
+            http_client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+            client = openai_sdk().AsyncOpenAI(
+                base_url=base_url,
+                api_key=os.getenv(api_key_env),
+                http_client=http_client,
+                timeout=self.timeout,
+            )
+            self._clients[base_url] = client
+        return client
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for key, client in clients.items():
+            # Copies made by with_options share their base client's pool
+            if isinstance(key, str):
+                await client.close()
+
+registry = None
+
+def init_providers() -> ProviderRegistry:
+    global registry
+    if registry is None:
+        registry = ProviderRegistry()
+    return registry
+
+async def close_providers():
+    global registry
+    if registry is not None:
+        await registry.aclose()
+        registry = None
@@ -0,0 +1,141 @@
+import bisect
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+
+from src.models import Message, Session as DBSession, SessionSummary, all_shards, shard_for
+from src.retention import utcnow
+
+logger = logging.getLogger(__name__)
+
+# Sessions only move once they have been idle this long, so a live
+# conversation is never caught between two databases
+RESHARD_IDLE_SECONDS = float(os.getenv("RESHARD_IDLE_SECONDS", "600"))
+RESHARD_BATCH_SIZE = int(os.getenv("RESHARD_BATCH_SIZE", "100"))
+RESHARD_BATCH_PAUSE_MS = float(os.getenv("RESHARD_BATCH_PAUSE_MS", "50"))
+
+def scan_batch(after: int, limit: int, db: Session):
+    # Sessions of one shard by id keyset
+    return db.execute(select(DBSession.id, DBSession.session_id).where(DBSession.id > after).order_by(DBSession.id).limit(limit)).all()
+
+def copy_session(pk: int, idle_before, source: Session, target: Session):
+    # Copy a session with its messages and summary to the target shard in one
+    # transaction. Returns the version copied, "busy" for a session used since
+    # idle_before, "conflict" when the target already has a different copy.
+    session = source.get(DBSession, pk)
+    if session is None:
+        return None
+    if session.last_activity is not None and session.last_activity >= idle_before:
+        return "busy"
+    existing = target.execute(select(DBSession.version).where(DBSession.session_id == session.session_id)).first()
+    if existing is not None:
+        # Copied by an earlier run that stopped before deleting the source
+        return session.version if existing.version == session.version else "conflict"
+
+    messages = source.execute(select(Message).where(Message.session_id == pk).order_by(Message.id)).scalars().all()
+    summary = source.get(SessionSummary, pk)
+    copy = DBSession(
+        session_id=session.session_id, created_at=session.created_at, version=session.version,
+        message_count=session.message_count, last_activity=session.last_activity,
+    )
+    target.add(copy)
+    target.flush()
+    # The target numbers the messages anew, in the same order
+    copies = [
+        Message(session_id=copy.id, model_id=m.model_id, role=m.role, content=m.content, created_at=m.created_at, truncated=m.truncated, pending=m.pending)
+        for m in messages
+    ]
+    target.add_all(copies)
+    target.flush()
+    if summary is not None:
+        folded = bisect.bisect_right([m.id for m in messages], summary.last_message_id)
+        target.add(SessionSummary(session_id=copy.id, summary=summary.summary, last_message_id=copies[folded - 1].id if folded else 0))
+    target.commit()
+    return session.version
+
+def delete_session(where, db: Session) -> bool:
+    # Delete the session matching `where` with its messages and summary, in
+    # one transaction. False when nothing matched (it was written meanwhile).
+    pk = db.execute(delete(DBSession).where(*where).returning(DBSession.id)).scalar()
+    if pk is None:
+        db.rollback()
+        return False
+    db.execute(delete(SessionSummary).where(SessionSummary.session_id == pk))
+    db.execute(delete(Message).where(Message.session_id == pk))
+    db.commit()
+    return True
+
+def move_session(pk: int, session_id: str, source, target, idle_before, report):
+    with source.SessionLocal() as source_db, target.SessionLocal() as target_db:
+        version = copy_session(pk, idle_before, source_db, target_db)
+        if version is None:
+            return
+        if version == "busy":
+            report["busy"] += 1
+            return
+        if version != "conflict":
+            # The copy is live from here: requests look for a session on its new
+            # shard first. A request that reached the source before that bumped
+            # its version, so the source stays and the copy goes.
+            if delete_session([DBSession.id == pk, DBSession.version == version], source_db):
+                report["moved"] += 1
+                report["messages"] += target_db.execute(select(DBSession.message_count).where(DBSession.session_id == session_id)).scalar() or 0
+                return
+            if delete_session([DBSession.session_id == session_id, DBSession.version == version], target_db):
+                report["busy"] += 1
+                return
+    # Both copies were written to; left in place for an operator
+    report["conflicts"] += 1
+    logger.warning("session %s was written on both shard %s and shard %s while moving, left on both", session_id, source.name, target.name)
+
+def reshard(idle_seconds: float = RESHARD_IDLE_SECONDS, batch_size: int = RESHARD_BATCH_SIZE, pause_ms: float = RESHARD_BATCH_PAUSE_MS, dry_run: bool = False):
+    # Move every idle session that is not on its shard under DATABASE_SHARDS,
+    # one session per transaction pair, pausing between batches
+    started = time.perf_counter()
+    idle_before = utcnow() - timedelta(seconds=idle_seconds)
+    report = {"scanned": 0, "misplaced": 0, "moved": 0, "busy": 0, "conflicts": 0, "messages": 0}
+    for source in all_shards():
+        after = 0
+        while True:
+            with source.SessionLocal() as db:
+                rows = scan_batch(after, batch_size, db)
+            report["scanned"] += len(rows)
+            for pk, session_id in rows:
+                target = shard_for(session_id)
+                if target is source:
+                    continue
+                report["misplaced"] += 1
+                if not dry_run:
+                    move_session(pk, session_id, source, target, idle_before, report)
+            if len(rows) < batch_size:
+                break
+            after = rows[-1][0]
+            time.sleep(pause_ms / 1000)
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
+if __name__ == "__main__":
+    # Move sessions to their shards after DATABASE_SHARDS changed. With the new
+    # map in DATABASE_SHARDS and the old one in DATABASE_SHARDS_PREVIOUS (the
+    # servers restarted with both), run until misplaced is 0, then drop
+    # DATABASE_SHARDS_PREVIOUS and restart again:
+    #   python -m src.reshard [--idle-seconds 600] [--batch-size 100] [--dry-run]
+    import argparse
+
+    from src.models import init_db
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--idle-seconds", type=float, default=RESHARD_IDLE_SECONDS)
+    parser.add_argument("--batch-size", type=int, default=RESHARD_BATCH_SIZE)
+    parser.add_argument("--pause-ms", type=float, default=RESHARD_BATCH_PAUSE_MS)
+    parser.add_argument("--dry-run", action="store_true", help="only count the sessions that would move")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    print(json.dumps(reshard(args.idle_seconds, args.batch_size, args.pause_ms, args.dry_run)))
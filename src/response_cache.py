@@ -0,0 +1,247 @@
+import hashlib
+import importlib.util
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+
+import anyio
+
+from src.retrieval import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Replies are only reused when they are close to deterministic: requests at or
+# below RESPONSE_CACHE_MAX_TEMPERATURE, and card-explanation turns
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_MAX_TEMPERATURE = float(os.getenv("RESPONSE_CACHE_MAX_TEMPERATURE", "0.3"))
+RESPONSE_CACHE_CARD_TURNS = os.getenv("RESPONSE_CACHE_CARD_TURNS", "1") == "1"
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "10000"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600"))
+# Semantic tier: a reply is also reused when everything but the last user
+# message matches exactly and the last message is this similar
+RESPONSE_CACHE_SEMANTIC = os.getenv("RESPONSE_CACHE_SEMANTIC", "0") == "1"
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0.92"))
+# sentence-transformers model for the semantic tier; bigram vectors when unset or not installed
+RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL")
+HAS_SENTENCE_TRANSFORMERS = importlib.util.find_spec("sentence_transformers") is not None
+
+# Rough cost of an entry's dicts and keys on top of the reply text
+ENTRY_OVERHEAD_BYTES = 400
+
+def normalize(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", text).casefold().split())
+
+def digest(*parts) -> str:
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode()).hexdigest()
+
+class BigramEmbedder:
+    # Sparse term vectors from the retrieval tokenizer, no model download needed
+
+    def embed(self, text: str):
+        counts = Counter(tokenize(text))
+        norm = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+        return {term: count / norm for term, count in counts.items()}
+
+    def similarity(self, a, b) -> float:
+        if len(a) > len(b):
+            a, b = b, a
+        return sum(weight * b.get(term, 0.0) for term, weight in a.items())
+
+class SentenceTransformerEmbedder:
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+
+    def embed(self, text: str):
+        return self.model.encode(text, normalize_embeddings=True)
+
+    def similarity(self, a, b) -> float:
+        return float(a @ b)
+
+def create_embedder():
+    if RESPONSE_CACHE_EMBEDDING_MODEL and HAS_SENTENCE_TRANSFORMERS:
+        return SentenceTransformerEmbedder(RESPONSE_CACHE_EMBEDDING_MODEL)
+    if RESPONSE_CACHE_EMBEDDING_MODEL:
+        logger.warning("sentence-transformers is not installed, using bigram vectors for the response cache")
+    return BigramEmbedder()
+
+@dataclass
+class CacheKey:
+    exact: str
+    prefix: str  # everything but the last user message, for the semantic tier
+    query: str
+    embedding: object = None
+
+@dataclass
+class CachedReply:
+    model_id: str
+    parts: list  # streamed chunks, replayed with the same boundaries
+    size: int
+    expires_at: float
+    prefix: str = ""
+    embedding: object = field(default=None, repr=False)
+
+class CachedStream:
+    # Replays a cached reply through the same interface as a provider stream
+
+    def __init__(self, model_id: str, parts):
+        self.model_id = model_id
+        self.parts = parts
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        for part in self.parts:
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=part))])
+
+    async def close(self):
+        pass
+
+class ResponseCache:
+    # LRU + TTL cache of finished replies keyed on (model_id, temperature,
+    # normalized history), with an optional semantic tier on the last message
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl: float = RESPONSE_CACHE_TTL_SECONDS,
+        semantic: bool = RESPONSE_CACHE_SEMANTIC,
+        similarity: float = RESPONSE_CACHE_SIMILARITY,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.semantic = semantic
+        self.similarity = similarity
+        self.embedder = None
+        self.entries = OrderedDict()
+        self.by_prefix = {}  # prefix -> exact keys, for semantic lookups
+        self.bytes = 0
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def eligible(self, request) -> bool:
+        if not RESPONSE_CACHE_ENABLED or not getattr(request, "use_cache", True):
+            return False
+        return request.temperature <= RESPONSE_CACHE_MAX_TEMPERATURE or (RESPONSE_CACHE_CARD_TURNS and len(request.tarot_card) > 0)
+
+    def key(self, model_id: str, temperature: float, messages) -> CacheKey:
+        normalized = [(message["role"], normalize(message["content"])) for message in messages]
+        last_user = max((i for i, (role, _) in enumerate(normalized) if role == "user"), default=len(normalized) - 1)
+        prefix = digest(model_id, round(temperature, 3), normalized[:last_user], normalized[last_user + 1:])
+        query = normalized[last_user][1] if normalized else ""
+        return CacheKey(digest(prefix, query), prefix, query)
+
+    def bypass(self):
+        with self.lock:
+            self.bypassed += 1
+
+    def lookup(self, key: CacheKey):
+        # (reply, "hit" or "semantic") or (None, None). Semantic lookups embed
+        # the query, see lookup_reply for calling this from the event loop.
+        with self.lock:
+            entry = self._get(key.exact)
+            if entry is not None:
+                self.hits += 1
+                return entry, "hit"
+            if not self.semantic:
+                self.misses += 1
+                return None, None
+
+        if self.embedder is None:
+            self.embedder = create_embedder()
+        key.embedding = self.embedder.embed(key.query)
+        with self.lock:
+            best, best_score = None, self.similarity
+            for exact in list(self.by_prefix.get(key.prefix, ())):
+                candidate = self._get(exact)
+                if candidate is None:
+                    continue
+                score = self.embedder.similarity(key.embedding, candidate.embedding)
+                if score >= best_score:
+                    best, best_score = candidate, score
+            if best is not None:
+                self.semantic_hits += 1
+                return best, "semantic"
+            self.misses += 1
+            return None, None
+
+    def store(self, key: CacheKey, model_id: str, parts):
+        size = sum(sys.getsizeof(part) for part in parts) + ENTRY_OVERHEAD_BYTES
+        with self.lock:
+            self._remove(key.exact)
+            if size > self.max_bytes:
+                return
+            self.entries[key.exact] = CachedReply(model_id, list(parts), size, time.monotonic() + self.ttl, key.prefix, key.embedding)
+            self.bytes += size
+            self.stores += 1
+            if key.embedding is not None:
+                self.by_prefix.setdefault(key.prefix, set()).add(key.exact)
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.semantic_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "bypassed": self.bypassed,
+                "hit_rate": (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+            }
+
+    def _get(self, exact: str):
+        entry = self.entries.get(exact)
+        if entry is not None and entry.expires_at < time.monotonic():
+            self._remove(exact)
+            return None
+        if entry is not None:
+            self.entries.move_to_end(exact)
+        return entry
+
+    def _remove(self, exact: str):
+        entry = self.entries.pop(exact, None)
+        if entry is not None:
+            self.bytes -= entry.size
+            self._unindex(exact, entry)
+
+    def _unindex(self, exact: str, entry: CachedReply):
+        keys = self.by_prefix.get(entry.prefix)
+        if keys is not None:
+            keys.discard(exact)
+            if not keys:
+                del self.by_prefix[entry.prefix]
+
+    def _evict(self):
+        while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+            exact, entry = self.entries.popitem(last=False)
+            self.bytes -= entry.size
+            self._unindex(exact, entry)
+            self.evictions += 1
+
+response_cache = ResponseCache()
+
+async def lookup_reply(key: CacheKey):
+    if response_cache.semantic:
+        return await anyio.to_thread.run_sync(response_cache.lookup, key)
+    return response_cache.lookup(key)
@@ -0,0 +1,267 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import delete, or_, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from src.cache import session_cache
+from src.models import JobLease, Message, Session as DBSession, SessionSummary, all_shards, engine, run_db
+
+logger = logging.getLogger(__name__)
+
+# Days a session is kept after its last activity, by session_id suffix, e.g.
+# {"_default": 30, "_rag": 30, "_memory": 90}. Suffixes not listed use
+# RETENTION_DAYS; with neither set nothing is deleted.
+RETENTION_TTL_DAYS = json.loads(os.getenv("RETENTION_TTL_DAYS") or "{}")
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS") or "0")
+RETENTION_INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+# Only the worker holding the retention lease in the first shard runs the job.
+# A holder that stops renewing it is replaced after RETENTION_LEASE_SECONDS.
+RETENTION_LEASE_SECONDS = float(os.getenv("RETENTION_LEASE_SECONDS") or str(2 * RETENTION_INTERVAL_SECONDS))
+LEASE_HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+# Sessions deleted per transaction, and the pause between transactions that
+# lets request writes through
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "200"))
+RETENTION_BATCH_PAUSE_MS = float(os.getenv("RETENTION_BATCH_PAUSE_MS", "50"))
+# When set, expired sessions are written to a gzipped NDJSON file here first
+RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR")
+# SQLite upkeep after a run: free pages returned per run (0 = all) and the
+# WAL checkpoint mode (PASSIVE never blocks writers, TRUNCATE also shrinks the file)
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "0"))
+RETENTION_CHECKPOINT = os.getenv("RETENTION_CHECKPOINT", "PASSIVE").upper()
+
+def utcnow():
+    # Naive UTC, like the database's CURRENT_TIMESTAMP
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+class RetentionStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.sessions_deleted = 0
+        self.messages_deleted = 0
+        self.summaries_deleted = 0
+        self.sessions_archived = 0
+        self.pages_freed = 0
+        self.seconds = 0.0
+        self.last_run = None
+
+    def record(self, report):
+        with self.lock:
+            self.runs += 1
+            self.sessions_deleted += report["sessions"]
+            self.messages_deleted += report["messages"]
+            self.summaries_deleted += report["summaries"]
+            self.sessions_archived += report["archived"]
+            self.pages_freed += report["pages_freed"]
+            self.seconds += report["seconds"]
+            self.last_run = report
+
+    def stats(self):
+        with self.lock:
+            return {
+                "runs": self.runs,
+                "sessions_deleted": self.sessions_deleted,
+                "messages_deleted": self.messages_deleted,
+                "summaries_deleted": self.summaries_deleted,
+                "sessions_archived": self.sessions_archived,
+                "pages_freed": self.pages_freed,
+                "seconds": self.seconds,
+            }
+
+retention_stats = RetentionStats()
+
+def retention_policies(ttl_days=None, default_days=None):
+    # [(suffix or None for the rest, cutoff)], longest suffix first
+    ttl_days = RETENTION_TTL_DAYS if ttl_days is None else ttl_days
+    default_days = RETENTION_DAYS if default_days is None else default_days
+    now = utcnow()
+    policies = [(suffix, now - timedelta(days=days)) for suffix, days in sorted(ttl_days.items(), key=lambda item: -len(item[0]))]
+    if default_days:
+        policies.append((None, now - timedelta(days=default_days)))
+    return policies
+
+def overridden_suffixes(suffix, suffixes):
+    # Suffixes whose policy takes the sessions `suffix` would otherwise match:
+    # the longer ones ending in it, or every suffix for the catch-all
+    if suffix is None:
+        return list(suffixes)
+    return [other for other in suffixes if len(other) > len(suffix) and other.endswith(suffix)]
+
+def expired_query(suffix, cutoff, others, limit: int):
+    query = select(DBSession.id, DBSession.session_id).where(DBSession.last_activity < cutoff)
+    if suffix is not None:
+        query = query.where(DBSession.session_id.endswith(suffix, autoescape=True))
+    # The longest matching suffix decides a session's TTL
+    for other in others:
+        query = query.where(~DBSession.session_id.endswith(other, autoescape=True))
+    return query.order_by(DBSession.last_activity).limit(limit)
+
+def archive_sessions(rows, path: str, db: Session):
+    # Append each session with its messages and summary as one NDJSON line
+    ids = [pk for pk, _ in rows]
+    messages = {}
+    for session_pk, role, content, model_id, truncated, created_at in db.execute(
+        select(Message.session_id, Message.role, Message.content, Message.model_id, Message.truncated, Message.created_at)
+        .where(Message.session_id.in_(ids), Message.pending.is_(False)).order_by(Message.id)
+    ):
+        messages.setdefault(session_pk, []).append({
+            "role": role, "content": content, "model_id": model_id, "truncated": truncated,
+            "created_at": created_at.isoformat() if created_at else None,
+        })
+    summaries = dict(db.execute(select(SessionSummary.session_id, SessionSummary.summary).where(SessionSummary.session_id.in_(ids))).all())
+    with gzip.open(path, "at", encoding="utf-8") as f:
+        for pk, session_id in rows:
+            f.write(json.dumps({"session_id": session_id, "summary": summaries.get(pk), "messages": messages.get(pk, [])}, ensure_ascii=False) + "\n")
+
+def delete_expired_batch(suffix, cutoff, others, limit: int, archive_path, db: Session):
+    # One short write transaction. The session delete re-checks last_activity,
+    # so a session that became active again since the select is kept.
+    rows = db.execute(expired_query(suffix, cutoff, others, limit)).all()
+    if not rows:
+        return {"selected": 0, "sessions": 0, "messages": 0, "summaries": 0, "archived": 0, "session_ids": []}
+    if archive_path:
+        archive_sessions(rows, archive_path, db)
+
+    deleted = db.execute(
+        delete(DBSession).where(DBSession.id.in_([pk for pk, _ in rows]), DBSession.last_activity < cutoff)
+        .returning(DBSession.id, DBSession.session_id)
+    ).all()
+    ids = [pk for pk, _ in deleted]
+    summaries = db.execute(delete(SessionSummary).where(SessionSummary.session_id.in_(ids))).rowcount if ids else 0
+    messages = db.execute(delete(Message).where(Message.session_id.in_(ids))).rowcount if ids else 0
+    db.commit()
+    return {
+        "selected": len(rows),
+        "sessions": len(deleted),
+        "messages": messages,
+        "summaries": summaries,
+        "archived": len(rows) if archive_path else 0,
+        "session_ids": [session_id for _, session_id in deleted],
+    }
+
+def sqlite_upkeep(bind=None, vacuum_pages: int = RETENTION_VACUUM_PAGES, checkpoint: str = RETENTION_CHECKPOINT):
+    # Hand free pages back to the filesystem and checkpoint the WAL. Incremental
+    # vacuum needs auto_vacuum=INCREMENTAL, which new databases get; an older
+    # file needs one offline VACUUM to switch.
+    bind = bind or engine
+    if bind.dialect.name != "sqlite":
+        return 0
+    with bind.connect() as conn:
+        freed = 0
+        if conn.execute(text("PRAGMA auto_vacuum")).scalar() == 2:
+            before = conn.execute(text("PRAGMA freelist_count")).scalar()
+            # Frees one page per step; executescript steps it to completion
+            conn.connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)})" if vacuum_pages else "PRAGMA incremental_vacuum")
+            freed = before - conn.execute(text("PRAGMA freelist_count")).scalar()
+        else:
+            logger.info("auto_vacuum is not INCREMENTAL, freed pages are reused but the file does not shrink until VACUUM")
+        if checkpoint in ("PASSIVE", "FULL", "RESTART", "TRUNCATE"):
+            conn.exec_driver_sql(f"PRAGMA wal_checkpoint({checkpoint})").fetchall()
+        conn.commit()
+    return freed
+
+async def run_retention(batch_size: int = RETENTION_BATCH_SIZE, pause_ms: float = RETENTION_BATCH_PAUSE_MS, archive_dir=RETENTION_ARCHIVE_DIR):
+    # Delete (and optionally archive) every expired session in bounded batches
+    started = time.perf_counter()
+    report = {"sessions": 0, "messages": 0, "summaries": 0, "archived": 0, "batches": 0, "pages_freed": 0}
+    archive_path = None
+    if archive_dir:
+        os.makedirs(archive_dir, exist_ok=True)
+        archive_path = os.path.join(archive_dir, f"sessions-{utcnow().strftime('%Y%m%dT%H%M%S')}-{os.getpid()}.jsonl.gz")
+
+    policies = retention_policies()
+    suffixes = [suffix for suffix, _ in policies if suffix is not None]
+    # Shard by shard, so only one database is being pruned at a time
+    for shard in all_shards():
+        deleted = report["sessions"]
+        for suffix, cutoff in policies:
+            others = overridden_suffixes(suffix, suffixes)
+            while True:
+                batch = await run_db(delete_expired_batch, suffix, cutoff, others, batch_size, archive_path, shard=shard)
+                report["batches"] += 1
+                for key in ("sessions", "messages", "summaries", "archived"):
+                    report[key] += batch[key]
+                for session_id in batch["session_ids"]:
+                    session_cache.invalidate(session_id)
+                if batch["selected"] < batch_size:
+                    break
+                await asyncio.sleep(pause_ms / 1000)
+
+        if report["sessions"] > deleted:
+            report["pages_freed"] += await run_db(lambda db: sqlite_upkeep(shard.engine), shard=shard)
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    retention_stats.record(report)
+    logger.info(json.dumps({"event": "retention", **report}))
+    return report
+
+def acquire_lease(name: str, holder: str, seconds: float, db: Session) -> bool:
+    # Take or renew the named lease; False while another holder's is unexpired
+    now = utcnow()
+    expires_at = now + timedelta(seconds=seconds)
+    taken = db.execute(
+        update(JobLease).where(JobLease.name == name, or_(JobLease.holder == holder, JobLease.expires_at < now))
+        .values(holder=holder, expires_at=expires_at)
+    ).rowcount
+    if not taken:
+        db.add(JobLease(name=name, holder=holder, expires_at=expires_at))
+    try:
+        db.commit()
+    except IntegrityError:
+        # Held by another process
+        db.rollback()
+        return False
+    return True
+
+def release_lease(name: str, holder: str, db: Session):
+    # Let another process take over at once, e.g. when this worker shuts down
+    db.execute(update(JobLease).where(JobLease.name == name, JobLease.holder == holder).values(expires_at=utcnow()))
+    db.commit()
+
+async def retention_loop(interval: float = RETENTION_INTERVAL_SECONDS):
+    while True:
+        try:
+            if await run_db(acquire_lease, "retention", LEASE_HOLDER, RETENTION_LEASE_SECONDS):
+                await run_retention()
+        except Exception:
+            logger.exception("retention run failed")
+        await asyncio.sleep(interval)
+
+task = None
+
+def retention_enabled() -> bool:
+    return bool(RETENTION_TTL_DAYS or RETENTION_DAYS)
+
+async def start_retention():
+    global task
+    if task is None and retention_enabled():
+        task = asyncio.create_task(retention_loop())
+
+async def stop_retention():
+    global task
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        task = None
+        try:
+            await run_db(release_lease, "retention", LEASE_HOLDER)
+        except Exception:
+            logger.exception("could not release the retention lease")
+
+if __name__ == "__main__":
+    # One run from cron or a shell: python -m src.retention
+    from src.models import init_db
+    logging.basicConfig(level=logging.INFO)
+    init_db()
+    print(json.dumps(asyncio.run(run_retention()), ensure_ascii=False))
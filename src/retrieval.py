@@ -0,0 +1,191 @@
+import gc
+import heapq
+import importlib.util
+import json
+import math
+import os
+import pickle
+import re
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from functools import cached_property
+
+from src.tarot import card_names, tarot_card_descriptions
+
+# JSONL documents ({"title": ..., "text": ...} per line) searched for passages
+# related to the user's problem
+RAG_DOCUMENTS = os.getenv("RAG_DOCUMENTS")
+# Optional pickle of the built index, rebuilt when RAG_DOCUMENTS is newer
+RAG_INDEX_CACHE = os.getenv("RAG_INDEX_CACHE")
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "3"))
+# Related passages scoring below this are left out; one shared common Thai
+# bigram scores 1-2
+RAG_MIN_SCORE = float(os.getenv("RAG_MIN_SCORE", "3.0"))
+RAG_PASSAGE_CHARS = int(os.getenv("RAG_PASSAGE_CHARS", "600"))
+RAG_MAX_POSTINGS = int(os.getenv("RAG_MAX_POSTINGS", "256"))
+RAG_MAX_QUERY_TERMS = int(os.getenv("RAG_MAX_QUERY_TERMS", "8"))
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# Use pythainlp word segmentation when it is installed, Thai character bigrams otherwise
+HAS_PYTHAINLP = importlib.util.find_spec("pythainlp") is not None
+
+TOKEN_RE = re.compile(r"[฀-๿]+|[a-z0-9]+")
+
+def tokenize(text: str):
+    tokens = []
+    for run in TOKEN_RE.findall(text.lower()):
+        if run[0] < "฀":
+            tokens.append(run)
+        elif HAS_PYTHAINLP:
+            from pythainlp.tokenize import word_tokenize
+            tokens.extend(word for word in word_tokenize(run, engine="newmm") if word.strip())
+        elif len(run) == 1:
+            tokens.append(run)
+        else:
+            tokens.extend(map(str.__add__, run, run[1:]))
+    return tokens
+
+@dataclass
+class Passage:
+    title: str
+    text: str
+
+    @cached_property
+    def rendered(self):
+        return f"{self.title}: {self.text}"
+
+    def prompt(self):
+        # Rendered once, passages are shared by every request
+        return self.rendered
+
+class BM25Index:
+    # In-memory BM25 over short passages. Per-posting weights are precomputed at
+    # build time and each posting list keeps only its RAG_MAX_POSTINGS heaviest
+    # entries (static pruning), so query cost stays flat as the corpus grows.
+
+    def __init__(self, passages, max_postings: int = RAG_MAX_POSTINGS):
+        # Millions of small tuples would otherwise trigger repeated full GC passes
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            self._build(passages, max_postings)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+
+    def _build(self, passages, max_postings: int):
+        self.passages = list(passages)
+
+        doc_terms = []
+        doc_freq = Counter()
+        for passage in self.passages:
+            terms = Counter(tokenize(f"{passage.title} {passage.text}"))
+            doc_terms.append(terms)
+            doc_freq.update(terms.keys())
+
+        total = len(self.passages)
+        self.idf = {term: math.log(1 + (total - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()}
+        lengths = [sum(terms.values()) for terms in doc_terms]
+        # 1 when no passage has a single token, which would otherwise divide by 0
+        avg_length = (sum(lengths) / total if total else 0.0) or 1.0
+
+        postings = defaultdict(list)
+        k1 = BM25_K1 + 1
+        for doc_id, terms in enumerate(doc_terms):
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc_id] / avg_length)
+            for term, tf in terms.items():
+                postings[term].append((tf * k1 / (tf + norm), doc_id))
+
+        self.postings = {}
+        for term, entries in postings.items():
+            if len(entries) > max_postings:
+                entries = heapq.nlargest(max_postings, entries)
+            idf = self.idf[term]
+            self.postings[term] = [(doc_id, idf * weight) for weight, doc_id in entries]
+
+    def search(self, query: str, k: int = RAG_TOP_K, min_score: float = RAG_MIN_SCORE):
+        # Score only the most selective query terms, long problem statements are noisy
+        terms = heapq.nlargest(RAG_MAX_QUERY_TERMS, set(tokenize(query)) & self.idf.keys(), key=self.idf.__getitem__)
+        scores = {}
+        get = scores.get
+        for term in terms:
+            for doc_id, weight in self.postings[term]:
+                scores[doc_id] = get(doc_id, 0.0) + weight
+        best = heapq.nlargest(k, scores, key=scores.__getitem__)
+        return [self.passages[doc_id] for doc_id in best if scores[doc_id] >= min_score]
+
+class RagIndex:
+    # The drawn cards' passages by name, and a BM25 index over RAG_DOCUMENTS
+    # for related passages. Cards are kept out of the search, or the model would
+    # be shown cards the user did not draw.
+
+    def __init__(self, cards, documents):
+        self.cards = {}
+        for passage in cards:
+            self.cards.setdefault(passage.title, []).append(passage)
+        self.documents = BM25Index(documents)
+
+    def retrieve(self, query: str, titles=(), k: int = RAG_TOP_K):
+        # Passages of the named cards, then up to k document passages for the query
+        pinned = [passage for title in titles for passage in self.cards.get(title, ())]
+        related = self.documents.search(f"{query} {' '.join(titles)}", k)
+        return pinned, related
+
+def split_passages(title: str, text: str, max_chars: int = RAG_PASSAGE_CHARS):
+    # Paragraph-sized passages so one long document does not dominate the prompt
+    passages = []
+    current = ""
+    for paragraph in (p.strip() for p in text.split("\n")):
+        if not paragraph:
+            continue
+        if current and len(current) + len(paragraph) > max_chars:
+            passages.append(Passage(title, current))
+            current = ""
+        current = f"{current}\n{paragraph}" if current else paragraph
+    if current:
+        passages.append(Passage(title, current))
+    return passages
+
+def load_documents(path: str):
+    passages = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                document = json.loads(line)
+                passages.extend(split_passages(document["title"], document["text"]))
+    return passages
+
+def tarot_passages():
+    return [Passage(card["card_name"], card["card_description"]) for card in tarot_card_descriptions]
+
+def build_index() -> RagIndex:
+    return RagIndex(tarot_passages(), load_documents(RAG_DOCUMENTS) if RAG_DOCUMENTS else [])
+
+def load_or_build_index(cache_path: str) -> RagIndex:
+    # Large document sets take seconds to tokenize, so reuse the pickled index
+    # until the documents file changes
+    source_mtime = os.path.getmtime(RAG_DOCUMENTS) if RAG_DOCUMENTS else 0
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= source_mtime:
+        with open(cache_path, "rb") as f:
+            cached = pickle.load(f)
+        # Caches from before the cards were kept apart are rebuilt
+        if isinstance(cached, RagIndex):
+            return cached
+    built = build_index()
+    with open(cache_path, "wb") as f:
+        pickle.dump(built, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return built
+
+index = None
+
+def get_index() -> RagIndex:
+    global index
+    if index is None:
+        index = load_or_build_index(RAG_INDEX_CACHE) if RAG_INDEX_CACHE else build_index()
+        # Card passages go into every /chat/rag card turn, render them up front
+        for title in card_names:
+            for passage in index.cards.get(title, ()):
+                passage.prompt()
+    return index
@@ -0,0 +1,233 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from dataclasses import dataclass
+from urllib.parse import urlparse
+
+from src.admission import get_admission, retry_after
+from src.metrics import metrics
+from src.providers import init_providers, is_rate_limit, provider_for
+
+logger = logging.getLogger(__name__)
+
+# Models tried, in order, when the requested one is failing or much slower,
+# e.g. {"typhoon-v1.5x-70b-instruct": ["llama-3.1-70b-versatile"]}
+MODEL_FALLBACKS = json.loads(os.getenv("MODEL_FALLBACKS") or "{}")
+# Start a second request when the first has produced no token after this
+# long and stream whichever answers first. 0 disables hedging.
+ROUTING_HEDGE_MS = float(os.getenv("ROUTING_HEDGE_MS", "0"))
+# Rolling TTFT and error rate are exponentially weighted moving averages
+ROUTING_EWMA_ALPHA = float(os.getenv("ROUTING_EWMA_ALPHA", "0.2"))
+# A model whose error rate is above this is skipped until it has been
+# error-free for ROUTING_COOLDOWN_SECONDS
+ROUTING_MAX_ERROR_RATE = float(os.getenv("ROUTING_MAX_ERROR_RATE", "0.5"))
+ROUTING_COOLDOWN_SECONDS = float(os.getenv("ROUTING_COOLDOWN_SECONDS", "30"))
+# A fallback is preferred when the requested model's TTFT is this many times
+# its own, once both have ROUTING_MIN_SAMPLES measurements
+ROUTING_LATENCY_FACTOR = float(os.getenv("ROUTING_LATENCY_FACTOR", "2.0"))
+ROUTING_MIN_SAMPLES = int(os.getenv("ROUTING_MIN_SAMPLES", "5"))
+
+@dataclass
+class ModelHealth:
+    ttft: float = 0.0  # seconds
+    error_rate: float = 0.0
+    samples: int = 0
+    errors: int = 0
+    last_error_at: float = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return self.error_rate <= ROUTING_MAX_ERROR_RATE or now - self.last_error_at > ROUTING_COOLDOWN_SECONDS
+
+    def measured(self) -> bool:
+        return self.samples >= ROUTING_MIN_SAMPLES
+
+class RoutedStream:
+    # A provider stream whose first chunks were read while racing other
+    # attempts. Iterates like the openai AsyncStream it wraps.
+
+    def __init__(self, model_id: str, response, iterator, buffered):
+        self.model_id = model_id
+        self.response = response
+        self.iterator = iterator
+        self.buffered = buffered
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        buffered, self.buffered = self.buffered, []
+        for chunk in buffered:
+            yield chunk
+        async for chunk in self.iterator:
+            yield chunk
+
+    async def close(self):
+        await self.response.close()
+
+class Router:
+    # Picks the model to call from rolling per-model TTFT and error rates,
+    # fails over to MODEL_FALLBACKS and optionally hedges slow first tokens
+
+    def __init__(self, fallbacks=None, hedge_ms: float = ROUTING_HEDGE_MS):
+        self.fallbacks = MODEL_FALLBACKS if fallbacks is None else fallbacks
+        self.hedge_ms = hedge_ms
+        self.health = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.fallbacks_served = 0
+
+    def model_health(self, model_id: str) -> ModelHealth:
+        health = self.health.get(model_id)
+        if health is None:
+            health = self.health[model_id] = ModelHealth()
+        return health
+
+    def record_ttft(self, model_id: str, seconds: float):
+        health = self.model_health(model_id)
+        health.ttft = seconds if not health.samples else health.ttft + ROUTING_EWMA_ALPHA * (seconds - health.ttft)
+        health.error_rate -= ROUTING_EWMA_ALPHA * health.error_rate
+        health.samples += 1
+
+    def record_error(self, model_id: str):
+        health = self.model_health(model_id)
+        health.error_rate += ROUTING_EWMA_ALPHA * (1 - health.error_rate)
+        health.errors += 1
+        health.last_error_at = time.monotonic()
+
+    def candidates(self, model_id: str):
+        # Requested model first unless it is failing or much slower than a fallback
+        now = time.monotonic()
+        models = [model_id] + [fallback for fallback in self.fallbacks.get(model_id, []) if fallback != model_id]
+        ordered = [m for m in models if self.model_health(m).healthy(now)] + [m for m in models if not self.model_health(m).healthy(now)]
+        first = self.model_health(ordered[0])
+        if first.measured():
+            faster = [m for m in ordered[1:] if self.model_health(m).healthy(now) and self.model_health(m).measured()
+                      and self.model_health(m).ttft * ROUTING_LATENCY_FACTOR < first.ttft]
+            if faster:
+                ordered.remove(faster[0])
+                ordered.insert(0, faster[0])
+        return ordered
+
+    async def first_token(self, model_id: str, messages, temperature: float, retries: bool = True) -> RoutedStream:
+        # Open a stream and read up to its first content chunk. Without
+        # retries, errors surface at once so the router can fail over.
+        started = time.perf_counter()
+        response = None
+        try:
+            client = init_providers().get(model_id, None if retries else 0)
+            response = await client.chat.completions.create(
+                model=model_id,
+                messages=messages,
+                temperature=temperature,
+                stream=True
+            )
+            iterator = response.__aiter__()
+            buffered = []
+            async for chunk in iterator:
+                buffered.append(chunk)
+                if chunk.choices and chunk.choices[0].delta.content is not None:
+                    break
+        except asyncio.CancelledError:
+            # A lost hedge race is recorded by open(); a client that went away
+            # says nothing about the provider
+            if response is not None:
+                await response.close()
+            raise
+        except Exception as e:
+            self.record_error(model_id)
+            if is_rate_limit(e):
+                # Hold new requests to this provider instead of adding to its quota
+                get_admission().throttle(model_id, retry_after(e))
+            metrics.observe_upstream(model_id, "error", time.perf_counter() - started)
+            if response is not None:
+                await response.close()
+            raise
+        elapsed = time.perf_counter() - started
+        self.record_ttft(model_id, elapsed)
+        metrics.observe_upstream(model_id, "ok", elapsed)
+        return RoutedStream(model_id, response, iterator, buffered)
+
+    async def open(self, model_id: str, messages, temperature: float) -> RoutedStream:
+        candidates = self.candidates(model_id)
+        remaining = list(candidates)
+        pending = {}  # task -> (model_id, is the hedge, started)
+        hedge = None
+        winner = None
+        error = None
+
+        def launch(target: str, is_hedge: bool = False):
+            task = asyncio.create_task(self.first_token(target, messages, temperature, retries=len(candidates) == 1))
+            pending[task] = (target, is_hedge, time.perf_counter())
+            return task
+
+        launch(remaining.pop(0))
+        try:
+            while pending and winner is None:
+                timeout = self.hedge_ms / 1000 if self.hedge_ms and hedge is None else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # No token yet, race a second request: the next fallback or the same model again
+                    self.hedges += 1
+                    hedge = launch(remaining.pop(0) if remaining else candidates[0], is_hedge=True)
+                    continue
+                for task in done:
+                    target, is_hedge, _ = pending.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        logger.warning("upstream %s failed: %r", target, error)
+                    elif winner is None:
+                        winner = task.result()
+                        self.hedge_wins += is_hedge
+                    else:
+                        await task.result().close()
+                if winner is None and not pending and remaining:
+                    self.failovers += 1
+                    launch(remaining.pop(0))
+        finally:
+            # Cancel the losers, which closes their upstream streams
+            now = time.perf_counter()
+            for task, (target, _, started) in pending.items():
+                task.cancel()
+                if winner is not None:
+                    # Lost the hedge race, its TTFT is at least this long
+                    self.record_ttft(target, now - started)
+                    metrics.observe_upstream(target, "lost", now - started)
+            if pending:
+                await asyncio.wait(pending)
+
+        if winner is None:
+            raise error
+        if winner.model_id != model_id:
+            self.fallbacks_served += 1
+        return winner
+
+    def stats(self):
+        return {
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "fallbacks_served": self.fallbacks_served,
+        }
+
+    def models(self):
+        return {
+            model_id: {
+                "provider": urlparse(provider_for(model_id)[0]).netloc,
+                "ttft_ms": round(health.ttft * 1000, 1),
+                "error_rate": round(health.error_rate, 3),
+                "samples": health.samples,
+                "errors": health.errors,
+            }
+            for model_id, health in self.health.items()
+        }
+
+router = None
+
+def get_router() -> Router:
+    global router
+    if router is None:
+        router = Router()
+    return router
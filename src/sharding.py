@@ -0,0 +1,36 @@
+import bisect
+import hashlib
+import json
+import os
+
+# Points per shard on the hash ring. More points spread sessions more evenly;
+# adding a shard moves about 1/N of the sessions either way.
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "128"))
+
+def parse_shards(value, default_url: str = None):
+    # DATABASE_SHARDS: a JSON list of URLs, named by position ("0", "1", ...),
+    # or an object of name -> URL. Names place shards on the ring, so keep a
+    # shard's name when its URL changes. Unset means one shard, default_url.
+    if not value:
+        return {"0": default_url} if default_url else {}
+    shards = json.loads(value)
+    if isinstance(shards, list):
+        shards = {str(i): url for i, url in enumerate(shards)}
+    if not isinstance(shards, dict) or not shards:
+        raise ValueError("DATABASE_SHARDS must be a non-empty JSON list of URLs or object of name -> URL")
+    return {str(name): url for name, url in shards.items()}
+
+def ring_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    # Consistent hashing of session ids onto shard names
+
+    def __init__(self, names, vnodes: int = SHARD_VNODES):
+        points = sorted((ring_hash(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self.hashes = [point for point, _ in points]
+        self.names = [name for _, name in points]
+
+    def node(self, key: str) -> str:
+        i = bisect.bisect(self.hashes, ring_hash(key))
+        return self.names[i % len(self.names)]
@@ -0,0 +1,201 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import AsyncGenerator
+
+import anyio
+from fastapi.responses import StreamingResponse
+
+from src.persistence import get_writer
+from src.response_cache import response_cache
+
+logger = logging.getLogger(__name__)
+
+# Event streams (SSE or NDJSON) batch provider deltas into one write per
+# STREAM_FLUSH_MS or STREAM_FLUSH_BYTES of text, whichever comes first
+STREAM_FLUSH_MS = float(os.getenv("STREAM_FLUSH_MS", "20"))
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES", "256"))
+
+class StreamStats:
+    # Counters for streams the client abandoned before the provider finished.
+    # Saved tokens are estimated from the average length of completed replies,
+    # counting one provider chunk as one token.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.completed_tokens = 0
+        self.cancelled = 0
+        self.cancelled_tokens = 0
+        self.tokens_saved = 0
+        self.errors = 0
+        self.event_streams = 0
+        self.event_deltas = 0
+        self.event_writes = 0
+
+    def record_completed(self, tokens: int):
+        with self.lock:
+            self.completed += 1
+            self.completed_tokens += tokens
+
+    def record_cancelled(self, tokens: int):
+        with self.lock:
+            self.cancelled += 1
+            self.cancelled_tokens += tokens
+            if self.completed:
+                self.tokens_saved += max(0, round(self.completed_tokens / self.completed) - tokens)
+
+    def record_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def record_events(self, deltas: int, writes: int):
+        with self.lock:
+            self.event_streams += 1
+            self.event_deltas += deltas
+            self.event_writes += writes
+
+    def stats(self):
+        with self.lock:
+            return {
+                "completed": self.completed,
+                "cancelled": self.cancelled,
+                "errors": self.errors,
+                "completed_tokens_streamed": self.completed_tokens,
+                "cancelled_tokens_streamed": self.cancelled_tokens,
+                "tokens_saved": self.tokens_saved,
+                "event_streams": self.event_streams,
+                "event_deltas": self.event_deltas,
+                "event_writes": self.event_writes,
+            }
+
+stream_stats = StreamStats()
+
+async def generate_streaming_response(response, db_session_id: int, reply_id: int, request, timer=None, cache_key=None, ticket=None, shard=None) -> AsyncGenerator[str, None]:
+    parts = []
+    first_token_at = None
+    completed = False
+    failed = False
+    try:
+        async for chunk in response:
+            if not chunk.choices:
+                continue
+            message = chunk.choices[0].delta.content
+            if message is not None:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                parts.append(message)
+                yield message
+        completed = True
+    except Exception:
+        failed = True
+        raise
+    finally:
+        # Runs on normal completion, on upstream errors and when the client goes away
+        with anyio.CancelScope(shield=True):
+            if completed:
+                stream_stats.record_completed(len(parts))
+                if cache_key is not None and parts:
+                    response_cache.store(cache_key, getattr(response, "model_id", request.model_id), parts)
+            else:
+                # Stop the provider generating output nobody will read
+                await response.close()
+                if failed:
+                    stream_stats.record_error()
+                else:
+                    stream_stats.record_cancelled(len(parts))
+                    logger.info("client disconnected from session %s after %d chunks", request.session_id, len(parts))
+
+            # Hand the response to the write-behind queue to fill in the row reserved
+            # with the turn, flagging cut-off replies and dropping the row if nothing came
+            await get_writer().submit(
+                request.session_id, db_session_id, reply_id, "".join(parts) if completed or parts else None,
+                getattr(response, "model_id", request.model_id), truncated=not completed, shard=shard,
+            )
+
+            if ticket is not None:
+                # Free the provider slot and charge the reply to the token budget
+                ticket.release(len(parts))
+
+            if timer is not None:
+                timer.finish("completed" if completed else "error" if failed else "cancelled", len(parts), first_token_at)
+
+class ChatStreamingResponse(StreamingResponse):
+    # Starlette cancels the send loop when the client disconnects but leaves the
+    # body generator suspended. Closing it here runs its cleanup immediately.
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.body_iterator.aclose()
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, separators=(',', ':'))}\n\n"
+
+def ndjson_event(event: str, data: dict) -> str:
+    return json.dumps({"type": event, **data}, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+# format -> (media type, encoder)
+STREAM_FORMATS = {
+    "sse": ("text/event-stream", sse_event),
+    "ndjson": ("application/x-ndjson", ndjson_event),
+}
+
+async def stream_events(reply, format: str, usage: dict, flush_ms: float = STREAM_FLUSH_MS, flush_bytes: int = STREAM_FLUSH_BYTES):
+    # A reply as delta events, then usage and done, or an error event if the
+    # provider fails midway. The first delta goes out at once; later ones are
+    # held until flush_ms after the oldest held one or flush_bytes of text.
+    encode = STREAM_FORMATS[format][1]
+    held, held_bytes, deadline = [], 0, None
+    deltas = writes = characters = 0
+
+    def flush():
+        nonlocal held, held_bytes, writes
+        text = "".join(held)
+        held, held_bytes = [], 0
+        writes += 1
+        return encode("delta", {"text": text})
+
+    try:
+        while True:
+            if held:
+                # Wait for the next delta no longer than the flush deadline
+                try:
+                    with anyio.move_on_at(deadline) as scope:
+                        part = await anext(reply)
+                except StopAsyncIteration:
+                    break
+                if scope.cancelled_caught:
+                    yield flush()
+                    continue
+            else:
+                try:
+                    part = await anext(reply)
+                except StopAsyncIteration:
+                    break
+            deltas += 1
+            characters += len(part)
+            if not held:
+                deadline = anyio.current_time() + flush_ms / 1000
+            held.append(part)
+            held_bytes += len(part.encode())
+            if deltas == 1 or held_bytes >= flush_bytes:
+                yield flush()
+    except Exception as e:
+        if held:
+            yield flush()
+        writes += 1
+        yield encode("error", {"message": str(e)})
+    else:
+        if held:
+            yield flush()
+        writes += 2
+        yield encode("usage", {**usage, "completion_chunks": deltas, "completion_characters": characters})
+        yield encode("done", {})
+    finally:
+        stream_stats.record_events(deltas, writes)
+        await reply.aclose()
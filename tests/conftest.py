@@ -0,0 +1,26 @@
+import pytest
+
+import src.models as models
+from src.models import create_shards, init_db
+from src.sharding import HashRing
+
+@pytest.fixture
+def sqlite_shards(tmp_path, monkeypatch):
+    # Point src.models at fresh SQLite shards in tmp_path, e.g.
+    # sqlite_shards(["0", "1", "2"], previous=["0", "1"]) in the middle of a reshard
+    def configure(names=("0",), previous=None):
+        current = {name: f"sqlite:///{tmp_path / f'shard{name}.db'}" for name in names}
+        before = {name: f"sqlite:///{tmp_path / f'shard{name}.db'}" for name in previous or ()}
+        shards = create_shards(current, before)
+        for shard in shards.values():
+            init_db(shard.engine)
+        monkeypatch.setattr(models, "shards", shards)
+        monkeypatch.setattr(models, "ring", HashRing(current))
+        monkeypatch.setattr(models, "previous_ring", HashRing(before) if before else None)
+        monkeypatch.setattr(models, "default_shard", shards[next(iter(current))])
+        # A limiter made on another test's event loop
+        monkeypatch.setattr(models, "_db_limiter", None)
+        return shards
+
+    yield configure
+    models.dispose_engines()
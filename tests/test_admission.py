@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from src.admission import Admission, Overloaded
+
+TYPHOON = "typhoon-v1.5x-70b-instruct"
+GROQ = "llama-3.1-70b-versatile"
+
+def one_stream_each():
+    return Admission(limits={"api.opentyphoon.ai": {"concurrency": 1}, "api.groq.com": {"concurrency": 1}},
+                     queue_size=1, session_queue=1, max_wait_ms=1000)
+
+def test_full_provider_does_not_turn_away_others():
+    async def scenario():
+        admission = one_stream_each()
+        busy = await admission.admit(TYPHOON, "a")
+        waiting = asyncio.create_task(admission.admit(TYPHOON, "b"))
+        await asyncio.sleep(0)
+        # Typhoon's queue is full, for every session
+        with pytest.raises(Overloaded) as rejected:
+            await admission.admit(TYPHOON, "c")
+        assert rejected.value.status_code == 503
+
+        # Groq has a free stream: admitted at once, not queued behind Typhoon
+        ticket = await asyncio.wait_for(admission.admit(GROQ, "c"), 0.1)
+        assert admission.stats()["queued"] == 1
+
+        # Session b may still queue for Groq while it waits for Typhoon
+        groq_waiter = asyncio.create_task(admission.admit(GROQ, "b"))
+        await asyncio.sleep(0)
+        assert admission.stats()["queued"] == 2
+        ticket.release()
+        (await groq_waiter).release()
+
+        busy.release()
+        (await waiting).release()
+        assert admission.stats()["queued"] == 0
+        assert admission.stats()["in_flight"] == 0
+
+    asyncio.run(scenario())
+
+def test_waiters_keep_their_turn_within_a_provider():
+    async def scenario():
+        admission = Admission(limits={"api.groq.com": {"concurrency": 1}}, queue_size=4, session_queue=1, max_wait_ms=1000)
+        busy = await admission.admit(GROQ, "a")
+        first = asyncio.create_task(admission.admit(GROQ, "b"))
+        await asyncio.sleep(0)
+        second = asyncio.create_task(admission.admit(GROQ, "c"))
+        await asyncio.sleep(0)
+        # Typhoon's free capacity is not held up by Groq's queue
+        (await asyncio.wait_for(admission.admit(TYPHOON, "d"), 0.1)).release()
+
+        busy.release()
+        ticket = await first
+        assert not second.done()
+        ticket.release()
+        (await second).release()
+        assert admission.stats()["admitted"] == 4
+
+    asyncio.run(scenario())
@@ -0,0 +1,34 @@
+from src.cache import SessionCache
+
+def message(message_id: int, role: str = "user", content: str = "สวัสดี"):
+    return {"id": message_id, "role": role, "content": content}
+
+def test_append_needs_the_previous_version():
+    cache = SessionCache()
+    assert cache.put("s", 1, 1, [message(1)])
+    assert [m["id"] for m in cache.append("s", 2, [message(2)])] == [1, 2]
+    # Another worker wrote version 3: this entry can no longer be trusted
+    assert cache.append("s", 4, [message(5)]) is None
+    assert cache.get("s") is None
+    assert cache.stats()["invalidations"] == 1
+
+def test_reply_filled_in_late_keeps_id_order():
+    cache = SessionCache()
+    cache.put("s", 1, 1, [message(1)])
+    # The next turn (3) was saved before the reply reserved as 2 was filled in
+    cache.append("s", 2, [message(3)])
+    history = cache.append("s", 3, [message(2, "assistant")])
+    assert [m["id"] for m in history] == [1, 2, 3]
+
+def test_oversized_sessions_are_remembered():
+    cache = SessionCache(max_entry_bytes=2000, ttl=60)
+    assert cache.put("s", 1, 1, [message(1)])
+    assert cache.append("s", 2, [message(2, content="ก" * 5000)]) is None
+    assert cache.get("s") is None
+    assert cache.is_oversized("s")
+    assert not cache.put("big", 2, 1, [message(1, content="ก" * 5000)])
+    assert cache.is_oversized("big")
+    # Deleting its history makes it cacheable again
+    cache.invalidate("big")
+    assert not cache.is_oversized("big")
+    assert cache.stats()["oversized_skips"] == 2
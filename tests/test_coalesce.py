@@ -0,0 +1,96 @@
+import asyncio
+
+import pytest
+
+from src.coalesce import Flights, SessionLocks, SingleFlight
+
+def source(items, opened, delay: float = 0.01):
+    async def open():
+        opened.append(True)
+        closed = []
+
+        async def iterate():
+            for item in items:
+                await asyncio.sleep(delay)
+                yield item
+
+        async def close():
+            closed.append(True)
+
+        return "meta", iterate(), close
+    return open
+
+def test_identical_requests_share_one_source():
+    async def scenario():
+        flights, opened = Flights(), []
+        first, second = await asyncio.gather(
+            flights.subscribe("k", source(["a", "b", "c"], opened)),
+            flights.subscribe("k", source(["x"], opened)),
+        )
+        assert (first.coalesced, second.coalesced) == (False, True)
+        assert first.meta == second.meta == "meta"
+        async def read(subscription):
+            return [item async for item in subscription]
+
+        results = await asyncio.gather(read(first), read(second))
+        await first.close()
+        await second.close()
+        return opened, results, flights.stats()
+
+    opened, results, stats = asyncio.run(scenario())
+    assert len(opened) == 1
+    assert results == [["a", "b", "c"], ["a", "b", "c"]]
+    assert stats == {"started": 1, "coalesced": 1, "in_flight": 0}
+
+def test_source_runs_until_its_last_subscriber_leaves():
+    async def scenario():
+        flights, opened = Flights(), []
+        first = await flights.subscribe("k", source(range(100), opened))
+        second = await flights.subscribe("k", source([], opened))
+        await first.close()
+        assert not first.flight.task.done()
+        assert await second.__anext__() == 0
+        await second.close()
+        await asyncio.sleep(0)
+        return first.flight
+
+    flight = asyncio.run(scenario())
+    assert flight.task.cancelled() or flight.done
+
+def test_single_flight_shares_the_result_and_the_error():
+    async def scenario():
+        single, calls = SingleFlight(), []
+
+        async def work(value):
+            calls.append(value)
+            await asyncio.sleep(0.01)
+            if value == "boom":
+                raise ValueError(value)
+            return value
+
+        assert await asyncio.gather(single.do("s", work, 1), single.do("s", work, 2)) == [1, 1]
+        with pytest.raises(ValueError):
+            await asyncio.gather(single.do("e", work, "boom"), single.do("e", work, "boom"))
+        return calls, single.stats()
+
+    calls, stats = asyncio.run(scenario())
+    assert calls == [1, "boom"]
+    assert stats == {"started": 2, "coalesced": 2, "in_flight": 0}
+
+def test_session_locks_serialize_one_session_only():
+    async def scenario():
+        locks, order = SessionLocks(), []
+
+        async def write(key, name):
+            async with locks.hold(key):
+                order.append(f"{name} start")
+                await asyncio.sleep(0.01)
+                order.append(f"{name} end")
+
+        await asyncio.gather(write("a", "a1"), write("a", "a2"), write("b", "b1"))
+        return order, locks.stats()
+
+    order, stats = asyncio.run(scenario())
+    assert order.index("a1 end") < order.index("a2 start")
+    assert order.index("b1 start") < order.index("a1 end")
+    assert stats == {"held": 0, "contended": 1}
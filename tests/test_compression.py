@@ -0,0 +1,45 @@
+from sqlalchemy import select
+
+from src.compression import Codec, build_zlib_dictionary, content_length, stored_length
+from src.models import Message, Session as DBSession
+
+LONG = "ไพ่ The Star หมายถึงความหวังและการเริ่มต้นใหม่ค่ะ " * 20
+
+def test_codec_round_trips_and_leaves_short_text_alone():
+    codec = Codec("zlib", min_bytes=256)
+    assert codec.compress("สั้น") == "สั้น"
+    packed = codec.compress(LONG)
+    assert isinstance(packed, bytes) and len(packed) < len(LONG.encode("utf-8"))
+    assert codec.decompress(packed) == LONG
+    assert content_length(packed) == len(LONG)
+    # Off: stored as text
+    assert Codec("none").compress(LONG) == LONG
+
+def test_dictionary_content_needs_its_dictionary():
+    samples = [LONG, "ความรักของคุณจะสดใส ไพ่ The Lovers หมายถึงความรักค่ะ " * 5]
+    dictionary = build_zlib_dictionary(samples)
+    with_dictionary = Codec("zlib", min_bytes=16, dictionaries=[dictionary])
+    packed = with_dictionary.compress(samples[1])
+    assert with_dictionary.decompress(packed) == samples[1]
+    # Any process given the dictionary can read it; one without it refuses
+    assert Codec("zlib", dictionaries=[b"other", dictionary]).decompress(packed) == samples[1]
+    try:
+        Codec("zlib", dictionaries=[]).decompress(packed)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("decompressed without the dictionary")
+
+def test_column_compresses_on_sqlite_and_reads_both_forms(sqlite_shards):
+    (shard,) = sqlite_shards().values()
+    with shard.SessionLocal() as db:
+        session = DBSession(session_id="a_default")
+        db.add(session)
+        db.flush()
+        db.add_all([Message(session_id=session.id, role="assistant", content=LONG), Message(session_id=session.id, role="user", content="สั้น")])
+        db.commit()
+        raw = db.connection().exec_driver_sql("SELECT content FROM messages ORDER BY id").scalars().all()
+        assert isinstance(raw[0], bytes) and raw[1] == "สั้น"
+        assert db.execute(select(Message.content).order_by(Message.id)).scalars().all() == [LONG, "สั้น"]
+        # Lengths in characters without decompressing
+        assert db.execute(select(stored_length(Message.content)).order_by(Message.id)).scalars().all() == [len(LONG), len("สั้น")]
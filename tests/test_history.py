@@ -0,0 +1,28 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from src.app import delete_chat_history, view_chat_history
+from src.models import Message, Session as DBSession
+
+def test_delete_history(sqlite_shards):
+    (shard,) = sqlite_shards().values()
+    with shard.SessionLocal() as db:
+        session = DBSession(session_id="a_default", message_count=1, version=1)
+        db.add(session)
+        db.flush()
+        db.add(Message(session_id=session.id, role="user", content="สวัสดี"))
+        db.commit()
+
+    assert asyncio.run(delete_chat_history("a_default")) == {"message": "Chat history deleted successfully"}
+    history = asyncio.run(view_chat_history("a_default", after=0, limit=None, format="json"))
+    assert history["history"] == []
+
+    # An unknown session is a 404, like /view_history
+    with pytest.raises(HTTPException) as missing:
+        asyncio.run(delete_chat_history("missing"))
+    assert missing.value.status_code == 404
+    with pytest.raises(HTTPException) as missing:
+        asyncio.run(view_chat_history("missing", after=0, limit=None, format="json"))
+    assert missing.value.status_code == 404
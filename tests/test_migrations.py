@@ -0,0 +1,46 @@
+from sqlalchemy import inspect, select, text
+
+from src.migrations import latest_version, migrate
+from src.models import Message, Session as DBSession, bump_session_version, create_db_engine
+
+LEGACY_SCHEMA = [
+    "CREATE TABLE sessions (id INTEGER PRIMARY KEY, session_id VARCHAR NOT NULL UNIQUE)",
+    "CREATE TABLE messages (id INTEGER PRIMARY KEY, session_id INTEGER NOT NULL, model_id VARCHAR, role VARCHAR NOT NULL, content TEXT NOT NULL)",
+]
+
+def test_legacy_database_upgrades_to_latest(tmp_path):
+    engine = create_db_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    with engine.begin() as conn:
+        for statement in LEGACY_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO sessions (id, session_id) VALUES (1, 'a_default'), (2, 'b_default')"))
+        conn.execute(text("INSERT INTO messages (session_id, role, content) VALUES (1, 'user', 'hi'), (1, 'assistant', 'hello'), (2, 'user', 'hey')"))
+
+    migrate(engine)
+    # Safe to run again, as a second worker might
+    migrate(engine)
+
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() == latest_version()
+        sessions = {column["name"] for column in inspect(conn).get_columns("sessions")}
+        messages = {column["name"] for column in inspect(conn).get_columns("messages")}
+        indexes = {index["name"] for index in inspect(conn).get_indexes("sessions")}
+    assert {"version", "message_count", "last_activity"} <= sessions
+    assert "last_message_id" not in sessions
+    assert {"created_at", "truncated", "pending"} <= messages
+    assert indexes == {"ix_sessions_last_activity_id"}
+
+    with engine.connect() as conn:
+        rows = conn.execute(select(DBSession.session_id, DBSession.message_count, DBSession.last_activity).order_by(DBSession.id)).all()
+    assert [(session_id, count) for session_id, count, _ in rows] == [("a_default", 2), ("b_default", 1)]
+    # Backfilled, so retention can expire them
+    assert all(last_activity is not None for _, _, last_activity in rows)
+
+    # Legacy plain-text rows read back next to new ones
+    with engine.connect() as conn:
+        conn.execute(Message.__table__.insert().values(session_id=1, role="user", content="again" * 100))
+        assert bump_session_version(1, conn, 1) == 1
+        contents = conn.execute(select(Message.content).where(Message.session_id == 1).order_by(Message.id)).scalars().all()
+        conn.commit()
+    assert contents == ["hi", "hello", "again" * 100]
+    engine.dispose()
@@ -0,0 +1,51 @@
+import asyncio
+
+from sqlalchemy import select
+
+from src.cache import session_cache
+from src.models import Message, Session as DBSession
+from src.persistence import MessageWriter
+
+def reserve(db, session_id: str, turns: int):
+    # Each turn is a user message with its reply row reserved behind it
+    session = DBSession(session_id=session_id, message_count=turns, version=turns)
+    db.add(session)
+    db.flush()
+    replies = []
+    for turn in range(turns):
+        db.add(Message(session_id=session.id, role="user", content=f"turn {turn}"))
+        reply = Message(session_id=session.id, role="assistant", content="", pending=True)
+        db.add(reply)
+        db.flush()
+        replies.append(reply.id)
+    db.commit()
+    return session.id, replies
+
+def test_writer_fills_drops_and_skips_reserved_rows(sqlite_shards):
+    (shard,) = sqlite_shards().values()
+    with shard.SessionLocal() as db:
+        pk, (filled, dropped, deleted) = reserve(db, "a_default", 3)
+        # History deleted while the third reply was streaming
+        db.query(Message).filter(Message.id == deleted).delete()
+        db.commit()
+
+    async def scenario():
+        writer = MessageWriter(flush_ms=1)
+        writer.start()
+        await writer.submit("a_default", pk, filled, "ไพ่ใบนี้", "m", truncated=True, shard=shard)
+        await writer.submit("a_default", pk, dropped, None, shard=shard)
+        await writer.submit("a_default", pk, deleted, "lost", "m", shard=shard)
+        await writer.wait("a_default")
+        await writer.stop()
+
+    asyncio.run(scenario())
+    session_cache.invalidate("a_default")
+    with shard.SessionLocal() as db:
+        rows = db.execute(select(Message.role, Message.content, Message.truncated, Message.pending).where(Message.session_id == pk).order_by(Message.id)).all()
+        session = db.get(DBSession, pk)
+    assert [tuple(row) for row in rows] == [
+        ("user", "turn 0", False, False), ("assistant", "ไพ่ใบนี้", True, False),
+        ("user", "turn 1", False, False), ("user", "turn 2", False, False),
+    ]
+    # One more message and one more version for the batch
+    assert (session.message_count, session.version) == (4, 4)
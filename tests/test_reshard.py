@@ -0,0 +1,118 @@
+# python -m src.reshard over SQLite shards, growing a two-shard map to three
+import pytest
+from sqlalchemy import func, select
+
+import src.models as models
+import src.reshard as reshard_module
+from src.models import Message, Session as DBSession, SessionSummary
+from src.reshard import reshard
+
+SESSIONS = 60
+TURNS = 5
+
+@pytest.fixture
+def resharding(sqlite_shards):
+    # Sessions written under the previous map, servers restarted with the new one
+    shards = sqlite_shards(["0", "1", "2"], previous=["0", "1"])
+    old_ring = models.previous_ring
+
+    # Turns of all sessions interleaved, so each shard numbers them differently
+    # from the one they move to; every session has a summary up to its third message
+    sessions = {}
+    for i in range(SESSIONS):
+        session_id = f"s{i}_memory"
+        with shards[old_ring.node(session_id)].SessionLocal() as db:
+            session = DBSession(session_id=session_id, version=TURNS * 2, message_count=TURNS * 2)
+            db.add(session)
+            db.commit()
+            sessions[session_id] = session.id
+    expected = {session_id: [] for session_id in sessions}
+    for turn in range(TURNS):
+        for session_id, pk in sessions.items():
+            with shards[old_ring.node(session_id)].SessionLocal() as db:
+                for role in ("user", "assistant"):
+                    content = f"{session_id} {role} {turn}"
+                    db.add(Message(session_id=pk, role=role, content=content, model_id="test"))
+                    expected[session_id].append((role, content))
+                db.commit()
+    for session_id, pk in sessions.items():
+        with shards[old_ring.node(session_id)].SessionLocal() as db:
+            third = db.execute(select(Message.id).where(Message.session_id == pk).order_by(Message.id).offset(2).limit(1)).scalar()
+            db.add(SessionSummary(session_id=pk, summary=f"summary of {session_id}", last_message_id=third))
+            db.commit()
+
+    return shards, expected
+
+def snapshot(shards):
+    # session_id -> [(shard, message_count, [(role, content)], content of the summary's last message)]
+    found = {}
+    for shard in shards.values():
+        with shard.SessionLocal() as db:
+            for session in db.execute(select(DBSession)).scalars():
+                messages = db.execute(select(Message).where(Message.session_id == session.id).order_by(Message.id)).scalars().all()
+                summary = db.get(SessionSummary, session.id)
+                folded = next((m.content for m in messages if summary and m.id == summary.last_message_id), None)
+                found.setdefault(session.session_id, []).append(
+                    (shard.name, session.message_count, [(m.role, m.content) for m in messages], folded)
+                )
+    return found
+
+def message_total(shards):
+    total = 0
+    for shard in shards.values():
+        with shard.SessionLocal() as db:
+            total += db.execute(select(func.count(Message.id))).scalar()
+    return total
+
+def check_moved(shards, expected):
+    found = snapshot(shards)
+    assert set(found) == set(expected)
+    for session_id, copies in found.items():
+        # Exactly one copy, on its shard under the new map, nothing lost or reordered
+        assert len(copies) == 1
+        name, message_count, messages, folded = copies[0]
+        assert name == models.shard_for(session_id).name
+        assert messages == expected[session_id]
+        assert message_count == len(expected[session_id])
+        assert folded == expected[session_id][2][1]
+    assert message_total(shards) == SESSIONS * TURNS * 2
+
+def test_reshard_moves_sessions(resharding):
+    shards, expected = resharding
+    misplaced = sum(models.shard_for(session_id) is not models.shards[models.previous_ring.node(session_id)] for session_id in expected)
+    assert misplaced > 0
+
+    report = reshard(idle_seconds=-5, batch_size=7, pause_ms=0)
+    assert report["misplaced"] == misplaced
+    assert report["moved"] == misplaced
+    assert report["conflicts"] == 0
+    assert report["messages"] == misplaced * TURNS * 2
+    check_moved(shards, expected)
+
+    again = reshard(idle_seconds=-5, batch_size=7, pause_ms=0)
+    assert again["misplaced"] == 0
+
+def test_reshard_resumes_after_stopping(resharding, monkeypatch):
+    shards, expected = resharding
+    # Stop partway, after a copy committed but before its source was deleted
+    delete_session = reshard_module.delete_session
+    calls = []
+
+    def stop_on_fourth(where, db):
+        calls.append(where)
+        if len(calls) == 4:
+            raise KeyboardInterrupt
+        return delete_session(where, db)
+
+    monkeypatch.setattr(reshard_module, "delete_session", stop_on_fourth)
+    with pytest.raises(KeyboardInterrupt):
+        reshard(idle_seconds=-5, batch_size=7, pause_ms=0)
+    assert len(calls) == 4
+    found = snapshot(shards)
+    assert sum(len(copies) == 2 for copies in found.values()) == 1
+
+    monkeypatch.setattr(reshard_module, "delete_session", delete_session)
+    report = reshard(idle_seconds=-5, batch_size=7, pause_ms=0)
+    assert report["conflicts"] == 0
+    assert report["busy"] == 0
+    check_moved(shards, expected)
@@ -0,0 +1,44 @@
+import time
+
+from src.response_cache import ResponseCache
+
+def history(question: str, greeting: str = "สวัสดีค่ะ"):
+    return [{"role": "system", "content": "You are a seer."}, {"role": "assistant", "content": greeting}, {"role": "user", "content": question}]
+
+def test_exact_tier_matches_normalized_history():
+    cache = ResponseCache(semantic=False)
+    key = cache.key("m", 0.2, history("The Lovers ความรักของฉันจะเป็นยังไง"))
+    assert cache.lookup(key) == (None, None)
+    cache.store(key, "m", ["ไพ่", "ใบนี้"])
+
+    # Case and runs of whitespace do not matter, the model and temperature do
+    reply, outcome = cache.lookup(cache.key("m", 0.2, history("  the LOVERS \n ความรักของฉันจะเป็นยังไง ")))
+    assert (reply.parts, outcome) == (["ไพ่", "ใบนี้"], "hit")
+    assert cache.lookup(cache.key("m", 0.25, history("The Lovers ความรักของฉันจะเป็นยังไง"))) == (None, None)
+    assert cache.lookup(cache.key("other", 0.2, history("The Lovers ความรักของฉันจะเป็นยังไง"))) == (None, None)
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 3
+
+def test_semantic_tier_needs_the_same_prefix():
+    cache = ResponseCache(semantic=True, similarity=0.8)
+    key = cache.key("m", 0.2, history("อยากรู้เรื่องการงานปีนี้ค่ะ"))
+    cache.lookup(key)  # embeds the query, as a miss before a store does
+    cache.store(key, "m", ["งานดี"])
+
+    reply, outcome = cache.lookup(cache.key("m", 0.2, history("อยากรู้เรื่องการงานปีนี้ครับ")))
+    assert (reply.parts, outcome) == (["งานดี"], "semantic")
+    # A similar question after a different greeting is another conversation
+    assert cache.lookup(cache.key("m", 0.2, history("อยากรู้เรื่องการงานปีนี้ครับ", greeting="หวัดดี"))) == (None, None)
+    assert cache.lookup(cache.key("m", 0.2, history("ความรักจะสมหวังไหม"))) == (None, None)
+
+def test_entries_expire_and_are_evicted():
+    cache = ResponseCache(max_entries=2, ttl=60, semantic=False)
+    keys = [cache.key("m", 0.0, history(f"คำถาม {i}")) for i in range(3)]
+    for key in keys:
+        cache.store(key, "m", ["x"])
+    assert cache.lookup(keys[0]) == (None, None)
+    assert cache.lookup(keys[2])[1] == "hit"
+    assert cache.stats()["evictions"] == 1
+
+    cache.entries[keys[2].exact].expires_at = time.monotonic() - 1
+    assert cache.lookup(keys[2]) == (None, None)
+    assert cache.stats()["entries"] == 1
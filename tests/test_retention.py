@@ -0,0 +1,53 @@
+import asyncio
+from datetime import timedelta
+
+from sqlalchemy import select
+
+import src.retention as retention
+from src.models import Message, Session as DBSession
+from src.retention import acquire_lease, release_lease, run_retention, utcnow
+
+def add_session(db, session_id: str, idle_days: float):
+    session = DBSession(session_id=session_id, last_activity=utcnow() - timedelta(days=idle_days))
+    db.add(session)
+    db.flush()
+    db.add(Message(session_id=session.id, role="user", content=f"hello from {session_id}"))
+
+def remaining(shard):
+    with shard.SessionLocal() as db:
+        return set(db.execute(select(DBSession.session_id)).scalars())
+
+def test_longest_suffix_decides_ttl(sqlite_shards, monkeypatch):
+    (shard,) = sqlite_shards().values()
+    # _x_rag also ends in _rag but keeps its own, longer TTL
+    monkeypatch.setattr(retention, "RETENTION_TTL_DAYS", {"_rag": 1, "_x_rag": 30})
+    monkeypatch.setattr(retention, "RETENTION_DAYS", 10)
+    with shard.SessionLocal() as db:
+        for session_id, idle_days in [
+            ("a_rag", 5), ("b_rag", 0.5),
+            ("a_x_rag", 5), ("b_x_rag", 40),
+            ("a_default", 5), ("b_default", 20),
+        ]:
+            add_session(db, session_id, idle_days)
+        db.commit()
+
+    report = asyncio.run(run_retention(pause_ms=0, archive_dir=None))
+    assert remaining(shard) == {"b_rag", "a_x_rag", "a_default"}
+    assert report["sessions"] == 3
+    assert report["messages"] == 3
+
+def test_one_holder_runs_retention(sqlite_shards):
+    (shard,) = sqlite_shards().values()
+    with shard.SessionLocal() as db:
+        assert acquire_lease("retention", "worker-1", 60, db=db)
+        assert not acquire_lease("retention", "worker-2", 60, db=db)
+        # Renewed by its holder
+        assert acquire_lease("retention", "worker-1", 60, db=db)
+        assert not acquire_lease("retention", "worker-2", 60, db=db)
+
+        # Taken over once it expires, or as soon as its holder lets go
+        assert acquire_lease("retention", "worker-1", -1, db=db)
+        assert acquire_lease("retention", "worker-2", 60, db=db)
+        assert not acquire_lease("retention", "worker-1", 60, db=db)
+        release_lease("retention", "worker-2", db=db)
+        assert acquire_lease("retention", "worker-1", 60, db=db)
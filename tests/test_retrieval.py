@@ -0,0 +1,16 @@
+from src.retrieval import BM25Index, Passage, RagIndex, tarot_passages
+
+def test_documents_without_tokens_find_nothing():
+    # Punctuation-only documents give an average length of 0
+    for documents in ([], [Passage("!!", "..."), Passage("", "—")]):
+        index = RagIndex(tarot_passages(), documents)
+        pinned, related = index.retrieve("ความรัก The Fool", ["The Fool"])
+        assert pinned and all(passage.title == "The Fool" for passage in pinned)
+        assert related == []
+
+def test_related_passages_come_from_documents_only():
+    documents = [Passage("งาน", "เปลี่ยนงานใหม่ เงินเดือน หัวหน้า"), Passage("ความรัก", "แฟน คนรัก ความสัมพันธ์")]
+    index = BM25Index(documents)
+    assert index.search("อยากเปลี่ยนงานใหม่ หัวหน้าไม่ดี", min_score=0) == [documents[0]]
+    # Below the minimum score nothing is returned
+    assert index.search("อยากเปลี่ยนงานใหม่ หัวหน้าไม่ดี", min_score=1000) == []
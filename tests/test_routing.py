@@ -0,0 +1,78 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import src.routing as routing
+from src.routing import Router
+
+PRIMARY = "typhoon-v1.5x-70b-instruct"
+FALLBACK = "llama-3.1-70b-versatile"
+
+class FakeStream:
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.closed = False
+
+    def __aiter__(self):
+        return self.chunks()
+
+    async def chunks(self):
+        await asyncio.sleep(self.delay)
+        for text in ("ไพ่", "ใบนี้"):
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=text))])
+
+    async def close(self):
+        self.closed = True
+
+@pytest.fixture
+def providers(monkeypatch):
+    # First token delay per model; every stream opened, by model
+    delays, opened = {}, {}
+
+    async def create(model, **kwargs):
+        stream = FakeStream(delays[model])
+        opened.setdefault(model, []).append(stream)
+        return stream
+
+    client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+    monkeypatch.setattr(routing, "init_providers", lambda: SimpleNamespace(get=lambda model_id, retries=None: client))
+    return delays, opened
+
+def test_lost_hedge_records_its_wait(providers):
+    delays, opened = providers
+    delays.update({PRIMARY: 1.0, FALLBACK: 0.01})
+    router = Router(fallbacks={PRIMARY: [FALLBACK]}, hedge_ms=50)
+
+    async def scenario():
+        stream = await router.open(PRIMARY, [], 0.5)
+        return stream.model_id, [chunk.choices[0].delta.content async for chunk in stream]
+
+    assert asyncio.run(scenario()) == (FALLBACK, ["ไพ่", "ใบนี้"])
+    assert router.stats()["hedge_wins"] == 1
+    primary = router.model_health(PRIMARY)
+    # The loser's TTFT is at least the time it took the hedge to win
+    assert primary.samples == 1 and primary.ttft >= 0.05
+    assert primary.errors == 0
+    assert router.model_health(FALLBACK).samples == 1
+    assert opened[PRIMARY][0].closed
+
+def test_client_disconnect_leaves_health_alone(providers):
+    delays, opened = providers
+    delays.update({PRIMARY: 1.0, FALLBACK: 1.0})
+    router = Router(fallbacks={PRIMARY: [FALLBACK]}, hedge_ms=50)
+
+    async def scenario():
+        task = asyncio.create_task(router.open(PRIMARY, [], 0.5))
+        await asyncio.sleep(0.1)
+        # Hedged by now; the client goes away before either answers
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert router.stats()["hedges"] == 1
+    for model_id in (PRIMARY, FALLBACK):
+        health = router.model_health(model_id)
+        assert (health.samples, health.errors) == (0, 0)
+        assert opened[model_id][0].closed